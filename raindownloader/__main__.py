@@ -0,0 +1,8 @@
+"""
+Allow running the command line with `python -m raindownloader`
+"""
+import sys
+
+from .cli import main
+
+sys.exit(main())
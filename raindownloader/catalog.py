@@ -0,0 +1,198 @@
+"""
+The catalog module keeps track of the files available in the local folder.
+It is a small SQLite database stored in the local folder, with one row per datatype,
+date and reference date, so the parsers don't need to hit the filesystem (exists/stat)
+to know whether a file has already been downloaded.
+"""
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+
+from .utils import DateProcessor, OSUtil
+
+
+class LocalCatalog:
+    """
+    Persistent catalog of the local archive.
+    Each entry stores the local path, size, remote modification time (the downloaded files
+    are stamped with the remote time) and the last time the file was checked against the server.
+    """
+
+    filename = "catalog.sqlite"
+
+    def __init__(self, local_folder: Union[str, Path]):
+        self.path = Path(local_folder) / LocalCatalog.filename
+        self._lock = threading.Lock()
+
+        # the connection is shared by the download workers, so access is serialized by the lock
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                datatype TEXT NOT NULL,
+                date TEXT NOT NULL,
+                ref_date TEXT NOT NULL DEFAULT '',
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                remote_mtime TEXT NOT NULL,
+                checked REAL NOT NULL,
+                PRIMARY KEY (datatype, ref_date, date)
+            )
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def date_key(date: Optional[Union[str, datetime]]) -> str:
+        """Normalize a date (or ref_date) to the format stored in the catalog"""
+        if date is None:
+            return ""
+        return DateProcessor.parse_date(date).strftime("%Y%m%dT%H%M%S")
+
+    @staticmethod
+    def _entry(row: tuple) -> dict:
+        """Convert a row into a dict with the same keys of `OSUtil.get_local_file_info`"""
+        path, size, remote_mtime, checked = row
+        return {
+            "path": Path(path),
+            "size": size,
+            "datetime": datetime.fromisoformat(remote_mtime),
+            "checked": checked,
+        }
+
+    def get(
+        self,
+        datatype: str,
+        date: Union[str, datetime],
+        ref_date: Optional[Union[str, datetime]] = None,
+    ) -> Optional[dict]:
+        """Return the entry of a file or None if it is not in the catalog"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path, size, remote_mtime, checked FROM files "
+                "WHERE datatype = ? AND ref_date = ? AND date = ?",
+                (datatype, self.date_key(ref_date), self.date_key(date)),
+            ).fetchone()
+
+        return None if row is None else self._entry(row)
+
+    def lookup(
+        self,
+        datatype: str,
+        dates: Iterable[Union[str, datetime]],
+        ref_date: Optional[Union[str, datetime]] = None,
+    ) -> Dict[str, dict]:
+        """
+        Return the entries of the given dates that are in the catalog, keyed by `date_key`.
+        The whole range is retrieved in a single (indexed) query.
+        """
+        keys = {self.date_key(date) for date in dates}
+        if not keys:
+            return {}
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT date, path, size, remote_mtime, checked FROM files "
+                "WHERE datatype = ? AND ref_date = ? AND date BETWEEN ? AND ?",
+                (datatype, self.date_key(ref_date), min(keys), max(keys)),
+            ).fetchall()
+
+        return {row[0]: self._entry(row[1:]) for row in rows if row[0] in keys}
+
+    def latest(
+        self, datatype: str, ref_date: Optional[Union[str, datetime]] = None
+    ) -> Optional[datetime]:
+        """Return the most recent date of a datatype in the catalog"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(date) FROM files WHERE datatype = ? AND ref_date = ?",
+                (datatype, self.date_key(ref_date)),
+            ).fetchone()
+
+        return None if row[0] is None else datetime.strptime(row[0], "%Y%m%dT%H%M%S")
+
+    def register(
+        self,
+        datatype: str,
+        date: Union[str, datetime],
+        path: Union[str, Path],
+        ref_date: Optional[Union[str, datetime]] = None,
+    ) -> dict:
+        """Add (or replace) the entry of a local file, reading its size and time from disk"""
+        info = OSUtil.get_local_file_info(path)
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datatype,
+                    self.date_key(date),
+                    self.date_key(ref_date),
+                    str(path),
+                    info["size"],
+                    info["datetime"].isoformat(),
+                    time.time(),
+                ),
+            )
+            self._db.commit()
+
+        return {"path": Path(path), "checked": time.time(), **info}
+
+    def touch(
+        self,
+        datatype: str,
+        date: Union[str, datetime],
+        ref_date: Optional[Union[str, datetime]] = None,
+    ):
+        """Update the last check time of an entry"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE files SET checked = ? WHERE datatype = ? AND ref_date = ? AND date = ?",
+                (time.time(), datatype, self.date_key(ref_date), self.date_key(date)),
+            )
+            self._db.commit()
+
+    def remove(
+        self,
+        datatype: str,
+        date: Union[str, datetime],
+        ref_date: Optional[Union[str, datetime]] = None,
+    ):
+        """Remove an entry from the catalog"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM files WHERE datatype = ? AND ref_date = ? AND date = ?",
+                (datatype, self.date_key(ref_date), self.date_key(date)),
+            )
+            self._db.commit()
+
+    def prune(self) -> int:
+        """
+        Remove the entries whose files are no longer in the local folder
+        (e.g., deleted by the user). Return the number of removed entries.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT rowid, path FROM files").fetchall()
+            missing = [(rowid,) for rowid, path in rows if not Path(path).exists()]
+            self._db.executemany("DELETE FROM files WHERE rowid = ?", missing)
+            self._db.commit()
+
+        return len(missing)
+
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self._db.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __repr__(self) -> str:
+        return f"LocalCatalog({self.path}, {len(self)} files)"
@@ -0,0 +1,180 @@
+"""
+Command line interface of the package.
+Usage: raindownloader sync --datatypes DAILY_RAIN --start 2023-01-01 --end 2023-03-31 --workers 4
+
+The `sync` command downloads (or checks) the files of the given datatypes and period
+to the local folder and prints a summary at the end, so it can be scheduled (e.g., cron)
+to keep the local archive up to date.
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+from .downloader import Downloader
+from .inpeparser import INPEParsers, INPETypes
+from .utils import DateProcessor
+
+
+class SyncStats:
+    """Counters of a sync run"""
+
+    def __init__(self):
+        self.cached = 0
+        self.downloaded = 0
+        self.bytes = 0
+        self.failures: List[str] = []
+        self.start = time.perf_counter()
+
+    @property
+    def files(self) -> int:
+        """Total of files processed"""
+        return self.cached + self.downloaded + len(self.failures)
+
+    def summary(self) -> str:
+        """Return the summary of the run"""
+        elapsed = time.perf_counter() - self.start
+        return (
+            f"{self.files} files in {elapsed:.1f}s: {self.downloaded} downloaded "
+            f"({self.bytes / 1e6:.1f} MB, {self.bytes / 1e6 / elapsed:.2f} MB/s, "
+            f"{self.files / elapsed:.1f} files/s), {self.cached} cache hits, "
+            f"{len(self.failures)} failures"
+        )
+
+
+def sync(
+    downloader: Downloader,
+    datatype: INPETypes,
+    start_date: str,
+    end_date: str,
+    stats: SyncStats,
+    **kwargs,
+):
+    """
+    Get the files of a datatype in the period, using `downloader.max_workers` threads.
+    Each parser decides if its files must be updated. The files left untouched are counted
+    as cache hits and errors are counted as failures, without interrupting the other files.
+    """
+    parser = downloader.get_parser(datatype)
+
+    def file_stat(file: Path) -> Optional[tuple]:
+        if not file.exists():
+            return None
+
+        stat = file.stat()
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def worker(date: str):
+        try:
+            local_target = parser.local_target(date, downloader.local_folder, **kwargs)
+            before = file_stat(local_target)
+
+            with downloader.ftp.session():
+                file = Path(parser.get_file(date, downloader.local_folder, **kwargs))
+
+            # a file that was replaced or rewritten has been downloaded (or updated)
+            if file == local_target and file_stat(file) == before:
+                return "cached", 0
+
+            return "downloaded", file.stat().st_size
+
+        except Exception as error:  # pylint: disable=broad-except
+            return "failed", f"{datatype.name}/{date}: {error}"
+
+    dates = parser.dates_range(start_date, end_date)
+
+    # the freshness checks are answered by the folder listings
+    if not parser.avoid_update:
+        downloader.ftp.prefetch_listings(
+            [parser.remote_path(date, **kwargs) for date in dates]
+        )
+
+    with ThreadPoolExecutor(max_workers=downloader.max_workers) as executor:
+        for status, value in executor.map(worker, dates):
+            if status == "cached":
+                stats.cached += 1
+            elif status == "downloaded":
+                stats.downloaded += 1
+                stats.bytes += value
+            else:
+                stats.failures.append(value)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """Create the argument parser"""
+    yesterday = DateProcessor.normalize_date(datetime.now() - timedelta(days=1))
+
+    arg_parser = argparse.ArgumentParser(
+        prog="raindownloader", description="Download rain data from INPE"
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = commands.add_parser(
+        "sync", help="Download the files of a period to the local folder"
+    )
+    sync_parser.add_argument(
+        "--datatypes",
+        nargs="+",
+        choices=[datatype.name for datatype in INPETypes],
+        default=[INPETypes.DAILY_RAIN.name],
+    )
+    sync_parser.add_argument("--start", required=True, help="start date (YYYY-MM-DD)")
+    sync_parser.add_argument(
+        "--end", default=yesterday, help="end date, defaults to yesterday"
+    )
+    sync_parser.add_argument("--ref-date", help="reference date of the WRF forecasts")
+    sync_parser.add_argument("--workers", type=int, default=4)
+    sync_parser.add_argument("--local-folder", default=".", type=Path)
+    sync_parser.add_argument("--server", default=INPEParsers.FTPurl)
+    sync_parser.add_argument(
+        "--check-updates",
+        action="store_true",
+        help="download again the files that changed in the server",
+    )
+
+    return arg_parser
+
+
+# datatypes whose files depend on the reference date of the forecast
+WRF_TYPES = {INPETypes.HOURLY_WRF.name, INPETypes.DAILY_WRF.name}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the command line and return the exit code (1 if any file failed)"""
+    arg_parser = create_parser()
+    args = arg_parser.parse_args(argv)
+
+    wrf_types = WRF_TYPES.intersection(args.datatypes)
+    if wrf_types and args.ref_date is None:
+        arg_parser.error(f"--ref-date is required for {', '.join(sorted(wrf_types))}")
+
+    args.local_folder.mkdir(parents=True, exist_ok=True)
+    downloader = Downloader(
+        server=args.server,
+        parsers=INPEParsers.parsers,
+        local_folder=args.local_folder,
+        avoid_update=not args.check_updates,
+        max_workers=args.workers,
+        keepalive=None,
+    )
+
+    kwargs = {} if args.ref_date is None else {"ref_date": args.ref_date}
+
+    stats = SyncStats()
+    try:
+        for name in args.datatypes:
+            before = stats.files
+            sync(downloader, INPETypes[name], args.start, args.end, stats, **kwargs)
+            print(f"{name}: {stats.files - before} files")
+    finally:
+        downloader.close()
+
+    for failure in stats.failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+
+    print(stats.summary())
+
+    return 1 if stats.failures else 0
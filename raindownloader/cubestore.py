@@ -0,0 +1,313 @@
+"""
+The cubestore module keeps the decoded cubes of a datatype in a chunked Zarr store,
+so creating a cube for a period that was already decoded is just a slice of the store.
+It also keeps the running totals of the daily rain (CumulativeStore), so the accumulation
+of any period is the difference of two slices.
+"""
+from __future__ import annotations
+
+import shutil
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Union
+
+from .lazy import np, pd, xr
+from .utils import GISUtil
+
+
+class CubeStore:
+    """
+    Zarr store with the cube of one datatype, appended along `time` as new dates are opened.
+    Each layer is identified by the requested date (`date` coordinate), that may differ from
+    the time inside the file. Reading does not depend on the order the dates were appended.
+    :param path: Path of the Zarr store (e.g., local_folder/cache/cubes/DAILY_RAIN.zarr)
+    :param time_chunk: Number of dates in each chunk of the store
+    """
+
+    dim = "time"
+    var = "data"
+
+    def __init__(self, path: Union[str, Path], time_chunk: int = 32):
+        self.path = Path(path)
+        self.time_chunk = time_chunk
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _dates(dates: List[Union[str, datetime]]) -> pd.DatetimeIndex:
+        """Convert the dates to a DatetimeIndex (dates are normalized to midnight/hour)"""
+        return pd.DatetimeIndex([pd.Timestamp(date) for date in dates])
+
+    def positions(self, dates: List[Union[str, datetime]]) -> Optional[np.ndarray]:
+        """
+        Return the positions of the dates along time in the store or None if any of them
+        is not in the store.
+        """
+        if not self.path.exists():
+            return None
+
+        with xr.open_zarr(self.path) as store:
+            stored = pd.DatetimeIndex(store["date"].values)
+
+        positions = stored.get_indexer(self._dates(dates))
+        return None if (positions < 0).any() else positions
+
+    def missing(self, dates: List[Union[str, datetime]]) -> list:
+        """Return the dates that are not in the store"""
+        if not self.path.exists():
+            return list(dates)
+
+        with xr.open_zarr(self.path) as store:
+            stored = pd.DatetimeIndex(store["date"].values)
+
+        return [
+            date
+            for date, position in zip(dates, stored.get_indexer(self._dates(dates)))
+            if position < 0
+        ]
+
+    def read(
+        self,
+        dates: List[Union[str, datetime]],
+        lazy: bool = False,
+        subset: Optional[Callable] = None,
+    ) -> Optional[xr.DataArray]:
+        """
+        Return the cube with the given dates (in the same order) or None if any of them is
+        not in the store. If lazy is True, the data is returned as dask arrays.
+        `subset` is applied to the cube before loading it (e.g., to cut a region).
+        """
+        positions = self.positions(dates)
+        if positions is None:
+            return None
+
+        if lazy:
+            GISUtil.require_dask()
+
+        store = xr.open_zarr(self.path, chunks={} if lazy else None)
+        cube = store[self.var].isel({self.dim: positions})
+
+        # the CRS (spatial_ref) is read back as a variable of the store
+        if "spatial_ref" in store and "spatial_ref" not in cube.coords:
+            cube = cube.assign_coords(spatial_ref=store["spatial_ref"])
+        cube = cube.rename(store.attrs.get("name"))
+
+        # coordinates that don't change along time are scalars, as in xr.concat
+        cube = cube.drop_vars("date")
+        for name, coord in list(cube.coords.items()):
+            if name not in cube.dims and coord.dims == (self.dim,):
+                if bool((coord == coord[0]).all()):
+                    cube = cube.assign_coords({name: coord[0].values})
+
+        if subset is not None:
+            cube = subset(cube)
+
+        return cube if lazy else cube.load()
+
+    def append(self, cube: xr.DataArray, dates: List[Union[str, datetime]]):
+        """
+        Append the layers of the cube (stacked along time) with the requested dates.
+        Dates already in the store are skipped.
+        """
+        with self._lock:
+            missing = set(self._dates(self.missing(dates)))
+            keep = [i for i, date in enumerate(self._dates(dates)) if date in missing]
+            if not keep:
+                return
+
+            cube = cube.isel({self.dim: keep}).assign_coords(
+                date=(self.dim, self._dates(dates)[keep])
+            )
+
+            # scalar coordinates are stored along time, so all appends have the same layout
+            for name, coord in list(cube.coords.items()):
+                if coord.ndim == 0 and name != "spatial_ref":
+                    cube = cube.assign_coords(
+                        {
+                            name: (
+                                self.dim,
+                                np.repeat(coord.values, cube.sizes[self.dim]),
+                            )
+                        }
+                    )
+
+            dset = cube.rename(self.var).to_dataset()
+            dset.attrs["name"] = cube.name
+
+            if self.path.exists():
+                dset.to_zarr(self.path, append_dim=self.dim)
+            else:
+                dset.to_zarr(self.path, mode="w", encoding=self.encoding(dset))
+
+    def encoding(self, dset: xr.Dataset) -> dict:
+        """
+        Encoding of a new store: chunks along time and fixed units for the datetimes,
+        so dates appended later can always be represented
+        """
+        encoding = {
+            self.var: {
+                "chunks": [
+                    self.time_chunk if dim == self.dim else size
+                    for dim, size in dset[self.var].sizes.items()
+                ]
+            }
+        }
+
+        for name, coord in dset.coords.items():
+            if np.issubdtype(coord.dtype, np.datetime64):
+                encoding[name] = {"units": "seconds since 1970-01-01", "dtype": "int64"}
+            elif np.issubdtype(coord.dtype, np.timedelta64):
+                encoding[name] = {"units": "seconds", "dtype": "int64"}
+
+        return encoding
+
+    def clear(self):
+        """Remove the store"""
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class CumulativeStore:
+    """
+    Zarr store with the running total (per pixel) of a daily datatype, so the accumulation
+    of any period is the difference of two slices: total(end) - total(start - 1 day).
+    The first layer is a zero grid at the day before the first date, as the base of
+    the differences. NaNs are accumulated as 0.
+    :param path: Path of the Zarr store (e.g., local_folder/cache/cumsum/DAILY_RAIN.zarr)
+    :param time_chunk: Number of days in each chunk, also the number of days written at once
+    """
+
+    dim = "time"
+    var = "cumsum"
+    step = timedelta(days=1)
+
+    def __init__(self, path: Union[str, Path], time_chunk: int = 32):
+        self.path = Path(path)
+        self.time_chunk = time_chunk
+        self._lock = threading.Lock()
+
+    def dates(self) -> Optional[pd.DatetimeIndex]:
+        """Return the dates in the store (including the base) or None if it is empty"""
+        if not self.path.exists():
+            return None
+
+        with xr.open_zarr(self.path) as store:
+            return pd.DatetimeIndex(store[self.dim].values)
+
+    def covers(self, start_date: datetime, end_date: datetime) -> bool:
+        """Return True if the accumulation from start_date to end_date can be read"""
+        dates = self.dates()
+        return (
+            dates is not None
+            and dates[0] <= pd.Timestamp(start_date) - self.step
+            and dates[-1] >= pd.Timestamp(end_date)
+        )
+
+    def extend(self, arrays: Iterable[xr.DataArray], start_date: datetime):
+        """
+        Append the running totals of the daily arrays, from start_date on.
+        The start_date must be the day after the last date in the store.
+        The totals are written every `time_chunk` days, so just one chunk is kept in memory.
+        """
+        with self._lock:
+            start = pd.Timestamp(start_date)
+            dates = self.dates()
+
+            if dates is None:
+                total, date = None, start - self.step
+            elif dates[-1] + self.step == start:
+                with xr.open_zarr(self.path) as store:
+                    total = store[self.var].isel({self.dim: -1}).values
+                date = dates[-1]
+            else:
+                raise ValueError(
+                    f"Dates must be contiguous: {start} does not follow {dates[-1]}"
+                )
+
+            block: list = []
+            template = None
+            for array in arrays:
+                values = np.nan_to_num(np.asarray(array.values, dtype="float64"))
+
+                # the first write starts with the zero base
+                if total is None:
+                    total = np.zeros_like(values)
+                    block.append((date, total))
+
+                template = array if template is None else template
+                total = total + values
+                date = date + self.step
+                block.append((date, total))
+
+                if len(block) >= self.time_chunk:
+                    self._write(block, template)
+                    block = []
+
+            if block:
+                self._write(block, template)
+
+    def _write(self, block: list, template: xr.DataArray):
+        """Write the block of (date, total) to the store"""
+        # keep just the grid coordinates (and the CRS) of the arrays
+        grid = template.drop_vars(
+            [
+                name
+                for name, coord in template.coords.items()
+                if coord.ndim == 0 and name != "spatial_ref"
+            ]
+        )
+
+        dates, totals = zip(*block)
+        cube = xr.DataArray(
+            np.stack(totals),
+            dims=(self.dim, *grid.dims),
+            coords={**grid.coords, self.dim: pd.DatetimeIndex(dates)},
+        )
+        dset = cube.to_dataset(name=self.var)
+        dset.attrs["name"] = template.name
+
+        if self.path.exists():
+            dset.to_zarr(self.path, append_dim=self.dim)
+        else:
+            encoding = {
+                self.var: {
+                    "chunks": [
+                        self.time_chunk if dim == self.dim else size
+                        for dim, size in cube.sizes.items()
+                    ]
+                },
+                self.dim: {"units": "seconds since 1970-01-01", "dtype": "int64"},
+            }
+            dset.to_zarr(self.path, mode="w", encoding=encoding)
+
+    def accum(
+        self, start_date: Union[str, datetime], end_date: Union[str, datetime]
+    ) -> Optional[xr.DataArray]:
+        """
+        Return the accumulation from start_date to end_date (inclusive) as float32,
+        reading just two slices, or None if the store does not cover the period.
+        """
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+
+        with xr.open_zarr(self.path) as store:
+            positions = pd.DatetimeIndex(store[self.dim].values).get_indexer(
+                [start - self.step, end]
+            )
+            if (positions < 0).any():
+                return None
+
+            totals = store[self.var].isel({self.dim: positions}).load()
+            crs = store["spatial_ref"].load() if "spatial_ref" in store else None
+            name = store.attrs.get("name")
+
+        accum = (totals[1] - totals[0]).astype("float32")
+        accum = accum.assign_coords({self.dim: start}).rename(name)
+        if crs is not None:
+            accum = accum.assign_coords(spatial_ref=crs)
+
+        return accum
+
+    def clear(self):
+        """Remove the store"""
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
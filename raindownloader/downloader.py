@@ -1,20 +1,24 @@
 """
 Module with specialized classes to understand the INPE FTP Structure
 """
+from __future__ import annotations
 
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from enum import Enum
-from typing import Union, List, Optional, Callable
+from typing import Union, List, Optional, Callable, Dict, Iterable, Iterator, Tuple
 from datetime import datetime, timedelta
 import logging
 from logging import handlers
 
-import geopandas as gpd
-import xarray as xr
-
-from .utils import FTPUtil, OSUtil, DateProcessor
+from .lazy import gpd, np, xr
+from .utils import FTPUtil, OSUtil, DateProcessor, DateFrequency, GISUtil, Reducer
 from .inpeparser import INPETypes
 from .parser import BaseParser
+from .catalog import LocalCatalog
+from .cubestore import CubeStore, CumulativeStore
+from .maskcache import MaskCache
 
 
 class Downloader:
@@ -27,6 +31,12 @@ class Downloader:
         local_folder: Union[str, Path],
         avoid_update: bool = True,
         log_level: int = logging.INFO,
+        max_workers: int = 1,
+        keepalive: Optional[float] = 60,
+        catalog: bool = True,
+        prefetch: int = 0,
+        cube_store: bool = False,
+        cumulative_store: bool = False,
     ) -> None:
         """
         :param server: FTP server to connect to (should accept Anonymous)
@@ -38,13 +48,53 @@ class Downloader:
         :param post_processors: Any function that should be applied to the image after download.
         This argument should be a dictionary of file extension and function.
         For default processor, check NPEParsers.post_processors. Defaults to None
+        :param max_workers: Number of parallel FTP sessions/threads used to download ranges
+        of files, defaults to 1 (sequential download)
+        :param keepalive: Interval (in seconds) to send NOOP to idle FTP connections, so they are
+        not dropped by the server. None disables it. Defaults to 60
+        :param catalog: Keep a catalog of the downloaded files (catalog.sqlite in the local folder),
+        so the parsers don't need to check the filesystem for every file, defaults to True.
+        Files deleted manually from the local folder are downloaded again when opened;
+        call `.catalog.prune()` to drop their entries from the ranges as well
+        :param prefetch: Number of dates to download in background ahead of the date being
+        opened when creating cubes, so downloading and decoding overlap. It also downloads the
+        day after the latest local DAILY_RAIN file. Defaults to 0 (no prefetch)
+        :param cube_store: Keep the cubes created by `create_cube` in a Zarr store per datatype
+        (local_folder/cache/cubes), appending the new dates, so periods already decoded are
+        just sliced from the store. Datatypes whose parser checks for updates in the server
+        (avoid_update=False) or has its own freshness logic (e.g., MONTHLY_ACCUM_MANUAL)
+        don't use the store. Defaults to False
+        :param cumulative_store: Keep the running totals of the daily datatypes in a Zarr store
+        (local_folder/cache/cumsum), so `accum_rain` and `accum_periodically_rain` read just
+        two slices per period. Files updated in the server after being accumulated are not
+        reflected in the totals; call `.get_cumulative_store(datatype).clear()` to rebuild.
+        Defaults to False
         """
 
+        # the prefetch threads need their own FTP sessions
+        pool_size = max_workers * 2 if prefetch else max_workers
+
         # store initialization variables
-        self.ftp = FTPUtil(server)
+        self.ftp = FTPUtil(server, pool_size=pool_size, keepalive=keepalive)
         self.parsers = parsers
         self.local_folder = Path(local_folder)
         self.avoid_update = avoid_update
+        self.max_workers = max_workers
+        self.catalog = LocalCatalog(self.local_folder) if catalog else None
+        self.index_folder = self.local_folder / "cache" / "cfgrib"
+        self.cube_stores: Optional[Dict[str, CubeStore]] = {} if cube_store else None
+        self.cumulative_stores: Optional[Dict[str, CumulativeStore]] = (
+            {} if cumulative_store else None
+        )
+
+        # rasterized geometries, to be passed to `cut_cube_by_geoms` and `get_time_series`
+        self.mask_cache = MaskCache(self.local_folder / "cache" / "masks")
+
+        # background downloads, by (datatype, date, ref_date)
+        self.prefetch = prefetch
+        self._prefetcher: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[Tuple[str, str, str], Future] = {}
+        self._pending_lock = threading.Lock()
 
         self.logger = self.init_logger(log_level)
 
@@ -54,7 +104,12 @@ class Downloader:
         for parser in self.parsers:
             parser.ftp = self.ftp
             parser.avoid_update = self.avoid_update
-            parser.clean_local_folder(local_folder=local_folder)
+            parser.max_workers = self.max_workers
+            parser.catalog = self.catalog
+            parser.index_folder = self.index_folder
+
+        if self.prefetch and INPETypes.DAILY_RAIN in self.data_types:
+            self.prefetch_latest()
 
     def init_logger(self, log_level: int):
         """Initialize the loggers (downloader and parsers)"""
@@ -111,15 +166,22 @@ class Downloader:
 
     @staticmethod
     def cut_cube_by_geoms(
-        cube: xr.DataArray, geometries: gpd.GeoSeries
+        cube: xr.DataArray,
+        geometries: gpd.GeoSeries,
+        mask_cache: Optional[MaskCache] = None,
     ) -> xr.DataArray:
         """
         Calculate the cube inside the given geometries in the GeoDataFrame.
         The geometries are stored in a GeoSeries from Pandas
+        If mask_cache is given (e.g., `downloader.mask_cache`), the geometries are rasterized
+        once per grid and the cached mask is applied to the cube.
         """
         # first make sure we have the same CRS
         geometries = geometries.to_crs(cube.rio.crs)
 
+        if mask_cache is not None:
+            return mask_cache.clip(cube, geometries)
+
         # Let's use clip to ignore data outide the geometry
         clipped = cube.rio.clip(geometries)
 
@@ -131,10 +193,17 @@ class Downloader:
         shp: gpd.GeoDataFrame,
         reducer: Callable,
         keep_dim: str = "time",  # specify the dimension along with we will retrieve the TS
+        mask_cache: Optional[MaskCache] = None,
     ):
-        """Get a time series of values within the shape, given a reducer method"""
+        """
+        Get a time series of values within the shape, given a reducer method.
+        If mask_cache is given, the shape is clipped with the cached mask (see `cut_cube_by_geoms`)
+        """
         # clip to the desired area
-        area = cube.rio.clip(shp.geometry)
+        if mask_cache is not None:
+            area = mask_cache.clip(cube, shp.geometry)
+        else:
+            area = cube.rio.clip(shp.geometry)
 
         # get the dimensions to be reduced
         reduce_dims = list(cube.dims)
@@ -207,11 +276,29 @@ class Downloader:
         remote_file = self.remote_file_path(date, datatype=datatype)
         return self.ftp.file_exists(remote_file=remote_file)
 
+    def latest_available(
+        self,
+        datatype: Union[Enum, str],
+        date: Optional[Union[str, datetime]] = None,
+        **kwargs,
+    ) -> Optional[datetime]:
+        """
+        Return the most recent date of the datatype available in the server, up to `date`
+        (defaults to today), with a single listing of the remote folder (see
+        `BaseParser.latest_available`). If the month has no files yet, the previous month
+        is searched. Returns None if none is found.
+        """
+        return self.get_parser(datatype).latest_available(date, **kwargs)
+
     def local_file_exists(
         self, date: Union[str, datetime], datatype: Union[Enum, str]
     ) -> bool:
         """Verify if a specific local file exists"""
         parser = self.get_parser(datatype=datatype)
+
+        if parser.catalog_entry(date) is not None:
+            return True
+
         local_target = parser.local_target(date=date, local_folder=self.local_folder)
 
         return local_target.exists()
@@ -260,6 +347,10 @@ class Downloader:
         changed in the server.
         """
         parser = self.get_parser(datatype=datatype)
+
+        # if the file is being prefetched, wait for it instead of downloading it twice
+        self.wait_prefetch(date, datatype, **kwargs)
+
         return parser.get_file(
             date=date,
             local_folder=self.local_folder,
@@ -267,6 +358,105 @@ class Downloader:
             **kwargs,
         )
 
+    def _prefetch_key(
+        self, date: Union[str, datetime], datatype: Union[Enum, str], **kwargs
+    ) -> Tuple[str, str, str]:
+        """Key of a file in the prefetch queue"""
+        key = self.get_parser(datatype).catalog_key(date, **kwargs)
+        return (
+            key["datatype"],
+            LocalCatalog.date_key(key["date"]),
+            LocalCatalog.date_key(key["ref_date"]),
+        )
+
+    def prefetch_files(
+        self, dates: List, datatype: Union[Enum, str], **kwargs
+    ) -> List[Future]:
+        """
+        Get the files of the given dates in background threads. Files already being
+        prefetched are not submitted again. Errors (e.g., a file not yet available in
+        the server) are logged and the file is ignored.
+        """
+        parser = self.get_parser(datatype=datatype)
+
+        def worker(date: Union[str, datetime]) -> Optional[Path]:
+            try:
+                with self.ftp.session():
+                    return parser.get_file(
+                        date=date, local_folder=self.local_folder, **kwargs
+                    )
+
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.debug("Could not prefetch %s/%s: %s", datatype, date, error)
+                return None
+
+        with self._pending_lock:
+            if self._prefetcher is None:
+                self._prefetcher = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="prefetch"
+                )
+
+            futures = []
+            for date in dates:
+                key = self._prefetch_key(date, datatype, **kwargs)
+                future = self._pending.get(key)
+
+                if future is None:
+                    self.logger.debug("Prefetching %s/%s", datatype, date)
+                    future = self._prefetcher.submit(worker, date)
+                    self._pending[key] = future
+                    future.add_done_callback(
+                        lambda _, key=key: self._pending.pop(key, None)
+                    )
+
+                futures.append(future)
+
+        return futures
+
+    def wait_prefetch(
+        self, date: Union[str, datetime], datatype: Union[Enum, str], **kwargs
+    ) -> None:
+        """Wait for the prefetch of a file, if it is in progress"""
+        if not self._pending:
+            return
+
+        future = self._pending.get(self._prefetch_key(date, datatype, **kwargs))
+        if future is not None:
+            future.result()
+
+    def prefetch_latest(self) -> Optional[Future]:
+        """
+        Prefetch the day after the latest DAILY_RAIN file in the local catalog, as the
+        reports usually move forward one day at a time.
+        """
+        if self.catalog is None:
+            return None
+
+        parser = self.get_parser(INPETypes.DAILY_RAIN)
+        latest = self.catalog.latest(parser.subfolder.as_posix())
+
+        # MERGE files are published in the following day
+        if latest is None or latest + timedelta(days=1) >= datetime.now():
+            return None
+
+        return self.prefetch_files([latest + timedelta(days=1)], parser.datatype)[0]
+
+    def close(self):
+        """
+        Release the resources of the downloader: the prefetch threads (pending prefetches
+        are cancelled), the FTP connections and the local catalog.
+        """
+        with self._pending_lock:
+            prefetcher, self._prefetcher = self._prefetcher, None
+
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=True, cancel_futures=True)
+
+        self.ftp.close()
+
+        if self.catalog is not None:
+            self.catalog.close()
+
     def get_files(
         self,
         dates: List[str],
@@ -279,6 +469,10 @@ class Downloader:
         If there is a problem during the download of one file, a message error will be in the list.
         """
         parser = self.get_parser(datatype=datatype)
+
+        for date in dates:
+            self.wait_prefetch(date, datatype, **kwargs)
+
         return parser.get_files(
             dates=dates,
             local_folder=self.local_folder,
@@ -298,12 +492,11 @@ class Downloader:
         Download a range of files from start to end dates and receives a list pointing to the files.
         If there is a problem during the download of one file, a message error will be in the list.
         """
-
         parser = self.get_parser(datatype=datatype)
-        return parser.get_range(
-            start_date=start_date,
-            end_date=end_date,
-            local_folder=self.local_folder,
+
+        return self.get_files(
+            dates=parser.date_index(start_date, end_date).to_pydatetime().tolist(),
+            datatype=datatype,
             force_download=force_download,
             **kwargs,
         )
@@ -314,60 +507,234 @@ class Downloader:
         datatype: Union[Enum, str],
         force_download: bool = False,
         return_array: bool = True,
+        in_memory: bool = False,
+        chunks: Optional[dict] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        geometry: Optional[Union[gpd.GeoSeries, gpd.GeoDataFrame]] = None,
         **kwargs,
     ) -> Union[xr.Dataset, xr.DataArray]:
         """
         Open a file and apply the post processing, if existent.
         If return_array is True, it will try to access the corresponding variable
         from the dataset, otherwise return the dataset.
+        If in_memory is True, the file is streamed from the FTP into memory and nothing is
+        written to the local folder (only for datatypes that are downloaded as they are).
+        If chunks is not None, the file is opened lazily as dask arrays with these chunks
+        and the post processing is also lazy.
+        If bbox (minx, miny, maxx, maxy) or geometry are given, the array is cut to the region
+        right after opening, so only the region is loaded (see GISUtil.subset).
         """
 
         self.logger.debug("Asked to open file %s/%s", date_str, datatype)
 
-        # get the file
-        file = self.get_file(
-            date=date_str, datatype=datatype, force_download=force_download, **kwargs
-        )
+        parser = self.get_parser(datatype=datatype)
 
-        # open the file as is
-        dset = xr.open_dataset(file)
+        if chunks is not None:
+            GISUtil.require_dask()
+            if in_memory:
+                raise ValueError("Files opened in memory can't be lazy (chunks)")
 
-        # get the parser to check if there is a post processing associated with it
-        parser = self.get_parser(datatype=datatype)
+        if in_memory:
+            dset = parser.open_remote(date=date_str, **kwargs)
+
+        else:
+            # get the file
+            file = self.get_file(
+                date=date_str,
+                datatype=datatype,
+                force_download=force_download,
+                **kwargs,
+            )
+
+            # open the file as is
+            dset = GISUtil.open_dataset(file, self.index_folder, chunks=chunks)
+
+        # check if there is a post processing associated with the parser
         if parser.post_proc is not None:
             dset = parser.post_proc(dset, date_str=date_str)
 
         # transform the dataset into array
         if return_array:
             if isinstance(datatype, Enum):
-                return dset[datatype.value["var"]]
+                array = dset[datatype.value["var"]]
             else:
-                return dset.to_array()
+                array = dset.to_array()
+
+            return GISUtil.subset(array, bbox=bbox, geometry=geometry)
+
         else:
+            if bbox is not None or geometry is not None:
+                return dset.map(GISUtil.subset, bbox=bbox, geometry=geometry)
             return dset
 
+    def get_cube_store(self, datatype: Union[Enum, str]) -> Optional[CubeStore]:
+        """Return the cube store of the datatype or None if the cube stores are disabled"""
+        if self.cube_stores is None:
+            return None
+
+        name = self.get_parser(datatype).subfolder.as_posix()
+        if name not in self.cube_stores:
+            path = self.local_folder / "cache" / "cubes" / f"{name}.zarr"
+            self.cube_stores[name] = CubeStore(path)
+
+        return self.cube_stores[name]
+
+    def get_cumulative_store(
+        self, datatype: Union[Enum, str]
+    ) -> Optional[CumulativeStore]:
+        """
+        Return the cumulative store of a daily datatype or None if the cumulative stores
+        are disabled or the datatype is not daily
+        """
+        parser = self.get_parser(datatype)
+        if self.cumulative_stores is None or parser.date_freq != DateFrequency.DAILY:
+            return None
+
+        name = parser.subfolder.as_posix()
+        if name not in self.cumulative_stores:
+            path = self.local_folder / "cache" / "cumsum" / f"{name}.zarr"
+            self.cumulative_stores[name] = CumulativeStore(path)
+
+        return self.cumulative_stores[name]
+
+    def update_cumulative_store(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+        datatype: Union[Enum, str],
+    ) -> CumulativeStore:
+        """
+        Extend the cumulative store of the datatype to cover the period, accumulating just
+        the days after the last one in the store. As the totals can't be prepended, a period
+        starting before the store rebuilds it from the new start date.
+        """
+        store = self.get_cumulative_store(datatype)
+        if store is None:
+            raise ValueError(f"There is no cumulative store for {datatype}")
+
+        start = DateProcessor.parse_date(start_date)
+        end = DateProcessor.parse_date(end_date)
+
+        dates = store.dates()
+        if dates is not None and dates[0] > start - store.step:
+            self.logger.info("Rebuilding the cumulative store from %s", start)
+            end = max(end, dates[-1].to_pydatetime())
+            store.clear()
+            dates = None
+
+        first = start if dates is None else dates[-1].to_pydatetime() + store.step
+        if first <= end:
+            new_dates = (
+                self.get_parser(datatype)
+                .date_index(start_date=first, end_date=end)
+                .to_pydatetime()
+                .tolist()
+            )
+            store.extend(self._open_files(new_dates, datatype), first)
+
+        return store
+
+    def _open_files(
+        self,
+        dates: List,
+        datatype: Union[Enum, str],
+        force_download: bool = False,
+        **kwargs,
+    ) -> Iterator[xr.DataArray]:
+        """
+        Open the files of the dates one at a time (kwargs are passed to `open_file`).
+        With prefetch, the next dates are downloaded while the current one is decoded.
+        """
+        prefetch = self.prefetch and not force_download and not kwargs.get("in_memory")
+        file_kwargs = {
+            key: value
+            for key, value in kwargs.items()
+            if key not in ("in_memory", "chunks", "bbox", "geometry")
+        }
+
+        for i, date in enumerate(dates):
+            if prefetch:
+                self.prefetch_files(
+                    dates[i + 1 : i + 1 + self.prefetch], datatype, **file_kwargs
+                )
+
+            yield self.open_file(date, datatype, force_download, **kwargs)
+
     def _create_cube(
         self,
         dates: List,
         datatype: Union[Enum, str],
         dim_key: Optional[str] = "time",
         force_download: bool = False,
+        lazy: bool = False,
+        chunks: Optional[dict] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        geometry: Optional[Union[gpd.GeoSeries, gpd.GeoDataFrame]] = None,
         **kwargs,
     ) -> xr.DataArray:
         """
         Stack the images in the list as one XARRAY Dataset cube.
+        If lazy is True, the cube is backed by dask arrays (one chunk per file, unless
+        `chunks` is given) and the data is only read when it is computed.
+        With a cube store, only the dates that are not in the store are opened and appended
+        to it. Forced downloads, files opened with extra arguments and parsers that check
+        for updates in the server (avoid_update=False) or with their own freshness logic
+        (see `BaseParser.custom_freshness`) skip the store.
+        If bbox or geometry are given, each file is cut to the region before being stacked.
+        The cube store keeps the whole grid and the region is cut when reading from it.
         """
+        region = {"bbox": bbox, "geometry": geometry}
+
+        def subset(cube: xr.DataArray) -> xr.DataArray:
+            return GISUtil.subset(cube, **region)
+
+        # in lazy mode, chunks={} means one chunk per file
+        if lazy:
+            chunks = {} if chunks is None else chunks
 
         # set the stacked dimension name
         dim = "time" if dim_key is None else dim_key
 
-        # create a cube with the files
-        data_arrays = [
-            self.open_file(date, datatype, force_download, **kwargs).astype("float32")
-            for date in dates
-        ]
+        # ranges already decoded are sliced from the cube store
+        parser = self.get_parser(datatype)
+        store = None
+        if (
+            not force_download
+            and dim == "time"
+            and not any(kwargs.values())
+            and parser.avoid_update
+            and not parser.custom_freshness
+        ):
+            store = self.get_cube_store(datatype)
+
+        if store is not None:
+            cube = store.read(dates, lazy=lazy, subset=subset)
+            if cube is not None:
+                self.logger.debug("Cube of %s read from %s", datatype, store.path)
+                return cube
+
+            store_dates, dates = dates, store.missing(dates)
+
+        # files that go to the store are kept whole
+        arrays = self._open_files(
+            dates,
+            datatype,
+            force_download,
+            chunks=chunks,
+            **kwargs,
+            **({} if store is not None else region),
+        )
 
-        cube = xr.concat(data_arrays, dim=dim)  # type: ignore
+        # create a cube with the files. Eager cubes are preallocated and filled file by file
+        if lazy:
+            data_arrays = [array.astype("float32") for array in arrays]
+            cube = xr.concat(data_arrays, dim=dim)  # type: ignore
+        else:
+            cube = GISUtil.stack_arrays(arrays, size=len(dates), dim=dim)
+
+        if store is not None:
+            store.append(cube, dates)
+            return store.read(store_dates, lazy=lazy, subset=subset)  # type: ignore
 
         return cube
 
@@ -378,17 +745,31 @@ class Downloader:
         datatype: Union[Enum, str],
         dim_key: Optional[str] = "time",
         force_download: bool = False,
+        lazy: bool = False,
+        chunks: Optional[dict] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        geometry: Optional[Union[gpd.GeoSeries, gpd.GeoDataFrame]] = None,
         **kwargs,
     ) -> xr.DataArray:
-        """Create a cube from the range and apply the post_processor of the downloader"""
+        """
+        Create a cube from the range and apply the post_processor of the downloader.
+        If lazy is True, the cube is backed by dask arrays, so reductions over long periods
+        are computed chunk by chunk instead of loading the whole cube (requires dask).
+        `chunks` sets the chunks of each file (e.g., {"latitude": 500, "longitude": 500}).
+        `bbox` (minx, miny, maxx, maxy) or `geometry` restrict the cube to a region, that is
+        cut from each file before stacking, so only the region is kept in memory.
+        """
 
         self.logger.info(
             "Creating cube from %s to %s (%s)", start_date, end_date, datatype
         )
 
-        # first, let's grab the desired dates
-        dates = self.get_parser(datatype).dates_range(
-            start_date=start_date, end_date=end_date
+        # first, let's grab the desired dates (as datetimes, to avoid parsing them again)
+        dates = (
+            self.get_parser(datatype)
+            .date_index(start_date=start_date, end_date=end_date)
+            .to_pydatetime()
+            .tolist()
         )
 
         # then, create the cube
@@ -397,6 +778,10 @@ class Downloader:
             datatype=datatype,
             dim_key=dim_key,
             force_download=force_download,
+            lazy=lazy,
+            chunks=chunks,
+            bbox=bbox,
+            geometry=geometry,
             **kwargs,
         )
 
@@ -431,44 +816,220 @@ class Downloader:
         # set the stacked dimension name
         dim = "time" if dim_key is None else dim_key
 
-        # create a cube with the files
-        data_arrays = [
-            self.open_file(
-                date, INPETypes.DAILY_WRF, False, ref_date=lagged_date
-            ).astype("float32")
+        # create a cube with the files, decoding each one straight into the cube
+        data_arrays = (
+            self.open_file(date, INPETypes.DAILY_WRF, False, ref_date=lagged_date)
             for date, lagged_date in zip(dates, lagged_dates)
-        ]
+        )
 
-        cube = xr.concat(data_arrays, dim=dim)  # type: ignore
+        cube = GISUtil.stack_arrays(data_arrays, size=len(dates), dim=dim)
 
         return cube
 
+    def reduce_range(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+        datatype: Union[Enum, str],
+        reducer: Union[str, Reducer] = "sum",
+        force_download: bool = False,
+        **kwargs,
+    ) -> xr.DataArray:
+        """
+        Reduce the files of the range into a single grid, without creating the cube.
+        Each file is added to the accumulator as soon as it is opened, so the memory stays
+        at one grid regardless of the length of the period.
+        :param reducer: "sum", "max", "min", "rainy_days" or a `Reducer` (see utils.Reducer)
+        The other kwargs are passed to `open_file` (e.g., in_memory, bbox, geometry).
+        """
+        self.logger.info(
+            "Reducing (%s) from %s to %s (%s)", reducer, start_date, end_date, datatype
+        )
+
+        dates = (
+            self.get_parser(datatype)
+            .date_index(start_date=start_date, end_date=end_date)
+            .to_pydatetime()
+            .tolist()
+        )
+
+        arrays = self._open_files(dates, datatype, force_download, **kwargs)
+        return Reducer.get(reducer).reduce(arrays)
+
+    def create_lead_cube(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+        leads: Iterable[int] = range(1, 8),
+        force_download: bool = False,
+    ) -> xr.DataArray:
+        """
+        Create a cube of the daily WRF forecasts with dims (run_date, lead, latitude, longitude),
+        for the runs from start_date to end_date and the given leads (in days), so the
+        forecasts of several lags are compared in a single pass. The `valid_date` coordinate
+        has the date each forecast refers to (run_date + lead, at 12h, as the daily files).
+        The cumulative hours needed by all the runs and leads are planned up front, downloaded
+        once (in parallel, with max_workers) and each one is decoded once per run.
+        """
+        parser = self.get_parser(INPETypes.DAILY_WRF)
+        hourly = parser.hourly_parser  # type: ignore
+        leads = sorted(set(leads))
+        if not leads:
+            raise ValueError("At least one lead must be given")
+
+        run_dates = (
+            parser.date_index(start_date=start_date, end_date=end_date)
+            .to_pydatetime()
+            .tolist()
+        )
+        if not run_dates:
+            raise ValueError(f"No WRF runs between {start_date} and {end_date}")
+
+        self.logger.info(
+            "Creating lead cube from %s to %s (leads=%s)", start_date, end_date, leads
+        )
+
+        # the daily rain of a lead is cum(valid 12h) - cum(valid 12h - 24h), clamped to the run
+        def hours(run: datetime, lead: int) -> Tuple[datetime, datetime]:
+            end = run + timedelta(days=lead, hours=12)
+            return max(end - timedelta(hours=24), run), end
+
+        # cumulative hours of each run (consecutive leads share one hour)
+        plan = {
+            run: sorted({hour for lead in leads for hour in hours(run, lead)})
+            for run in run_dates
+        }
+        tasks = [(run, hour) for run, run_hours in plan.items() for hour in run_hours]
+
+        def download(task: Tuple[datetime, datetime]) -> Path:
+            run, hour = task
+            with self.ftp.session():
+                return hourly.get_cumulative(
+                    hour, self.local_folder, ref_date=run, force_download=force_download
+                )
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            files = dict(zip(tasks, executor.map(download, tasks)))
+
+        data = None
+        for i, run in enumerate(run_dates):
+            # decode each cumulative hour of the run just once
+            grids = {
+                hour: hourly.open_cumulative(files[run, hour]) for hour in plan[run]
+            }
+
+            for j, lead in enumerate(leads):
+                start, end = hours(run, lead)
+                if data is None:
+                    template = grids[end]
+                    data = np.empty(
+                        (len(run_dates), len(leads), *template.shape), dtype="float32"
+                    )
+
+                data[i, j] = grids[end].values - grids[start].values
+
+        grid = template.drop_vars(
+            [
+                name
+                for name, coord in template.coords.items()
+                if coord.ndim == 0 and name != "spatial_ref"
+            ]
+        )
+
+        return xr.DataArray(
+            data,
+            dims=("run_date", "lead", *grid.dims),
+            coords={
+                **grid.coords,
+                "run_date": run_dates,
+                "lead": leads,
+                "valid_date": (
+                    ("run_date", "lead"),
+                    [[hours(run, lead)[1] for lead in leads] for run in run_dates],
+                ),
+            },
+            name=parser.varname,
+        )
+
     def accum_rain(
         self,
         start_date: str,
         end_date: str,
         datatype: INPETypes,
         force_download: bool = False,
+        in_memory: bool = False,
+        lazy: bool = False,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        geometry: Optional[Union[gpd.GeoSeries, gpd.GeoDataFrame]] = None,
     ) -> xr.DataArray:
-        """Accumulate the rain in the given period"""
+        """
+        Accumulate the rain in the given period.
+        If in_memory is True, the files are streamed from the FTP, without using the local folder.
+        If lazy is True, the sum is computed chunk by chunk from a dask cube (see `create_cube`),
+        otherwise the files are summed one at a time (see `reduce_range`).
+        If bbox or geometry are given, the rain is accumulated just in the region.
+        With the cumulative store (and none of the above), the accumulation is read from the
+        running totals of the datatype.
+        """
+
+        # the accumulation is the difference of two slices of the running totals
+        store = None
+        if (
+            not (force_download or in_memory or lazy)
+            and bbox is None
+            and geometry is None
+        ):
+            store = self.get_cumulative_store(datatype)
+
+        if store is not None:
+            self.update_cumulative_store(start_date, end_date, datatype)
+            return store.accum(
+                DateProcessor.parse_date(start_date), DateProcessor.parse_date(end_date)
+            )
+
+        if not lazy:
+            return self.reduce_range(
+                start_date=start_date,
+                end_date=end_date,
+                datatype=datatype,
+                reducer="sum",
+                force_download=force_download,
+                in_memory=in_memory,
+                bbox=bbox,
+                geometry=geometry,
+            )
 
-        # first, get the cube
         cube = self.create_cube(
             start_date=start_date,
             end_date=end_date,
             datatype=datatype,
             force_download=force_download,
+            in_memory=in_memory,
+            lazy=lazy,
+            bbox=bbox,
+            geometry=geometry,
         )
 
         dset = cube.sum(dim="time")
         dset = dset.assign_coords({"time": cube.time[0].values})
 
-        return dset
+        return dset.compute()
 
     def accum_periodically_rain(
         self, periods: List, data_type: INPETypes, force_download: bool = False
     ) -> xr.DataArray:
-        """Accumulate the rain in given periods."""
+        """
+        Accumulate the rain in given periods.
+        With the cumulative store, it is extended once to cover all the periods and
+        each period costs two reads.
+        """
+
+        if not force_download and self.get_cumulative_store(data_type) is not None:
+            self.update_cumulative_store(
+                start_date=min(DateProcessor.parse_date(start) for start, _ in periods),
+                end_date=max(DateProcessor.parse_date(end) for _, end in periods),
+                datatype=data_type,
+            )
 
         # get the arrays with the accumulated rain in each period
         rains = [
@@ -3,21 +3,22 @@ Module with specialized classes to understand the INPE FTP Structure
 The idea is to have several classes that implement the following interface:
 remote_file_path(date: str)
 """
+from __future__ import annotations
+
 import os
+import shutil
+import threading
 
 # from abc import ABC, abstractmethod
 from enum import Enum, auto
 from pathlib import Path
-from typing import Callable, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import calendar
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
-import matplotlib.colors as colors
-
-import xarray as xr
-
+from .lazy import colors, xr
 from .parser import BaseParser
 from .utils import DateProcessor, DateFrequency, FTPUtil, GISUtil, OSUtil
 
@@ -35,6 +36,26 @@ class INPETypes(Enum):
     DAILY_WRF = {"id": auto(), "var": "forecast"}
 
 
+class LazyColormap:
+    """
+    Descriptor that creates a LinearSegmentedColormap on first access, so matplotlib
+    is only imported when the colormap is actually used
+    """
+
+    def __init__(self, name: str, positions: list, cmap_colors: list):
+        self.name = name
+        self.positions = positions
+        self.cmap_colors = cmap_colors
+        self.cmap = None
+
+    def __get__(self, obj, owner=None):
+        if self.cmap is None:
+            self.cmap = colors.LinearSegmentedColormap.from_list(
+                self.name, list(zip(self.positions, self.cmap_colors))
+            )
+        return self.cmap
+
+
 class INPE:
     """Create the structure, given a root path (remote or local) and date/time of the file"""
 
@@ -44,10 +65,8 @@ class INPE:
     cmap_colors = [(1.0, 1.0, 1.0), (1, 1, 1.0), (0.5, 0.5, 1.0), (1.0, 0.4, 0.6)]
     positions = [0.0, 0.1, 0.7, 1.0]
 
-    # Create the colormap using LinearSegmentedColormap
-    cmap = colors.LinearSegmentedColormap.from_list(
-        "my_colormap", list(zip(positions, cmap_colors))
-    )
+    # Create the colormap using LinearSegmentedColormap (on first access)
+    cmap = LazyColormap("my_colormap", positions, cmap_colors)
 
     def __init__(self, root_path: str) -> None:
         self.root = os.path.normpath(root_path)
@@ -197,8 +216,13 @@ class MonthAccumParser(BaseParser):
         date: Union[str, datetime],
         local_folder: Union[str, Path],
         force_download: bool,
+        incremental: bool = False,
     ) -> Path:
-        """Docstring"""
+        """
+        Accumulate the daily rain of the month into the local monthly file.
+        If incremental is True and the file exists, just the days after its `last_day`
+        are added to the accumulation in the file.
+        """
 
         # create a cube with the daily rain in the given month
         start_date, end_date = DateProcessor.start_end_dates(date=date)
@@ -208,76 +232,113 @@ class MonthAccumParser(BaseParser):
         today = datetime(now.year, now.month, now.day)
 
         if DateProcessor.parse_date(end_date) >= today:
-            # if the end date is future, it meansn we are trying to get the current month
-            # in this case, let's start going backwards to see the last available file in the FTP
-            for day in range(today.day, 0, -1):
-                end_date = today + relativedelta(day=day)
-                remote_file = self.daily_parser.remote_target(
-                    DateProcessor.normalize_date(end_date)
-                )
-
-                # if the file exists, then we have our end date
-                if self.ftp.file_exists(remote_file):
-                    break
+            # if the end date is future, it means we are trying to get the current month
+            # in this case, the last available file comes from the listing of the FTP folder
+            latest = self.daily_parser.latest_available(today)
+            if latest is None or latest < DateProcessor.parse_date(start_date):
+                raise Exception(f"No avilable file to calculate month {date}")
 
-                # otherwise, raise exception if we reached the first day
-                if day == 1:
-                    raise Exception(f"No avilable file to calculate month {date}")
+            end_date = latest
 
         end_date = DateProcessor.normalize_date(end_date)
+        target_file = self.local_target(date=date, local_folder=local_folder)
+        var = INPETypes.MONTHLY_ACCUM_MANUAL.value["var"]
+
+        # in the incremental update, start from the accumulation already in the file
+        previous = None
+        if incremental and target_file.exists():
+            with xr.open_dataset(target_file) as dset:
+                if "last_day" in dset.attrs and "days" in dset.attrs:
+                    previous = dset.load()
+
+        if previous is not None:
+            last_day = DateProcessor.parse_date(previous.attrs["last_day"])
+            start_date = DateProcessor.normalize_date(last_day + timedelta(days=1))
+
+        if DateProcessor.parse_date(start_date) <= DateProcessor.parse_date(end_date):
+            dates = self.daily_parser.date_index(start_date, end_date).to_pydatetime()
+            daily_files = self.daily_parser.get_files(
+                dates=dates.tolist(),
+                local_folder=local_folder,
+                force_download=force_download,
+            )
 
-        daily_files = self.daily_parser.get_range(
-            start_date=start_date,
-            end_date=end_date,
-            local_folder=local_folder,
-            force_download=force_download,
+            # files deleted by hand may still be in the catalog (get_file drops their entries)
+            daily_files = [
+                (
+                    file
+                    if Path(file).exists()
+                    else self.daily_parser.get_file(date, local_folder)
+                )
+                for date, file in zip(dates, daily_files)
+            ]
+        else:
+            daily_files = []
+
+        self.logger.debug(
+            "Accumulating %s days into %s", len(daily_files), target_file.name
         )
 
-        dset = GISUtil.create_cube(files=daily_files, dim_key="time")
-        cube = INPE.grib2_post_proc(dset)
+        if previous is not None:
+            accum = previous[var]
+            days = int(previous.attrs["days"]) + len(daily_files)
+
+            if daily_files:
+                # the new days have the same grid of the file (after the post processing)
+                new_days = GISUtil.reduce_files(
+                    files=daily_files,
+                    var=INPETypes.DAILY_RAIN.value["var"],
+                    reducer="sum",
+                    index_folder=self.daily_parser.index_folder,
+                    post_proc=INPE.grib2_post_proc,
+                )
+                accum = accum.copy(data=accum.values + new_days.values)
 
-        # get the reference datetime
-        ref_time = cube.time[0].values
+        else:
+            # sum the daily files one at a time, without creating the cube
+            accum = GISUtil.reduce_files(
+                files=daily_files,
+                var=INPETypes.DAILY_RAIN.value["var"],
+                reducer="sum",
+                index_folder=self.daily_parser.index_folder,
+                post_proc=INPE.grib2_post_proc,
+            )
+            days = len(daily_files)
 
-        accum = cube[INPETypes.DAILY_RAIN.value["var"]].sum(dim="time")
-        accum = accum.rename(INPETypes.MONTHLY_ACCUM_MANUAL.value["var"])
+            # get the reference datetime (from the first day)
+            ref_time = accum.time.values
 
-        # once the reduction is being done in the time dimension, create a new dimension for time
-        accum = accum.assign_coords({"time": ref_time}).expand_dims(dim="time")
+            accum = accum.rename(var)
+
+            # once the reduction is being done in the time dimension, create a new dimension
+            accum = accum.assign_coords({"time": ref_time}).expand_dims(dim="time")
 
         # save the file to disk
-        target_file = self.local_target(date=date, local_folder=local_folder)
         dset = accum.to_dataset()
 
         # update the creation date for this file
         dset.attrs["updated"] = str(now)
         dset.attrs["last_day"] = end_date
-        dset.attrs["days"] = len(daily_files)
+        dset.attrs["days"] = days
 
         dset.to_netcdf(target_file)
 
         return target_file
 
-    def get_file(
-        self,
-        date: Union[str, datetime],
-        local_folder: Union[str, Path],
-        force_download: bool = False,
-    ) -> Path:
+    def update_status(
+        self, date: Union[str, datetime], local_folder: Union[str, Path]
+    ) -> Tuple[bool, bool]:
         """
-        Get a specific file. If it is not available locally, download it just in time.
-        If it is available locally and avoid_update is not True, check if the file has
-        changed in the server
+        Check the local monthly file and return if it must be updated and if the update
+        can be incremental (a complete file that is just outdated).
         """
 
         must_update = False
         dset = None
         local_target = self.local_target(date=date, local_folder=local_folder)
 
-        self.logger.debug("Getting file %s", local_target.name)
-
         # first check verifies if the file exists and has the new attributes
-        if not local_target.exists() or force_download:
+        if not local_target.exists():
             must_update = True
 
         else:
@@ -300,7 +361,11 @@ class MonthAccumParser(BaseParser):
                 must_update = True
 
         # now, we have to decide if the file must be updated
+        # (a complete file that is just outdated is updated incrementally)
+        incremental = False
         if dset is not None and not must_update:
+            incremental = True
+
             # first, let's get the dates from the file
             date = DateProcessor.parse_date(date)
             now = datetime.now()
@@ -310,7 +375,8 @@ class MonthAccumParser(BaseParser):
             # if file was updated in the last 30 min, return it regardless anything.
             update_delta = now - updated
             if update_delta.seconds < (30 * 60):
-                return local_target
+                dset.close()
+                return False, incremental
 
             # check if it is complete (has all the necessary days)
             if (date.year == now.year) and (date.month == now.month):
@@ -351,6 +417,38 @@ class MonthAccumParser(BaseParser):
         if dset is not None:
             dset.close()
 
+        return must_update, incremental
+
+    def is_downloaded(
+        self, date: Union[str, datetime], local_folder: Union[str, Path], **kwargs
+    ) -> bool:
+        """Return if the local monthly file exists and doesn't need to be updated"""
+        must_update, _ = self.update_status(date=date, local_folder=local_folder)
+        return not must_update
+
+    def get_file(
+        self,
+        date: Union[str, datetime],
+        local_folder: Union[str, Path],
+        force_download: bool = False,
+    ) -> Path:
+        """
+        Get a specific file. If it is not available locally, download it just in time.
+        If it is available locally and avoid_update is not True, check if the file has
+        changed in the server
+        """
+
+        local_target = self.local_target(date=date, local_folder=local_folder)
+
+        self.logger.debug("Getting file %s", local_target.name)
+
+        if force_download:
+            must_update, incremental = True, False
+        else:
+            must_update, incremental = self.update_status(
+                date=date, local_folder=local_folder
+            )
+
         if must_update:
             # store the old avoid update status
             avoid_update = self.daily_parser.avoid_update
@@ -360,6 +458,7 @@ class MonthAccumParser(BaseParser):
                 date=date,
                 local_folder=local_folder,
                 force_download=force_download,
+                incremental=incremental,
             )
 
             # retrieve the avoid_update status
@@ -475,7 +574,135 @@ class MonthAccumParser(BaseParser):
 
 
 class HourlyWRFParser(BaseParser):
-    """Docstring"""
+    """
+    Parser of the hourly WRF forecast. The WRF files have the rain accumulated since the
+    beginning of the run, so the rain of one hour is the difference of two cumulative files.
+    The cumulative files are kept in local_folder/cache/wrf_cumulative and each one is
+    downloaded only once, as hour H is also the previous hour of H+1. Only the folders of
+    the newest `keep_runs` runs are kept in the cache (see `prune_cumulative`).
+    """
+
+    # number of locks shared by the cumulative files (lock striping), see `get_cumulative`
+    n_locks = 64
+
+    def __init__(self, *args, keep_runs: int = 4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keep_runs = keep_runs
+
+        # workers of `get_files` may need the same cumulative hour at the same time
+        self._locks = [threading.Lock() for _ in range(HourlyWRFParser.n_locks)]
+        self._prune_lock = threading.Lock()
+
+    @staticmethod
+    def cumulative_folder(local_folder: Union[str, Path]) -> Path:
+        """Return the folder of the cumulative (raw) WRF files"""
+        return Path(local_folder) / "cache" / "wrf_cumulative"
+
+    def get_cumulative(
+        self,
+        date: Union[str, datetime],
+        local_folder: Union[str, Path],
+        ref_date: Union[str, datetime],
+        force_download: bool = False,
+    ) -> Path:
+        """
+        Get the cumulative file of a forecast hour, downloading it if it is not in the cache
+        or if it has changed in the server (checked against the cached folder listing).
+        Hours before the beginning of the run are replaced by the first hour (no rain).
+        """
+        date = max(DateProcessor.parse_date(date), DateProcessor.parse_date(ref_date))
+        folder = HourlyWRFParser.cumulative_folder(local_folder)
+        local_target = self.local_target(date, folder, ref_date=ref_date)
+
+        with self._locks[hash(local_target) % len(self._locks)]:
+            if local_target.exists() and not force_download:
+                remote_target = self.remote_target(date, ref_date=ref_date)
+                local_info = OSUtil.get_local_file_info(local_target)
+                if not self.ftp.file_changed(remote_target, local_info):
+                    return local_target
+
+            # the first file of a run (empty folder) triggers the cleanup of the older runs
+            new_run = not any(local_target.parent.iterdir())
+            file = super().download_file(date, local_folder=folder, ref_date=ref_date)
+
+        if new_run:
+            self.prune_cumulative(local_folder, current=local_target.parent)
+
+        return file
+
+    def prune_cumulative(
+        self, local_folder: Union[str, Path], current: Optional[Path] = None
+    ) -> List[Path]:
+        """
+        Delete the cached cumulative files of the runs older than the newest `keep_runs`.
+        Each run has its own folder (mirror_folder) and the runs are sorted by the
+        modification time of their files (stamped with the remote time).
+        :param current: Folder of the run in use, that is never deleted (even if it is old)
+        :return: the deleted run folders
+        """
+        root = HourlyWRFParser.cumulative_folder(local_folder) / self.subfolder
+
+        with self._prune_lock:
+            runs: Dict[Path, float] = {}
+            for file in root.rglob("*"):
+                try:
+                    if file.is_file():
+                        mtime = file.stat().st_mtime
+                        runs[file.parent] = max(runs.get(file.parent, mtime), mtime)
+
+                # temporary files of the downloads in progress
+                except FileNotFoundError:
+                    continue
+
+            # the run in use counts as the newest one
+            ordered = sorted(
+                runs, key=lambda run: (run == current, runs[run]), reverse=True
+            )
+            old_runs = ordered[self.keep_runs :]
+            for run in old_runs:
+                shutil.rmtree(run, ignore_errors=True)
+                self._created_folders.discard(run)
+
+                # remove the empty parents (e.g., the month of the run)
+                for parent in run.parents:
+                    if parent == root or any(parent.iterdir()):
+                        break
+                    parent.rmdir()
+                    self._created_folders.discard(parent)
+
+        return old_runs
+
+    def open_cumulative(self, file: Union[str, Path]) -> xr.DataArray:
+        """
+        Open a cumulative file as a loaded array named `varname` (the file has just the rain
+        variable, `unknown` in the INPE files), with the longitude adjusted and the CRS set
+        """
+        with GISUtil.open_dataset(file, self.index_folder) as dset:
+            array = next(iter(dset.data_vars.values())).load()
+
+        array = array.rename(self.varname)
+        array = array.assign_coords({"longitude": array.longitude - 360})
+        return array.rio.write_crs("epsg:4326")
+
+    def rain_between(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+        local_folder: Union[str, Path],
+        ref_date: Union[str, datetime],
+        force_download: bool = False,
+    ) -> xr.Dataset:
+        """
+        Return the rain between two forecast hours, as the difference of their cumulative
+        files (see `open_cumulative`)
+        """
+        end_file = self.get_cumulative(end_date, local_folder, ref_date, force_download)
+        start_file = self.get_cumulative(
+            start_date, local_folder, ref_date, force_download
+        )
+
+        rain = self.open_cumulative(end_file) - self.open_cumulative(start_file)
+        return rain.rio.write_crs("epsg:4326").to_dataset()
 
     def download_file(
         self,
@@ -487,42 +714,19 @@ class HourlyWRFParser(BaseParser):
         # convert the date to datetime
         date = DateProcessor.parse_date(date)
 
-        # download this specific date/hour
-        file1 = super().download_file(
-            date, local_folder=local_folder, ref_date=ref_date
-        )
-
-        # download the previous hour
-        prev_date = date - timedelta(hours=1)
-        tmp_folder = Path(local_folder) / "tmp"
-        if not tmp_folder.exists():
-            tmp_folder.mkdir(parents=True, exist_ok=True)
-        file2 = super().download_file(
-            prev_date, local_folder=tmp_folder, ref_date=ref_date
+        # the rain of the hour is the difference between the cumulative H and H-1
+        # (the cumulative H-1 is usually in the cache, from the previous hour)
+        dset = self.rain_between(
+            date - timedelta(hours=1), date, local_folder, ref_date=ref_date
         )
 
-        # open both files and subtract file1 - file2
-        dset1 = xr.open_dataset(file1)
-        dset2 = xr.open_dataset(file2)
-        dset = dset1 - dset2
-
-        # save the hourly rain to disk and delete the temporary
+        # save the hourly rain to disk
         dset.attrs["updated"] = str(datetime.now())
 
-        dset = dset.rename_vars({"unknown": "hour_wrf"})
-        dset = dset.assign_coords({"longitude": dset.longitude - 360})
-        dset = dset.rio.write_crs("epsg:4326")
+        local_target = self.local_target(date, local_folder, ref_date=ref_date)
+        dset.to_netcdf(local_target)
 
-        # close the datasets and clear the temp folder
-        dset.to_netcdf(file1)
-        # file1 = file1.with_suffix(".tif")
-        # dset.to_array().squeeze().rio.to_raster(file1)
-
-        dset1.close()
-        dset2.close()
-        OSUtil.clear_folder(tmp_folder)
-
-        return file1
+        return local_target
 
 
 class DailyWRFParser(BaseParser):
@@ -544,7 +748,7 @@ class DailyWRFParser(BaseParser):
         self,
         datatype: Union[Enum, str],
         root: str,
-        hourly_parser: BaseParser,
+        hourly_parser: HourlyWRFParser,
         ftp: Optional[FTPUtil] = None,
         avoid_update: bool = True,
         post_proc: Optional[Callable] = None,
@@ -573,9 +777,10 @@ class DailyWRFParser(BaseParser):
         ref_date: Union[str, datetime],
     ):
         """Actually this function performs as accum_monthly_rain"""
-        # accumulate the daily forecast
+        # accumulate the daily forecast (the cumulative files in the cache are checked
+        # against the server, so just the ones that changed are downloaded again)
         return self.accum_daily_forecast(
-            date=date, local_folder=local_folder, force_download=True, ref_date=ref_date
+            date=date, local_folder=local_folder, ref_date=ref_date
         )
 
     def accum_daily_forecast(
@@ -585,27 +790,25 @@ class DailyWRFParser(BaseParser):
         local_folder: Union[str, Path],
         force_download: bool = False,
     ):
-        """Docstring"""
+        """Accumulate the forecast rain of a date (from 12h of the previous day)"""
 
-        ### create a CUBE with the hourly forecast in the given date
-        # get the hourly dates to process
+        # the daily rain (from 12h of the previous day to 12h of the day) is just the
+        # difference of the two cumulative files, so only two hours are downloaded
         date = DateProcessor.parse_date(date).replace(hour=12, minute=0, second=0)
 
-        files = self.hourly_parser.get_range(
-            start_date=date - timedelta(hours=23),
+        dset = self.hourly_parser.rain_between(
+            start_date=date - timedelta(hours=24),
             end_date=date,
             local_folder=local_folder,
-            force_download=force_download,
             ref_date=ref_date,
+            force_download=force_download,
         )
 
-        # create the cube and get the correct variable
-        cube = GISUtil.create_cube(files=files, dim_key="time")
+        accum = dset[self.hourly_parser.varname]
         if self.hourly_parser.post_proc:
-            cube = self.hourly_parser.post_proc(cube)
+            accum = self.hourly_parser.post_proc(accum)
 
-        accum = cube[self.hourly_parser.varname].sum(dim="time")
-        accum = accum.rename(self.datatype.value["var"])  # type: ignore
+        accum = accum.rename(self.varname)
 
         # once the reduction is being done in the time dimension, create a new dimension for time
         accum = accum.assign_coords({"time": date}).expand_dims(dim="time")
@@ -0,0 +1,53 @@
+"""
+Lazy imports for the heavy dependencies (xarray, rasterio, geopandas, matplotlib, etc.).
+The modules are only imported on first attribute access, so `import raindownloader` and
+the command line (that just checks and downloads files) start fast.
+"""
+import importlib
+import types
+from typing import Optional
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module that is imported on first attribute access.
+    :param name: Name of the module (e.g., "xarray")
+    :param requires: Other modules to be imported along with it, e.g. "rioxarray",
+    that registers the `.rio` accessor in the xarray objects
+    """
+
+    def __init__(self, name: str, *requires: str):
+        super().__init__(name)
+        self._requires = requires
+        self._module: Optional[types.ModuleType] = None
+
+    def _load(self) -> types.ModuleType:
+        """Import the module (and the required ones) and return it"""
+        if self._module is None:
+            module = importlib.import_module(self.__name__)
+            for required in self._requires:
+                importlib.import_module(required)
+
+            self._module = module
+
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+xr = LazyModule("xarray", "rioxarray")
+xrio = LazyModule("rioxarray")
+rio = LazyModule("rasterio")
+features = LazyModule("rasterio.features")
+gpd = LazyModule("geopandas")
+colors = LazyModule("matplotlib.colors")
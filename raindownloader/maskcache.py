@@ -0,0 +1,107 @@
+"""
+The maskcache module keeps the rasterized masks of the geometries (e.g., basins) used to
+clip the cubes, so a geometry is rasterized just once for a given grid. The masks are kept
+in memory and persisted in the local folder (local_folder/cache/masks).
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Union
+
+from .lazy import features, gpd, np, xr
+
+
+class MaskCache:
+    """
+    Cache of boolean masks (True inside the geometries), keyed by the hash of the geometries
+    and by the transform, shape and CRS of the grid. The masks follow `rio.clip` defaults,
+    i.e., a pixel is inside if its center is within the geometries.
+    :param folder: Folder to persist the masks (one compressed .npz per mask)
+    """
+
+    def __init__(self, folder: Union[str, Path]):
+        self.folder = Path(folder)
+        self._masks: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(geometries: gpd.GeoSeries, cube: xr.DataArray) -> str:
+        """Return the key of the mask of the geometries (already in the CRS of the cube)"""
+        digest = hashlib.sha1()
+        for geometry in geometries:
+            digest.update(geometry.wkb)
+
+        digest.update(repr(tuple(cube.rio.transform())[:6]).encode())
+        digest.update(repr((cube.rio.height, cube.rio.width)).encode())
+        digest.update(cube.rio.crs.to_wkt().encode())
+
+        return digest.hexdigest()
+
+    def mask(self, cube: xr.DataArray, geometries: gpd.GeoSeries) -> np.ndarray:
+        """
+        Return the mask (height, width) of the geometries in the grid of the cube,
+        rasterizing it only if it is not in the cache
+        """
+        if geometries.crs is not None:
+            geometries = geometries.to_crs(cube.rio.crs)
+
+        key = MaskCache.key(geometries, cube)
+        path = self.folder / f"{key}.npz"
+
+        with self._lock:
+            if key in self._masks:
+                return self._masks[key]
+
+        if path.exists():
+            with np.load(path) as stored:
+                mask = stored["mask"]
+
+        else:
+            mask = features.geometry_mask(
+                geometries,
+                out_shape=(cube.rio.height, cube.rio.width),
+                transform=cube.rio.transform(),
+                invert=True,
+            )
+
+            # write to a temporary file first, as other processes may be reading the folder
+            self.folder.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.npz")
+            np.savez_compressed(tmp_path, mask=mask)
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self._masks[key] = mask
+
+        return mask
+
+    def clip(self, cube: xr.DataArray, geometries: gpd.GeoSeries) -> xr.DataArray:
+        """
+        Clip the cube to the geometries with the cached mask, as `rio.clip`: pixels outside
+        the geometries are NaN and the cube is cropped to the pixels inside them
+        """
+        mask = self.mask(cube, geometries)
+        if not mask.any():
+            raise ValueError("The geometries do not overlap the cube")
+
+        y_dim, x_dim = cube.rio.y_dim, cube.rio.x_dim
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        window = {
+            y_dim: slice(rows[0], rows[-1] + 1),
+            x_dim: slice(cols[0], cols[-1] + 1),
+        }
+
+        mask_array = xr.DataArray(
+            mask[window[y_dim], window[x_dim]], dims=(y_dim, x_dim)
+        )
+        return cube.isel(window).where(mask_array)
+
+    def clear(self):
+        """Remove the masks from memory and from disk"""
+        with self._lock:
+            self._masks.clear()
+            for path in self.folder.glob("*.npz"):
+                path.unlink()
@@ -1,19 +1,22 @@
 """
 The parser module defines the template of a Parser Class.
 """
+from __future__ import annotations
 
 # from abc import ABC, abstractmethod
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from enum import Enum
 from typing import Callable, Optional, Union, List
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
+import posixpath
 
-import xarray as xr
-
-from .utils import DateProcessor, DateFrequency, FTPUtil, OSUtil
+from .lazy import pd, xr
+from .utils import DateProcessor, DateFrequency, FTPUtil, GISUtil, OSUtil
+from .catalog import LocalCatalog
 
 
 class BaseParser:
@@ -30,6 +33,12 @@ class BaseParser:
                 '/DAILY/2001/02/' in the case of Daily rain
     date_freq: The frequency of the file. DateFrequency.[DAILY, MONTHLY, YEARLY]
     mirror_folder: If True, reproduces the same folder structure locally
+    max_workers: Number of threads used to get files in parallel in `get_files`/`get_range`.
+                 Each worker checks out its own session from the FTPUtil pool.
+    catalog: LocalCatalog with the state of the local folder. If set, it is consulted before
+             the filesystem to know if a file is downloaded (see raindownloader.catalog)
+    index_folder: Folder to keep the cfgrib indexes of the GRIB files. If None, GRIB files
+                  are opened without writing an index
     """
 
     def __init__(
@@ -43,6 +52,9 @@ class BaseParser:
         avoid_update: bool = True,
         post_proc: Optional[Callable] = None,
         mirror_folder: bool = False,
+        max_workers: int = 1,
+        catalog: Optional[LocalCatalog] = None,
+        index_folder: Optional[Path] = None,
     ):
         self.datatype = datatype
         self.root = Path(root).as_posix()
@@ -53,6 +65,10 @@ class BaseParser:
         self.avoid_update = avoid_update
         self.post_proc = post_proc
         self.mirror_folder = mirror_folder
+        self.max_workers = max_workers
+        self.catalog = catalog
+        self.index_folder = index_folder
+        self._created_folders: set = set()
         self.logger = logging.getLogger(str(datatype))
 
     @property
@@ -89,17 +105,40 @@ class BaseParser:
 
         return subfolder
 
-    def clean_local_folder(self, local_folder: Union[str, Path]) -> None:
-        """Clear the .idx files in the local download folder"""
+    def catalog_key(self, date: Union[str, datetime], **kwargs) -> dict:
+        """Return the arguments that identify a file in the catalog"""
+        return {
+            "datatype": self.subfolder.as_posix(),
+            "date": date,
+            "ref_date": kwargs.get("ref_date"),
+        }
 
-        # get the local path
-        local_path = Path(local_folder) / self.subfolder
+    @property
+    def custom_freshness(self) -> bool:
+        """
+        Check if the parser overrides `get_file` with its own freshness logic
+        (e.g., MonthAccumParser), so the local caches (catalog, cube store) can't answer for it
+        """
+        return type(self).get_file is not BaseParser.get_file
 
-        self.logger.debug("Cleaning folder: %s", local_path)
+    def catalog_entry(self, date: Union[str, datetime], **kwargs) -> Optional[dict]:
+        """
+        Return the catalog entry of a file (None if there is no catalog or no entry).
+        An entry whose file is no longer in the local folder (e.g., deleted by hand)
+        is removed from the catalog, so the file is downloaded again.
+        """
+        if self.catalog is None:
+            return None
 
-        # get idx files
-        for file in local_path.rglob("*.idx"):
-            file.unlink()
+        key = self.catalog_key(date, **kwargs)
+        entry = self.catalog.get(**key)
+
+        if entry is not None and not entry["path"].exists():
+            self.logger.debug("Cataloged file %s no longer exists", entry["path"])
+            self.catalog.remove(**key)
+            return None
+
+        return entry
 
     ### File/folder structure functions
     def filename(self, date: Union[str, datetime], **kwargs) -> str:
@@ -127,7 +166,11 @@ class BaseParser:
             )
             local_path /= remote_folder
 
-        local_path.mkdir(parents=True, exist_ok=True)
+        # remember the created folders, to avoid a mkdir syscall for every file
+        if local_path not in self._created_folders:
+            local_path.mkdir(parents=True, exist_ok=True)
+            self._created_folders.add(local_path)
+
         return local_path
 
     def local_target(
@@ -164,35 +207,140 @@ class BaseParser:
             start_date=start_date, end_date=end_date, date_freq=self.date_freq
         )
 
+    def date_index(
+        self, start_date: Union[str, datetime], end_date: Union[str, datetime]
+    ) -> pd.DatetimeIndex:
+        """Return the dates within the specified period as a DatetimeIndex"""
+        return DateProcessor.date_index(
+            start_date=start_date, end_date=end_date, date_freq=self.date_freq
+        )
+
+    def plan(
+        self,
+        dates: Union[pd.DatetimeIndex, List],
+        local_folder: Union[Path, str],
+        **kwargs,
+    ) -> pd.DataFrame:
+        """
+        Return the remote and local targets of all the dates in one pass.
+        The dates are parsed once and each folder is derived (and created) once, instead
+        of parsing the date strings in every filename/remote_path/local_path call.
+        The result is indexed by date with the columns: remote_path, remote_target, local_target
+        """
+        index = pd.DatetimeIndex(
+            [DateProcessor.parse_date(date) for date in dates]
+            if not isinstance(dates, pd.DatetimeIndex)
+            else dates
+        )
+
+        local_folders = {}
+        remote_paths, remote_targets, local_targets = [], [], []
+        for date in index.to_pydatetime():
+            filename = self.filename_fn(date, **kwargs)
+            remote_path = self.remote_path(date, **kwargs)
+
+            if remote_path not in local_folders:
+                local_folders[remote_path] = self.local_path(
+                    local_folder, date if self.mirror_folder else None, **kwargs
+                )
+
+            remote_paths.append(remote_path)
+            remote_targets.append(os.path.join(remote_path, filename))
+            local_targets.append(local_folders[remote_path] / filename)
+
+        return pd.DataFrame(
+            {
+                "remote_path": remote_paths,
+                "remote_target": remote_targets,
+                "local_target": local_targets,
+            },
+            index=index,
+        )
+
+    def plan_range(
+        self,
+        start_date: Union[str, datetime],
+        end_date: Union[str, datetime],
+        local_folder: Union[Path, str],
+        **kwargs,
+    ) -> pd.DataFrame:
+        """Plan the remote and local targets of all the dates in a period (see `plan`)"""
+        return self.plan(self.date_index(start_date, end_date), local_folder, **kwargs)
+
+    def latest_available(
+        self, date: Optional[Union[str, datetime]] = None, **kwargs
+    ) -> Optional[datetime]:
+        """
+        Return the most recent date (up to `date`, defaults to today) with a file in the server,
+        looking in the month of `date` and in the previous one, or None if there is no file.
+        The existence is checked against the folder listings (one per folder, cached by
+        FTPUtil), instead of querying each file.
+        """
+        end = datetime.now() if date is None else DateProcessor.parse_date(date)
+        start = (end.replace(day=1) - timedelta(days=1)).replace(day=1)
+
+        for candidate in reversed(self.date_index(start, end).to_pydatetime()):
+            remote_file = self.remote_target(candidate, **kwargs)
+            listing = self.ftp.folder_listing(posixpath.dirname(remote_file))
+
+            if posixpath.basename(remote_file) in listing:
+                return candidate
+
+        return None
+
     ### Download functions
     def download_file(
-        self, date: Union[str, datetime], local_folder: Union[Path, str], **kwargs
+        self,
+        date: Union[str, datetime],
+        local_folder: Union[Path, str],
+        remote_target: Optional[str] = None,
+        local_target: Optional[Path] = None,
+        **kwargs,
     ) -> Path:
         """
         Download the parsed file to a local subfolder (according to the parser datatype).
+        The targets may be given if they were already planned (see `plan`).
         OBS: Download file always force the download. Otherwise, use the `get_file` function
         """
 
-        remote_target = self.remote_target(date=date, **kwargs)
+        if remote_target is None:
+            remote_target = self.remote_target(date=date, **kwargs)
         self.logger.info("Downloading file %s", remote_target)
 
         # Download the file directly
         downloaded_file = self.ftp.download_ftp_file(
             remote_file=remote_target,
-            local_folder=self.local_path(
-                date=date, local_folder=local_folder, **kwargs
+            local_folder=(
+                self.local_path(date=date, local_folder=local_folder, **kwargs)
+                if local_target is None
+                else local_target.parent
             ),
         )
 
         return downloaded_file
 
     def is_downloaded(
-        self, date: Union[str, datetime], local_folder: Union[str, Path], **kwargs
+        self,
+        date: Union[str, datetime],
+        local_folder: Union[str, Path],
+        remote_target: Optional[str] = None,
+        local_target: Optional[Path] = None,
+        **kwargs,
     ) -> bool:
-        """Compare remote and local files and return if they are equal"""
+        """
+        Compare remote and local files and return if they are equal.
+        If there is a catalog, its entry is used instead of checking the local file.
+        The targets may be given if they were already planned (see `plan`).
+        """
+        entry = self.catalog_entry(date, **kwargs)
+        if entry is not None:
+            return self.is_updated(date, entry, remote_target, **kwargs)
 
         # create target to the local file
-        local_target = self.local_target(date=date, local_folder=local_folder, **kwargs)
+        if local_target is None:
+            local_target = self.local_target(
+                date=date, local_folder=local_folder, **kwargs
+            )
 
         self.logger.debug("Checking if %s exists", local_target)
 
@@ -201,6 +349,29 @@ class BaseParser:
             self.logger.debug("File %s does not exist", local_target)
             return False
 
+        # files downloaded before the catalog existed are added to it
+        if self.catalog is not None:
+            entry = self.catalog.register(
+                path=local_target, **self.catalog_key(date, **kwargs)
+            )
+        else:
+            entry = {"path": local_target, **OSUtil.get_local_file_info(local_target)}
+
+        return self.is_updated(date, entry, remote_target, **kwargs)
+
+    def is_updated(
+        self,
+        date: Union[str, datetime],
+        local_info: dict,
+        remote_target: Optional[str] = None,
+        **kwargs,
+    ) -> bool:
+        """
+        Return if a local file (described by `local_info` with path, size and datetime)
+        is up to date. If avoid_update is True, no check is done in the server.
+        """
+        local_target = local_info["path"]
+
         # if it exists locally and avoid update is True, we can confirm it is already downloaded
         if self.avoid_update:
             self.logger.debug("File %s exists, and avoiding its update", local_target)
@@ -208,17 +379,18 @@ class BaseParser:
 
         ### Check if file has changed in the server
         # create a string pointing to the remote file and get its info
-        remote_file = self.remote_target(date)
+        remote_file = remote_target or self.remote_target(date, **kwargs)
 
         # Now we need to compare the remote and local files
-        local_info = OSUtil.get_local_file_info(local_target)
-
         changed = self.ftp.file_changed(remote_file=remote_file, file_info=local_info)
 
         self.logger.debug(
             "File %s has %s on the server", local_target.name, "" if changed else "NOT"
         )
 
+        if self.catalog is not None and not changed:
+            self.catalog.touch(**self.catalog_key(date, **kwargs))
+
         return False if changed else True
 
     def get_file(
@@ -226,38 +398,84 @@ class BaseParser:
         date: Union[str, datetime],
         local_folder: Union[str, Path],
         force_download: bool = False,
+        remote_target: Optional[str] = None,
+        local_target: Optional[Path] = None,
         **kwargs,
     ) -> Path:
         """
         Get a specific file. If it is not available locally, download it just in time.
         If it is available locally and avoid_update is not True, check if the file has
-        changed in the server
+        changed in the server.
+        The targets may be given if they were already planned (see `plan`). They are only
+        passed on to parsers that keep the base `download_file`.
         """
         self.logger.info(
             "Getting %s/%s", self.datatype, DateProcessor.pretty_date(date)
         )
 
+        targets = {}
+        if remote_target is not None:
+            targets["remote_target"] = remote_target
+        if local_target is not None:
+            targets["local_target"] = local_target
+
         if force_download or not self.is_downloaded(
-            date=date, local_folder=local_folder, **kwargs
+            date=date, local_folder=local_folder, **targets, **kwargs
         ):
-            return self.download_file(date=date, local_folder=local_folder, **kwargs)
+            file = self.download_file(
+                date=date, local_folder=local_folder, **targets, **kwargs
+            )
+
+            if self.catalog is not None:
+                self.catalog.register(path=file, **self.catalog_key(date, **kwargs))
+
+            return file
+
+        elif self.catalog is not None:
+            entry = self.catalog.get(**self.catalog_key(date, **kwargs))
+            return entry["path"]  # type: ignore
+
+        elif local_target is not None:
+            return local_target
 
         else:
             return self.local_target(date=date, local_folder=local_folder, **kwargs)
 
+    def open_remote(self, date: Union[str, datetime], **kwargs) -> xr.Dataset:
+        """
+        Stream the remote file into memory and open it, without touching the local folder.
+        Only available for parsers that download the remote files as they are.
+        """
+        if type(self).download_file is not BaseParser.download_file:
+            raise ValueError(
+                f"Parser {self.datatype} creates its files locally and can't open them from memory"
+            )
+
+        remote_target = self.remote_target(date=date, **kwargs)
+        self.logger.info("Streaming file %s", remote_target)
+
+        data = self.ftp.read_ftp_file(remote_file=remote_target)
+
+        return GISUtil.open_bytes(data, filename=os.path.basename(remote_target))
+
     def open_file(
         self,
         date: Union[str, datetime],
         local_folder: Union[str, Path],
         force_download: bool = False,
+        in_memory: bool = False,
         **kwargs,
     ) -> xr.Dataset:
         """
         Open a file and process it using the processor.
+        If in_memory is True, the file is streamed from the server (see `open_remote`).
         """
 
-        file = self.get_file(date, local_folder, force_download, **kwargs)
-        dset = xr.open_dataset(file)
+        if in_memory:
+            dset = self.open_remote(date, **kwargs)
+        else:
+            file = self.get_file(date, local_folder, force_download, **kwargs)
+            dset = GISUtil.open_dataset(file, self.index_folder)
 
         if self.post_proc:
             return self.post_proc(dset)
@@ -274,18 +492,88 @@ class BaseParser:
         """
         Download files from a list of dates and receives a list pointing to the files.
         If there is a problem during the download of one file, a message error will be in the list.
+        If `max_workers` > 1, the files are retrieved in parallel, each worker using its own
+        FTP session. The returned list is always in the same order as `dates`.
+        Calls made from a thread that already holds a session (e.g., a parser that gets the
+        files of another parser inside its own worker) are serial, as new workers would wait
+        for the sessions held by their parents.
+        The remote and local targets of all the dates are derived in one pass (see `plan`)
+        and passed to each file.
+        If avoid_update is False, the listings of the remote folders are fetched beforehand,
+        so the freshness checks don't need to query each file in the server.
+        If there is a catalog and avoid_update is True, the files already downloaded are
+        found with a single query to the catalog and only the missing ones are processed.
+        The catalog is trusted, without checking each file: files deleted by hand are
+        downloaded again when opened (see `catalog_entry`) or after `catalog.prune()`.
+        Parsers that override `get_file` with their own freshness logic skip the catalog.
         """
-        files = []
-        for date in dates:
-            files.append(
-                self.get_file(
-                    date=date,
-                    local_folder=local_folder,
-                    force_download=force_download,
-                    **kwargs,
-                )
+        cataloged = {}
+        if (
+            self.catalog is not None
+            and self.avoid_update
+            and not force_download
+            and not self.custom_freshness
+        ):
+            cataloged = self.catalog.lookup(
+                self.subfolder.as_posix(), dates, ref_date=kwargs.get("ref_date")
+            )
+
+        if cataloged:
+            missing = [
+                date for date in dates if LocalCatalog.date_key(date) not in cataloged
+            ]
+            self.logger.debug(
+                "%s of %s files found in the catalog", len(cataloged), len(dates)
             )
 
+            missing_files = iter(
+                self.get_files(missing, local_folder, force_download, **kwargs)
+            )
+
+            return [
+                cataloged[key]["path"] if key in cataloged else next(missing_files)
+                for key in map(LocalCatalog.date_key, dates)
+            ]
+
+        # the targets of all the dates are derived in one pass and passed to each file
+        # (parsers with their own download_file derive their targets themselves)
+        use_plan = (
+            type(self).download_file is BaseParser.download_file
+            and not self.custom_freshness
+        )
+        targets: List[dict] = [{} for _ in dates]
+        if use_plan or not self.avoid_update:
+            plan = self.plan(dates, local_folder, **kwargs)
+            if use_plan:
+                targets = plan[["remote_target", "local_target"]].to_dict("records")
+
+            if not self.avoid_update:
+                self.ftp.prefetch_listings(plan["remote_path"].unique().tolist())
+
+        def get_file(date: Union[str, datetime], target: dict) -> Path:
+            return self.get_file(
+                date=date,
+                local_folder=local_folder,
+                force_download=force_download,
+                **target,
+                **kwargs,
+            )
+
+        if self.max_workers <= 1 or len(dates) <= 1 or self.ftp.in_session:
+            return [get_file(date, target) for date, target in zip(dates, targets)]
+
+        def worker(date: Union[str, datetime], target: dict) -> Path:
+            with self.ftp.session():
+                return get_file(date, target)
+
+        self.logger.debug(
+            "Getting %s files with %s workers", len(dates), self.max_workers
+        )
+
+        # executor.map keeps the results in the same order as the dates
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            files = list(executor.map(worker, dates, targets))
+
         return files
 
     def get_range(
@@ -300,7 +588,8 @@ class BaseParser:
         Download a range of files from start to end dates and receives a list pointing to the files.
         If there is a problem during the download of one file, a message error will be in the list.
         """
-        dates = self.dates_range(start_date, end_date)
+        # the dates are passed as datetimes, so they are not parsed again for each file
+        dates = self.date_index(start_date, end_date).to_pydatetime().tolist()
 
         return self.get_files(
             dates=dates,
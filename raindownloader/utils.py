@@ -1,11 +1,28 @@
 """
 Module with several utils used in raindownloader INPEraindownloader package
 """
+from __future__ import annotations
+
+import errno
+import hashlib
+import importlib.util
+import io
 import os
-import subprocess
+import posixpath
+import re
+import socket
+import tempfile
 import ftplib
+import queue
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from itertools import chain
+from functools import lru_cache
+from importlib import metadata
 from pathlib import Path
-from typing import Union, List, Optional, Tuple
+from typing import Union, List, Optional, Tuple, Iterator, Iterable, Dict, Callable
 from enum import Enum
 import logging
 
@@ -16,9 +33,7 @@ import calendar
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 
-import rasterio as rio
-import xarray as xr
-import rioxarray as xrio
+from .lazy import gpd, np, pd, rio, xr, xrio
 
 
 class DateFrequency(Enum):
@@ -33,10 +48,42 @@ class DateFrequency(Enum):
 class DateProcessor:
     """Docstring"""
 
+    # canonical formats emitted by `dates_range`: YYYYMMDD and YYYYMMDDTHHMMSS
+    canonical_date = re.compile(r"(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})(\d{2}))?")
+
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _parse_canonical(date: str) -> Optional[datetime.datetime]:
+        """
+        Parse a date string in a canonical format, or return None for other formats.
+        Results are memoized, as the same dates are parsed several times for each file.
+        """
+        match = DateProcessor.canonical_date.fullmatch(date)
+        if match is None:
+            return None
+
+        return datetime.datetime(*(int(value or 0) for value in match.groups()))
+
+    @staticmethod
+    def parse_date_str(date: str) -> datetime.datetime:
+        """
+        Parse a date string. The canonical formats are parsed directly and any other
+        format falls back to dateutil (not memoized, as partial dates like "2023-3"
+        are completed with the current day).
+        """
+        parsed = DateProcessor._parse_canonical(date)
+        if parsed is None:
+            return parser.parse(date)
+
+        return parsed
+
     @staticmethod
     def parse_date(date: Union[str, datetime.datetime]) -> datetime.datetime:
         """Return a date in datetime format, regardless the input [str | datetime]"""
-        return date if isinstance(date, datetime.datetime) else parser.parse(date)
+        if isinstance(date, datetime.datetime):
+            return date
+
+        return DateProcessor.parse_date_str(date)
 
     @staticmethod
     def normalize_date(date: Union[str, datetime.datetime]) -> str:
@@ -57,6 +104,29 @@ class DateProcessor:
 
         return date.strftime(format_str)
 
+    @staticmethod
+    def date_index(
+        start_date: Union[str, datetime.datetime],
+        end_date: Union[str, datetime.datetime],
+        date_freq: DateFrequency,
+    ) -> pd.DatetimeIndex:
+        """
+        Create the index of dates in the desired range at once.
+        Daily and hourly steps are fixed and vectorized; monthly and yearly steps follow
+        the same calendar rules of relativedelta (e.g., Jan 31 -> Feb 28 -> Mar 28)
+        """
+        step = date_freq.value
+        if "months" in step or "years" in step:
+            freq = pd.DateOffset(**step)
+        else:
+            freq = pd.Timedelta(**step)
+
+        return pd.date_range(
+            DateProcessor.parse_date(start_date),
+            DateProcessor.parse_date(end_date),
+            freq=freq,
+        )
+
     @staticmethod
     def dates_range(
         start_date: Union[str, datetime.datetime],
@@ -65,23 +135,12 @@ class DateProcessor:
     ) -> List[str]:
         """Spawn a dates list in normalized format in the desired range"""
 
-        current_date = DateProcessor.parse_date(start_date)
-        final_date = DateProcessor.parse_date(end_date)
-
-        # create the step to be applied to the current date
-        step = relativedelta(**date_freq.value)
+        index = DateProcessor.date_index(start_date, end_date, date_freq)
 
-        # looop through the dates
-        dates = []
-        while current_date <= final_date:
-            if date_freq == DateFrequency.HOURLY:
-                dates.append(DateProcessor.pretty_date(current_date, "%Y%m%dT%H%M%S"))
-            else:
-                dates.append(DateProcessor.normalize_date(current_date))
-
-            current_date += step
-
-        return dates
+        if date_freq == DateFrequency.HOURLY:
+            return index.strftime("%Y%m%dT%H%M%S").tolist()
+        else:
+            return index.strftime("%Y%m%d").tolist()
 
     @staticmethod
     def month_abrev(date: Union[str, datetime.datetime]) -> str:
@@ -166,77 +225,640 @@ class FileType(Enum):
     NETCDF = ".nc"
 
 
-class FTPUtil:
-    """FTP helper class to download file preserving timestamp and to get file info, among others"""
+class FTPConnection(ftplib.FTP):
+    """An ftplib.FTP that records when the server last answered a command"""
+
+    last_response: float = 0.0
 
-    def __init__(self, server: str) -> None:
+    def getline(self):
+        line = super().getline()
+        self.last_response = time.monotonic()
+        return line
+
+    @property
+    def idle_time(self) -> float:
+        """Seconds since the server last answered"""
+        return time.monotonic() - self.last_response
+
+
+class FTPUtil:
+    """
+    FTP helper class to download file preserving timestamp and to get file info, among others.
+    Besides the main connection (`.ftp`), it manages a pool of up to `pool_size` anonymous
+    sessions that can be checked out by worker threads through the `session` context manager.
+    Remote folder listings are cached for `listing_ttl` seconds, or `closed_listing_ttl` seconds
+    for the folders of past months (e.g. `DAILY/2023/03`), that are not expected to change.
+    Connections are not probed before each operation. Instead, a connection that fails is
+    replaced and the operation is retried once. If `keepalive` is set, a background thread
+    sends NOOP to the connections that have been idle for more than `keepalive` seconds.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        pool_size: int = 1,
+        listing_ttl: float = 10 * 60,
+        closed_listing_ttl: float = 24 * 60 * 60,
+        keepalive: Optional[float] = None,
+    ) -> None:
         self.ftp = FTPUtil.open_connection(server)
+        self.server = server
+
+        # the main connection is locked while in use by FTPUtil, so the keep-alive skips it
+        self._main_lock = threading.RLock()
+
+        # pool of idle sessions and the slots that bound the number of opened sessions
+        self.pool_size = max(pool_size, 1)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._local = threading.local()
+
+        # cache of remote folder listings {folder: (expiration time, listing)}
+        self.listing_ttl = listing_ttl
+        self.closed_listing_ttl = closed_listing_ttl
+        self._listings: Dict[str, Tuple[float, Dict[str, dict]]] = {}
+        self._listings_lock = threading.Lock()
+        self._fetch_locks: Dict[str, threading.Lock] = {}
 
         self.logger = logging.getLogger(self.__class__.__qualname__)
 
+        # background keep-alive (it holds just a weak reference, not to keep FTPUtil alive)
+        self.keepalive = keepalive
+        self._stop_keepalive = threading.Event()
+        if keepalive:
+            threading.Thread(
+                target=FTPUtil._keepalive_loop,
+                args=(weakref.ref(self), keepalive, self._stop_keepalive),
+                name="FTPUtil-keepalive",
+                daemon=True,
+            ).start()
+
     @staticmethod
     def open_connection(server: str) -> ftplib.FTP:
-        """Open an ftp connection and return an FTP instance"""
-        ftp = ftplib.FTP(server)
+        """
+        Open an ftp connection and return an FTP instance.
+        The server may include a port (e.g., `localhost:2121`), otherwise port 21 is used.
+        """
+        host, _, port = server.partition(":")
+        ftp = FTPConnection()
+        ftp.connect(host, int(port) if port else 21)
         ftp.login()
         ftp.sendcmd("TYPE I")
 
         return ftp
 
-    @property
-    def is_connected(self) -> bool:
-        """Check if the connection is open"""
-
+    @staticmethod
+    def check_connection(ftp: ftplib.FTP) -> bool:
+        """Check if the given connection is still responding"""
         try:
-            # test if the ftp is still responding
-            self.ftp.pwd()
+            ftp.voidcmd("NOOP")
             return True
 
         except Exception:  # pylint:disable=broad-except
-            # otherwise, return False
             return False
 
+    # errno of the OSErrors raised by sockets that lost the connection
+    _connection_errnos = frozenset(
+        {
+            errno.ECONNABORTED,
+            errno.ECONNRESET,
+            errno.EHOSTDOWN,
+            errno.EHOSTUNREACH,
+            errno.ENETDOWN,
+            errno.ENETRESET,
+            errno.ENETUNREACH,
+            errno.ENOTCONN,
+            errno.EPIPE,
+            errno.ETIMEDOUT,
+        }
+    )
+
+    @staticmethod
+    def is_connection_error(error: Exception) -> bool:
+        """
+        Check if the error means the connection is lost (and not, e.g., a missing file).
+        Local errors (e.g., disk full while writing a file) are not connection errors.
+        """
+        if isinstance(error, ftplib.error_temp):
+            return str(error).startswith("421")
+
+        if isinstance(
+            error, (EOFError, ConnectionError, socket.timeout, socket.gaierror)
+        ):
+            return True
+
+        return isinstance(error, OSError) and error.errno in FTPUtil._connection_errnos
+
+    @property
+    def is_connected(self) -> bool:
+        """Check if the connection is open"""
+        return FTPUtil.check_connection(self.ftp)
+
     def get_connection(self, alt_server: Optional[str] = None) -> ftplib.FTP:
         """
         Return a connection. If current connection is closed, connect again.
         If an alternative server is provided, return the alternative server.
+        If the current thread has checked out a session from the pool, return that session.
         """
         if alt_server is not None:
             return FTPUtil.open_connection(alt_server)
 
-        if not self.is_connected:
-            self.ftp = FTPUtil.open_connection(self.ftp.host)
+        session = getattr(self._local, "ftp", None)
+        if session is not None:
+            return session
+
+        # the main connection is only replaced if it is known to be closed
+        if self.ftp.sock is None:
+            self.ftp = FTPUtil.open_connection(self.server)
 
         return self.ftp
 
+    @contextmanager
+    def connection(self, alt_server: Optional[str] = None) -> Iterator[ftplib.FTP]:
+        """
+        Context manager that provides the connection to be used by the current thread:
+        its pooled session, a new connection to `alt_server` (closed at exit),
+        or the main connection (locked while in the context).
+        """
+        if alt_server is not None:
+            ftp = FTPUtil.open_connection(alt_server)
+            try:
+                yield ftp
+            finally:
+                FTPUtil.close_connection(ftp)
+
+        elif getattr(self._local, "ftp", None) is not None:
+            yield self._local.ftp
+
+        else:
+            with self._main_lock:
+                yield self.get_connection()
+
+    def run(self, func: Callable, alt_server: Optional[str] = None):
+        """
+        Call `func(ftp)` with the current connection. If the connection turns out to be lost,
+        reconnect and call it once more.
+        """
+        with self.connection(alt_server=alt_server) as ftp:
+            try:
+                return func(ftp)
+
+            except ftplib.all_errors as error:
+                if alt_server is not None or not FTPUtil.is_connection_error(error):
+                    raise
+
+                self.logger.debug("Connection lost (%s). Reconnecting.", error)
+                return func(self.reconnect())
+
+    @contextmanager
+    def session(self) -> Iterator[ftplib.FTP]:
+        """
+        Check out a session from the pool and bind it to the current thread, so every
+        FTPUtil call made by this thread uses it. Blocks while `pool_size` sessions are in use.
+        """
+        # nested sessions in the same thread reuse the outer one
+        if getattr(self._local, "ftp", None) is not None:
+            yield self._local.ftp
+            return
+
+        self._slots.acquire()
+        ftp = None
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+
+            except queue.Empty:
+                self.logger.debug("Opening new pooled session to %s", self.server)
+                ftp = FTPUtil.open_connection(self.server)
+
+            self._local.ftp = ftp
+            yield ftp
+
+        except ftplib.all_errors as error:
+            # a session that lost its connection can't be used anymore
+            # (other errors, e.g., a missing file, leave it usable)
+            if (
+                FTPUtil.is_connection_error(error)
+                and getattr(self._local, "ftp", None) is not None
+            ):
+                FTPUtil.close_connection(self._local.ftp)
+                self._local.ftp = None
+            raise
+
+        finally:
+            # the session bound to the thread may have been replaced by `reconnect`
+            ftp = getattr(self._local, "ftp", None)
+            self._local.ftp = None
+            if ftp is not None:
+                self._idle.put(ftp)
+            self._slots.release()
+
+    @property
+    def in_session(self) -> bool:
+        """Check if the current thread has checked out a session from the pool"""
+        return getattr(self._local, "ftp", None) is not None
+
+    def reconnect(self, alt_server: Optional[str] = None) -> ftplib.FTP:
+        """
+        Replace the current connection (the thread's session or the main connection)
+        by a new one and return it. Used to recover from a transfer that failed midway.
+        """
+        if alt_server is not None:
+            return FTPUtil.open_connection(alt_server)
+
+        session = getattr(self._local, "ftp", None)
+        if session is not None:
+            FTPUtil.close_connection(session)
+            self._local.ftp = FTPUtil.open_connection(self.server)
+            return self._local.ftp
+
+        with self._main_lock:
+            FTPUtil.close_connection(self.ftp)
+            self.ftp = FTPUtil.open_connection(self.server)
+            return self.ftp
+
+    @staticmethod
+    def close_connection(ftp: ftplib.FTP) -> None:
+        """Close a connection, ignoring errors from connections that are already dead"""
+        try:
+            ftp.quit()
+        except Exception:  # pylint:disable=broad-except
+            ftp.close()
+
+    def close_pool(self) -> None:
+        """Close all the idle sessions of the pool"""
+        while True:
+            try:
+                FTPUtil.close_connection(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def close(self) -> None:
+        """Stop the keep-alive and close the main connection and the pool"""
+        self._stop_keepalive.set()
+        self.close_pool()
+        with self._main_lock:
+            FTPUtil.close_connection(self.ftp)
+
+    def send_keepalives(self) -> None:
+        """
+        Send NOOP through the connections that are not in use and have been idle for more than
+        `keepalive` seconds. Connections that don't answer are closed, to be replaced lazily.
+        Each idle session is checked out with its own slot of the pool, so sessions requested
+        meanwhile wait for the ping instead of opening connections beyond `pool_size`.
+        """
+        max_idle = self.keepalive or 0
+
+        def keep_alive(ftp: ftplib.FTP) -> bool:
+            if getattr(ftp, "idle_time", 0) < max_idle:
+                return True
+
+            if FTPUtil.check_connection(ftp):
+                return True
+
+            self.logger.debug("Keep-alive failed. Closing connection.")
+            ftp.close()
+            return False
+
+        # main connection, if not in use
+        if self._main_lock.acquire(blocking=False):
+            try:
+                if self.ftp.sock is not None:
+                    keep_alive(self.ftp)
+            finally:
+                self._main_lock.release()
+
+        # idle sessions of the pool (sessions in use are skipped, as no slot is left for them)
+        idle = []
+        while self._slots.acquire(blocking=False):
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                self._slots.release()
+                break
+
+        try:
+            for ftp in idle:
+                if keep_alive(ftp):
+                    self._idle.put(ftp)
+        finally:
+            for _ in idle:
+                self._slots.release()
+
+    @staticmethod
+    def _keepalive_loop(
+        ref: "weakref.ref[FTPUtil]", interval: float, stop: threading.Event
+    ) -> None:
+        """Loop of the keep-alive thread. It ends with `close` or when FTPUtil is collected"""
+        while not stop.wait(interval):
+            ftp_util = ref()
+            if ftp_util is None:
+                return
+
+            try:
+                ftp_util.send_keepalives()
+            except Exception as error:  # pylint:disable=broad-except
+                ftp_util.logger.debug("Keep-alive error: %s", error)
+
+            del ftp_util
+
     def download_ftp_file(
         self,
         remote_file: str,
         local_folder: Union[str, Path],
         alt_server: Optional[str] = None,
+        retries: int = 3,
+        use_listing: bool = True,
     ) -> Path:
-        """Download an ftp file preserving filename and timestamps"""
-
-        # get a valid connection
-        ftp = self.get_connection(alt_server=alt_server)
+        """
+        Download an ftp file preserving filename and timestamps.
+        The file is first downloaded to a `.part` file, that is only renamed to the final name
+        once its size matches the remote file. If the transfer is interrupted, it is resumed
+        from the size of the `.part` file (REST command), up to `retries` times. A `.part` file
+        left by a previous call is also resumed, as long as the remote file hasn't changed.
+        The expected size and time come from the cached folder listing (if `use_listing`).
+        If the download doesn't match the listing, it may be outdated (e.g., the file was
+        published again), so the listing is dropped and the file is downloaded once more,
+        checking its size and time on the server (SIZE/MDTM).
+        """
 
         # get the filename and set the target path
         filename = os.path.basename(remote_file)
         local_path = Path(local_folder) / filename
+        part_path = local_path.with_name(filename + ".part")
 
-        # Retrieve the file from the ftp
-        with open(local_path, "wb") as local_file:
-            ftp.retrbinary("RETR " + remote_file, local_file.write)
+        # the folder may have been removed after being created by the parser
+        local_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # once downloaded, retrieve the remote time, correct the timezone and save it
-        remote_time_str = ftp.sendcmd("MDTM " + remote_file)
-        remote_time = parser.parse(remote_time_str[4:])
+        # connections opened to replace lost connections to the alt_server
+        replacements: List[ftplib.FTP] = []
+
+        def replace_connection() -> ftplib.FTP:
+            if alt_server is None:
+                return self.reconnect()
 
-        timestamp = remote_time.timestamp()
+            replacements.append(FTPUtil.open_connection(alt_server))
+            return replacements[-1]
+
+        # get the remote time and size from the folder listing, if available
+        info = (
+            self.listed_file_info(remote_file)
+            if alt_server is None and use_listing
+            else None
+        )
+
+        with self.connection(alt_server=alt_server) as ftp:
+            try:
+                try:
+                    remote_info = FTPUtil.complete_file_info(ftp, remote_file, info)
+
+                except ftplib.all_errors as error:
+                    if not FTPUtil.is_connection_error(error):
+                        raise
+                    ftp = replace_connection()
+                    remote_info = FTPUtil.complete_file_info(ftp, remote_file, info)
+
+                timestamp = remote_info["datetime"].timestamp()
+
+                # the partial file is stamped with the remote time, to know if it can be resumed
+                if part_path.exists():
+                    part_stat = part_path.stat()
+                    if (
+                        part_stat.st_mtime != timestamp
+                        or part_stat.st_size > remote_info["size"]
+                    ):
+                        self.logger.debug(
+                            "Discarding outdated partial file %s", part_path
+                        )
+                        part_path.unlink()
+
+                for attempt in range(retries + 1):
+                    # Retrieve the file from the ftp, resuming from the current size
+                    with open(part_path, "ab") as part_file:
+                        offset = part_file.tell()
+                        if offset >= remote_info["size"]:
+                            break
+
+                        try:
+                            ftp.retrbinary(
+                                "RETR " + remote_file,
+                                part_file.write,
+                                rest=offset or None,
+                            )
+
+                        except ftplib.all_errors as error:
+                            # local errors (e.g., disk full) leave the transfer unfinished,
+                            # so the connection is replaced before the error propagates
+                            if isinstance(
+                                error, OSError
+                            ) and not FTPUtil.is_connection_error(error):
+                                if alt_server is None:
+                                    self.reconnect()
+                                raise
+
+                            # permanent errors (e.g., file not found) are not worth retrying
+                            if (
+                                isinstance(error, ftplib.error_perm)
+                                or attempt == retries
+                            ):
+                                raise
+
+                            self.logger.warning(
+                                "Transfer of %s interrupted at %s bytes (%s). Resuming.",
+                                remote_file,
+                                part_file.tell(),
+                                error,
+                            )
+                            ftp = replace_connection()
+
+                        finally:
+                            part_file.flush()
+                            os.utime(part_path, (timestamp, timestamp))
+
+            finally:
+                for replacement in replacements:
+                    FTPUtil.close_connection(replacement)
+
+        # only move the file into place if it is complete
+        size = part_path.stat().st_size
+        if size != remote_info["size"]:
+            part_path.unlink(missing_ok=True)
+
+            if info is not None:
+                self.logger.debug(
+                    "Size of %s differs from the folder listing. Checking the server.",
+                    remote_file,
+                )
+                self.invalidate_listings(posixpath.dirname(remote_file))
+                return self.download_ftp_file(
+                    remote_file, local_folder, alt_server, retries, use_listing=False
+                )
+
+            raise IOError(
+                f"Downloaded {size} bytes of {remote_file}, expected {remote_info['size']}"
+            )
+
+        os.replace(part_path, local_path)
         os.utime(local_path, (timestamp, timestamp))
 
         return local_path
 
+    @staticmethod
+    def parse_ftp_time(value: str) -> datetime.datetime:
+        """
+        Parse the time value returned by MDTM or MLSD (YYYYMMDDHHMMSS[.sss]).
+        Fractions of seconds are ignored, so both sources give the same datetime.
+        """
+        return datetime.datetime.strptime(value.strip()[:14], "%Y%m%d%H%M%S")
+
+    @staticmethod
+    def parse_list_line(line: str) -> Optional[Tuple[str, dict]]:
+        """
+        Parse a unix style LIST line (e.g. `-rw-r--r-- 1 ftp ftp 1234 Mar 01 12:00 file.grib2`).
+        LIST times are not precise to the second, so the datetime is returned as None.
+        """
+        parts = line.split(None, 8)
+        if len(parts) < 9 or not parts[0].startswith("-"):
+            return None
+
+        return parts[8], {"datetime": None, "size": int(parts[4])}
+
+    def list_folder(
+        self, remote_folder: str, alt_server: Optional[str] = None
+    ) -> Dict[str, dict]:
+        """
+        Get the modification time and size of all the files in a remote folder with a single
+        MLSD command (or LIST, if MLSD is not supported by the server).
+        Return a dict {filename: {"datetime": datetime, "size": int}}.
+        A folder that does not exist returns an empty dict.
+        """
+        return self.run(
+            lambda ftp: self._read_listing(ftp, remote_folder), alt_server=alt_server
+        )
+
+    def _read_listing(self, ftp: ftplib.FTP, remote_folder: str) -> Dict[str, dict]:
+        """Read the listing of a remote folder through the given connection"""
+        files = {}
+        try:
+            # default facts (no OPTS MLST), as type, size and modify are returned by default
+            for name, facts in ftp.mlsd(remote_folder):
+                if facts.get("type", "file") != "file":
+                    continue
+
+                files[name] = {
+                    "datetime": FTPUtil.parse_ftp_time(facts["modify"])
+                    if "modify" in facts
+                    else None,
+                    "size": int(facts["size"]) if "size" in facts else None,
+                }
+
+        except ftplib.error_perm as error:
+            if str(error).startswith("550"):
+                return {}
+
+            # MLSD not supported by the server, fallback to LIST
+            self.logger.debug("MLSD failed (%s), falling back to LIST", error)
+            lines: List[str] = []
+            ftp.retrlines("LIST " + remote_folder, lines.append)
+
+            for line in lines:
+                parsed = FTPUtil.parse_list_line(line)
+                if parsed is not None:
+                    files[parsed[0]] = parsed[1]
+
+        return files
+
+    @staticmethod
+    def _folder_key(remote_folder: str) -> str:
+        """Normalize a remote folder to be used as a key for the listings"""
+        return posixpath.normpath(remote_folder)
+
+    def folder_ttl(self, remote_folder: str) -> float:
+        """
+        Return the time-to-live of the listing of a remote folder. Folders whose path
+        refers to a month before the current one (YYYY/MM) are considered closed.
+        """
+        match = re.search(r"(?:^|/)(\d{4})/(\d{2})(?:/|$)", remote_folder)
+        if match is not None:
+            now = datetime.datetime.now()
+            if (int(match[1]), int(match[2])) < (now.year, now.month):
+                return self.closed_listing_ttl
+
+        return self.listing_ttl
+
+    def folder_listing(self, remote_folder: str) -> Dict[str, dict]:
+        """
+        Return the listing of a remote folder from the cache. If it is not cached
+        or has expired, fetch it again from the server.
+        """
+        key = FTPUtil._folder_key(remote_folder)
+
+        with self._listings_lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+
+        # only one thread fetches a given folder, the others wait for its result
+        with fetch_lock:
+            with self._listings_lock:
+                expiration, listing = self._listings.get(key, (0.0, {}))
+
+            if expiration > time.monotonic():
+                return listing
+
+            self.logger.debug("Listing remote folder %s", key)
+            listing = self.list_folder(key)
+
+            with self._listings_lock:
+                self._listings[key] = (time.monotonic() + self.folder_ttl(key), listing)
+
+        return listing
+
+    def prefetch_listings(self, remote_folders: List[str]) -> None:
+        """Make sure the listings of the given folders are cached"""
+        for key in {FTPUtil._folder_key(folder) for folder in remote_folders}:
+            self.folder_listing(key)
+
+    def invalidate_listings(self, remote_folder: Optional[str] = None) -> None:
+        """Drop the cached listing of a remote folder, or of all the folders if None"""
+        with self._listings_lock:
+            if remote_folder is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(FTPUtil._folder_key(remote_folder), None)
+
+    def listed_file_info(self, remote_file: str) -> Optional[dict]:
+        """Return the info of the file from the cached listing, or None if it is not listed"""
+        listing = self.folder_listing(posixpath.dirname(remote_file))
+
+        return listing.get(posixpath.basename(remote_file))
+
+    @staticmethod
+    def remote_time(ftp: ftplib.FTP, remote_file: str) -> datetime.datetime:
+        """Get the modification time of a remote file with the MDTM command"""
+        remote_time_str = ftp.sendcmd("MDTM " + remote_file)
+        return FTPUtil.parse_ftp_time(remote_time_str[4:])
+
+    @staticmethod
+    def complete_file_info(
+        ftp: ftplib.FTP, remote_file: str, info: Optional[dict] = None
+    ) -> dict:
+        """
+        Return the modification time and size of a remote file, querying the server
+        (MDTM/SIZE) through the given connection for the values missing in `info`.
+        """
+        info = {"datetime": None, "size": None} if info is None else info
+
+        if info["datetime"] is not None:
+            remote_time = info["datetime"]
+        else:
+            remote_time = FTPUtil.remote_time(ftp, remote_file)
+
+        if info["size"] is not None:
+            size = info["size"]
+        else:
+            size = ftp.size(remote_file)
+
+        return {"datetime": remote_time, "size": size}
+
     def get_ftp_file_info(
         self,
         remote_file: str,
@@ -244,37 +866,40 @@ class FTPUtil:
     ) -> dict:
         """Get modification time and size of a specific file in the FTP server"""
 
-        # get a valid connection
-        ftp = self.get_connection(alt_server=alt_server)
+        info = self.listed_file_info(remote_file) if alt_server is None else None
+        if info is not None and None not in info.values():
+            return dict(info)
 
-        remote_time_str = ftp.sendcmd("MDTM " + remote_file)
-        remote_time = parser.parse(remote_time_str[4:])
+        return self.run(
+            lambda ftp: FTPUtil.complete_file_info(ftp, remote_file, info),
+            alt_server=alt_server,
+        )
 
-        # correct the timestamp
-        size = ftp.size(remote_file)
+    def read_ftp_file(
+        self, remote_file: str, alt_server: Optional[str] = None
+    ) -> bytes:
+        """Retrieve an ftp file straight into memory, without touching the disk"""
 
-        return {"datetime": remote_time, "size": size}
+        def read(ftp: ftplib.FTP) -> bytes:
+            buffer = io.BytesIO()
+            ftp.retrbinary("RETR " + remote_file, buffer.write)
+            return buffer.getvalue()
+
+        return self.run(read, alt_server=alt_server)
 
     def __repr__(self) -> str:
         output = f"FTP {'' if self.is_connected else 'Not '}connected to server {self.ftp.host}"
         return output
 
     def file_exists(self, remote_file: str) -> bool:
-        """Docstring"""
-        ftp = self.get_connection()
-
+        """Check if a remote file exists, based on the cached listing of its folder"""
         try:
-            ftp.size(remote_file)
+            return self.listed_file_info(remote_file) is not None
 
         except ftplib.error_perm as error:
-            if str(error).startswith("550"):
-                pass
-            else:
-                print(f"Error checking file existence: {error}")
+            print(f"Error checking file existence: {error}")
             return False
 
-        return True
-
     def file_changed(self, remote_file: str, file_info: dict) -> bool:
         """
         Check if the remote file has changed based in the size and datetime values
@@ -283,18 +908,91 @@ class FTPUtil:
 
         remote_info = self.get_ftp_file_info(remote_file=remote_file)
 
-        return (remote_info["size"] == file_info["size"]) and (
-            remote_info["datetime"] == file_info["datetime"]
+        return (remote_info["size"] != file_info["size"]) or (
+            remote_info["datetime"] != file_info["datetime"]
         )
 
 
 class GISUtil:
     """Helper class for basic GIS operations"""
 
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def cfgrib_version() -> str:
+        """Version of cfgrib, part of the index names, as its index format may change"""
+        return metadata.version("cfgrib")
+
+    @staticmethod
+    def is_grib(file: Union[str, Path]) -> bool:
+        """Check the magic bytes, as some .grib2 files are rewritten as NetCDF"""
+        with open(file, "rb") as stream:
+            return stream.read(4) == b"GRIB"
+
+    @staticmethod
+    def grib_index_path(file: Union[str, Path], index_folder: Union[str, Path]) -> Path:
+        """
+        Return the path of the cfgrib index of a GRIB file inside the index folder.
+        The name is keyed by the file path, size, mtime and cfgrib version, so an index is
+        never reused for a changed file. Outdated indexes of the same file are removed.
+        """
+        file, index_folder = Path(file), Path(index_folder)
+        stat = file.stat()
+
+        path_key = hashlib.sha1(str(file.resolve()).encode()).hexdigest()[:12]
+        prefix = f"{file.name}.{path_key}"
+        index_path = index_folder / (
+            f"{prefix}.{stat.st_size}-{stat.st_mtime_ns}"
+            f".cfgrib-{GISUtil.cfgrib_version()}.idx"
+        )
+
+        if not index_path.exists():
+            index_folder.mkdir(parents=True, exist_ok=True)
+            for old_index in index_folder.glob(f"{prefix}.*.idx"):
+                old_index.unlink(missing_ok=True)
+
+        return index_path
+
+    @staticmethod
+    def require_dask():
+        """Raise a helpful error if dask (needed for lazy cubes) is not installed"""
+        if importlib.util.find_spec("dask") is None:
+            raise ImportError(
+                "Lazy cubes need dask. Install it with `pip install dask` "
+                "or create the cube with lazy=False"
+            )
+
+    @staticmethod
+    def open_dataset(
+        file: Union[str, Path],
+        index_folder: Optional[Union[str, Path]] = None,
+        chunks: Optional[dict] = None,
+    ) -> xr.Dataset:
+        """
+        Open a local file with xarray. The cfgrib index of GRIB files is kept in the
+        index folder (see `grib_index_path`). If index_folder is None, no index is written.
+        If chunks is not None, the variables are lazy dask arrays with these chunks
+        ({} for one chunk per file).
+        """
+        if not GISUtil.is_grib(file):
+            return xr.open_dataset(file, chunks=chunks)
+
+        indexpath = (
+            ""
+            if index_folder is None
+            else str(GISUtil.grib_index_path(file, index_folder))
+        )
+        return xr.open_dataset(
+            file,
+            engine="cfgrib",
+            backend_kwargs={"indexpath": indexpath},
+            chunks=chunks,
+        )
+
     @staticmethod
     def create_cube(
         files: List,
         dim_key: Optional[str] = "time",
+        index_folder: Optional[Union[str, Path]] = None,
     ) -> xr.Dataset:
         """
         Stack the images in the list as one XARRAY Dataset cube.
@@ -307,20 +1005,178 @@ class GISUtil:
         # set the stacked dimension name
         dim = "time" if dim_key is None else dim_key
 
-        # create a cube with the files
-        data_arrays = [
-            xr.open_dataset(file).astype("float32")
-            for file in files
-            if Path(file).exists()
-        ]
+        # create a cube with the files, decoding each one straight into the cube
+        files = [file for file in files if Path(file).exists()]
+        datasets = (GISUtil.open_dataset(file, index_folder) for file in files)
+
+        return GISUtil.stack_datasets(datasets, size=len(files), dim=dim)
+
+    @staticmethod
+    def reduce_files(
+        files: List,
+        var: str,
+        reducer: Union[str, Reducer] = "sum",
+        index_folder: Optional[Union[str, Path]] = None,
+        post_proc: Optional[Callable] = None,
+    ) -> xr.DataArray:
+        """
+        Reduce the variable `var` of the files (see `Reducer`), opening one file at a time.
+        `post_proc` is applied to each dataset before selecting the variable.
+        """
+
+        def arrays():
+            for file in files:
+                with GISUtil.open_dataset(file, index_folder) as dset:
+                    if post_proc is not None:
+                        dset = post_proc(dset)
+                    yield dset[var]
+
+        return Reducer.get(reducer).reduce(arrays())
+
+    @staticmethod
+    def stack_datasets(
+        datasets: Iterable[xr.Dataset], size: int, dim: str = "time"
+    ) -> xr.Dataset:
+        """
+        Stack `size` datasets with the same grid along `dim`, as float32, like xr.concat.
+        The first dataset gives the grid and the cube is preallocated, so each dataset is
+        decoded straight into its slot and closed, instead of keeping all of them in memory.
+        Scalar coordinates that differ (e.g., time) become coordinates along `dim` and the
+        equal ones are kept as scalars.
+        """
+        iterator = iter(datasets)
+        first = next(iterator, None)
+        if first is None:
+            raise ValueError("No datasets to stack")
+
+        if dim in first.dims:
+            first = first.squeeze(dim)
+
+        buffers = {
+            name: np.empty((size, *var.shape), dtype="float32")
+            for name, var in first.data_vars.items()
+        }
+        scalars: Dict[str, list] = {
+            str(name): [] for name, coord in first.coords.items() if coord.ndim == 0
+        }
+
+        count = 0
+        for i, dset in enumerate(chain([first], iterator)):
+            if dim in dset.dims:
+                dset = dset.squeeze(dim)
+
+            for name, buffer in buffers.items():
+                if dset[name].shape != buffer.shape[1:]:
+                    raise ValueError(
+                        f"Variable {name} has shape {dset[name].shape} in dataset {i}, "
+                        f"expected {buffer.shape[1:]}"
+                    )
+                buffer[i] = dset[name].values
+
+            for name, values in scalars.items():
+                values.append(dset[name].values)
+
+            dset.close()
+            count = i + 1
+
+        coords = {name: coord for name, coord in first.coords.items() if coord.ndim > 0}
+        for name, values in scalars.items():
+            if name == dim or any(
+                not np.array_equal(value, values[0]) for value in values
+            ):
+                coords[name] = xr.Variable(dim, np.array(values), first[name].attrs)
+            else:
+                coords[name] = first[name].variable
+
+        data_vars = {
+            name: xr.Variable(
+                (dim, *first[name].dims), buffer[:count], first[name].attrs
+            )
+            for name, buffer in buffers.items()
+        }
+
+        return xr.Dataset(data_vars, coords, attrs=first.attrs)
+
+    @staticmethod
+    def stack_arrays(
+        arrays: Iterable[xr.DataArray], size: int, dim: str = "time"
+    ) -> xr.DataArray:
+        """Stack `size` DataArrays with the same grid along `dim` (see `stack_datasets`)"""
+        names = []
+
+        def datasets():
+            for array in arrays:
+                names.append(array.name)
+                yield array.to_dataset(name="layer")
 
-        cube = xr.concat(data_arrays, dim=dim)
+        cube = GISUtil.stack_datasets(datasets(), size=size, dim=dim)["layer"]
+        return cube.rename(names[0])
 
-        # close the arrays
-        for array in data_arrays:
-            array.close()
+    @staticmethod
+    def subset(
+        array: xr.DataArray,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        geometry: Optional[Union[gpd.GeoSeries, gpd.GeoDataFrame]] = None,
+    ) -> xr.DataArray:
+        """
+        Cut the array to a bounding box (minx, miny, maxx, maxy), in the CRS of the array,
+        and/or to geometries (masking the pixels outside them, as in `rio.clip`).
+        Arrays without CRS are considered EPSG:4326, as the INPE products.
+        As the array is cut before being loaded, only the region is read into memory.
+        """
+        if bbox is None and geometry is None:
+            return array
+
+        if array.rio.crs is None:
+            array = array.rio.write_crs("epsg:4326")
 
-        return cube
+        if geometry is not None:
+            geometries = geometry.geometry
+            if geometries.crs is not None:
+                geometries = geometries.to_crs(array.rio.crs)
+            minx, miny, maxx, maxy = geometries.total_bounds
+
+            if bbox is not None:
+                minx, miny = max(minx, bbox[0]), max(miny, bbox[1])
+                maxx, maxy = min(maxx, bbox[2]), min(maxy, bbox[3])
+
+            array = array.rio.clip_box(
+                minx, miny, maxx, maxy, allow_one_dimensional_raster=True
+            )
+            return array.rio.clip(geometries)
+
+        return array.rio.clip_box(*bbox, allow_one_dimensional_raster=True)
+
+    @staticmethod
+    def open_bytes(data: bytes, filename: str) -> xr.Dataset:
+        """
+        Open the contents of a NetCDF or GRIB2 file, already in memory, as a loaded Dataset.
+        NetCDF is decoded directly from memory. ecCodes/cfgrib can only decode GRIB from a path,
+        so GRIB2 data goes through a temporary file in shared memory (/dev/shm, when available),
+        removed right after decoding.
+        """
+        suffix = Path(filename).suffix
+
+        if suffix == FileType.NETCDF.value:
+            import netCDF4  # pylint: disable=import-outside-toplevel
+
+            store = xr.backends.NetCDF4DataStore(netCDF4.Dataset(filename, memory=data))
+            with xr.open_dataset(store) as dset:
+                return dset.load()
+
+        if suffix == FileType.GRIB.value:
+            tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+                tmp_file = Path(tmp) / filename
+                tmp_file.write_bytes(data)
+
+                # indexpath="" avoids creating the .idx file
+                with xr.open_dataset(
+                    tmp_file, engine="cfgrib", backend_kwargs={"indexpath": ""}
+                ) as dset:
+                    return dset.load()
+
+        raise ValueError(f"Opening {suffix} files from memory is not supported")
 
     @staticmethod
     def profile_from_xarray(array: xr.DataArray, driver: Optional[str] = "GTiff"):
@@ -372,6 +1228,72 @@ class GISUtil:
         return filename
 
 
+class Reducer:
+    """
+    Streaming reduction of arrays with the same grid (e.g., the daily rain of a period)
+    into a single grid. Each array is combined into the accumulator as soon as it is opened,
+    so the memory stays at one grid regardless of the number of arrays.
+    :param combine: ufunc that combines the accumulator with the next layer (e.g., np.add)
+    :param transform: Function applied to the values of each layer before combining them
+    """
+
+    def __init__(self, combine: Callable, transform: Optional[Callable] = None):
+        self.combine = combine
+        self.transform = transform
+
+    def reduce(self, arrays: Iterable[xr.DataArray]) -> xr.DataArray:
+        """
+        Reduce the arrays. The result keeps the coordinates of the first array
+        (e.g., its time) and is stored as float32, as the cubes.
+        """
+        first, accum = None, None
+        for array in arrays:
+            values = np.asarray(array.values, dtype="float64")
+            if self.transform is not None:
+                values = self.transform(values)
+
+            if accum is None:
+                first, accum = array, np.array(values, dtype="float64")
+            else:
+                self.combine(accum, values, out=accum)
+
+        if first is None:
+            raise ValueError("There are no arrays to reduce")
+
+        return first.copy(data=accum.astype("float32"))
+
+    @staticmethod
+    def sum() -> Reducer:
+        """Sum of the layers, with NaNs counting as 0 (as xarray's sum)"""
+        return Reducer(np.add, transform=lambda values: np.nan_to_num(values, nan=0))
+
+    @staticmethod
+    def max() -> Reducer:
+        """Maximum of the layers, ignoring NaNs"""
+        return Reducer(np.fmax)
+
+    @staticmethod
+    def min() -> Reducer:
+        """Minimum of the layers, ignoring NaNs"""
+        return Reducer(np.fmin)
+
+    @staticmethod
+    def rainy_days(threshold: float = 1.0) -> Reducer:
+        """Number of layers with rain (in mm) greater or equal to the threshold"""
+        return Reducer(np.add, transform=lambda values: values >= threshold)
+
+    @staticmethod
+    def get(reducer: Union[str, Reducer]) -> Reducer:
+        """Return a Reducer given its name ("sum", "max", "min" or "rainy_days")"""
+        if isinstance(reducer, Reducer):
+            return reducer
+
+        if reducer not in ("sum", "max", "min", "rainy_days"):
+            raise ValueError(f"Unknown reducer {reducer}")
+
+        return getattr(Reducer, reducer)()
+
+
 class OSUtil:
     """Helper class for OS related functions"""
 
@@ -385,10 +1307,3 @@ class OSUtil:
         local_dt = datetime.datetime.fromtimestamp(stat.st_mtime)
 
         return {"datetime": local_dt, "size": stat.st_size}
-
-    @staticmethod
-    def clear_folder(folder_path: Union[str, Path]):
-        """Clear the given folder"""
-        folder_path = Path(folder_path).as_posix()
-        command = f"rm -rf {folder_path}/*"
-        subprocess.run(command, shell=True, check=True)
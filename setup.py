@@ -8,6 +8,8 @@ setup(
     author="Mauricio Cordeiro",
     author_email="cordmaur@gmail.com",
     packages=find_packages(),
+    extras_require={"lazy": ["dask"], "store": ["zarr<3"]},
+    entry_points={"console_scripts": ["raindownloader=raindownloader.cli:main"]},
     # install_requires=[
     #     "geopandas",
     #     "xarray",
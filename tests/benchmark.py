@@ -0,0 +1,172 @@
+"""
+Throughput benchmark for `get_range` against the local FTP stand-in.
+Usage: python tests/benchmark.py --days 90 --workers 4 --latency 0.05 --bandwidth 2e6
+The import time of the package is measured with: python tests/benchmark.py --imports
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from raindownloader.downloader import Downloader
+from raindownloader.inpeparser import INPE, INPEParsers
+from raindownloader.parser import BaseParser
+from raindownloader.utils import DateFrequency
+
+from ftp_server import LocalFTPServer, populate_merge, populate_wrf, WRF_ROOT
+
+# dependencies that should only be imported on first use
+HEAVY_MODULES = ["xarray", "rioxarray", "rasterio", "geopandas", "matplotlib"]
+
+
+def run_benchmark(
+    layout: str = "merge",
+    days: int = 30,
+    workers: int = 1,
+    latency: float = 0.0,
+    bandwidth: Optional[float] = None,
+    size: int = 256 * 1024,
+    avoid_update: bool = True,
+) -> dict:
+    """
+    Serve synthetic files with the given latency/bandwidth and download them with `get_range`.
+    layout: "merge" (one file per day) or "wrf" (one run with one file per hour)
+    Return a dict with the number of files, bytes, elapsed seconds, files/s and MB/s.
+    """
+    start = datetime(2023, 1, 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root, local_folder = Path(tmp) / "ftp", Path(tmp) / "local"
+        local_folder.mkdir()
+
+        if layout == "merge":
+            end = start + timedelta(days=days - 1)
+            populate_merge(root, start, end, size=size)
+            parser = INPEParsers.daily_rain_parser
+            range_kwargs: dict = {}
+
+        else:
+            end = start + timedelta(hours=days)
+            populate_wrf(root, start, hours=days, size=size)
+            parser = BaseParser(
+                datatype="WRF_RAW",
+                root=WRF_ROOT,
+                filename_fn=INPE.WRF_filename,
+                foldername_fn=INPE.WRF_foldername,
+                date_freq=DateFrequency.HOURLY,
+                mirror_folder=True,
+            )
+            range_kwargs = {"ref_date": start}
+
+        server = LocalFTPServer(root, latency=latency, bandwidth=bandwidth).start()
+
+        try:
+            downloader = Downloader(
+                server=server.address,
+                parsers=[parser],
+                local_folder=local_folder,
+                avoid_update=avoid_update,
+                max_workers=workers,
+            )
+
+            begin = time.perf_counter()
+            files = downloader.get_range(start, end, parser.datatype, **range_kwargs)
+            elapsed = time.perf_counter() - begin
+
+        finally:
+            server.stop()
+
+        total_bytes = sum(Path(file).stat().st_size for file in files)
+
+    return {
+        "files": len(files),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "files/s": len(files) / elapsed,
+        "MB/s": total_bytes / elapsed / 1e6,
+        "commands": len(server.commands),
+    }
+
+
+def run_import_benchmark(module: str = "raindownloader.cli", repeat: int = 5) -> dict:
+    """
+    Import the module in fresh interpreters and return the best import time (seconds)
+    and the heavy modules that were loaded by the import.
+    """
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(json.dumps({'seconds': elapsed, 'heavy': heavy}))\n"
+    )
+
+    results = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", code], capture_output=True, check=True, text=True
+            ).stdout
+        )
+        for _ in range(repeat)
+    ]
+
+    return {
+        "module": module,
+        "seconds": min(result["seconds"] for result in results),
+        "heavy": results[0]["heavy"],
+    }
+
+
+def main():
+    """Parse the arguments and print the benchmark results"""
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--layout", choices=["merge", "wrf"], default="merge")
+    arg_parser.add_argument("--days", type=int, default=30, help="days (or WRF hours)")
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="s per reply")
+    arg_parser.add_argument("--bandwidth", type=float, default=None, help="bytes/s")
+    arg_parser.add_argument("--size", type=int, default=256 * 1024, help="file bytes")
+    arg_parser.add_argument(
+        "--check-updates",
+        action="store_true",
+        help="run with avoid_update=False",
+    )
+    arg_parser.add_argument(
+        "--imports", action="store_true", help="measure the import time instead"
+    )
+    args = arg_parser.parse_args()
+
+    if args.imports:
+        for module in ["raindownloader", "raindownloader.cli"]:
+            result = run_import_benchmark(module)
+            print(
+                f"import {module}: {result['seconds'] * 1000:.0f} ms"
+                f" (heavy modules loaded: {result['heavy'] or 'none'})"
+            )
+        return
+
+    result = run_benchmark(
+        layout=args.layout,
+        days=args.days,
+        workers=args.workers,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        size=args.size,
+        avoid_update=not args.check_updates,
+    )
+
+    print(
+        f"{result['files']} files, {result['bytes'] / 1e6:.1f} MB in {result['seconds']:.2f}s"
+        f" -> {result['files/s']:.1f} files/s, {result['MB/s']:.2f} MB/s"
+        f" ({result['commands']} FTP commands)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Shared fixtures for the tests
+"""
+from datetime import datetime
+
+import pytest
+
+from ftp_server import LocalFTPServer, populate_merge, populate_wrf
+from raindownloader.inpeparser import INPEParsers
+
+
+@pytest.fixture
+def ftp_server_factory(tmp_path):
+    """
+    Return a function that starts local FTP servers with the MERGE daily layout
+    (March 2023) and one WRF run (2023-05-22). The servers are stopped at teardown.
+    """
+    root = tmp_path / "ftp"
+    populate_merge(root, datetime(2023, 3, 1), datetime(2023, 3, 31))
+    populate_wrf(root, datetime(2023, 5, 22), hours=24)
+
+    servers = []
+
+    def factory(**kwargs) -> LocalFTPServer:
+        server = LocalFTPServer(root, **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield factory
+
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def ftp_server(ftp_server_factory) -> LocalFTPServer:
+    """A local FTP server without latency or bandwidth limits"""
+    return ftp_server_factory()
+
+
+@pytest.fixture(autouse=True)
+def restore_inpe_parsers():
+    """
+    Restore the attributes of the module-level INPE parsers after each test, as the
+    Downloader (and some tests) set their FTP, catalog, workers, etc.
+    """
+    saved = [(parser, dict(vars(parser))) for parser in INPEParsers.parsers]
+    yield
+
+    for parser, attributes in saved:
+        vars(parser).clear()
+        vars(parser).update(attributes)
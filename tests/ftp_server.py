@@ -0,0 +1,410 @@
+"""
+Local FTP stand-in for tests and benchmarks.
+It serves a folder from disk with anonymous access and can inject a latency in every
+command reply and cap the bandwidth of the data transfers, to mimic a remote server.
+Only the commands used by ftplib/FTPUtil are implemented.
+"""
+import os
+import posixpath
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from raindownloader.inpeparser import (
+    INPE,
+    DailyWRFParser,
+    HourlyWRFParser,
+    MonthAccumParser,
+)
+from raindownloader.parser import BaseParser
+from raindownloader.utils import DateFrequency
+
+# the synthetic GRIB files are decoded with the variable names of the INPE files (e.g., `prec`),
+# with the local definitions of CPTEC (set before ecCodes is first used)
+GRIB_DEFINITIONS = Path(__file__).parent / "grib_definitions"
+os.environ["ECCODES_EXTRA_DEFINITION_PATH"] = os.pathsep.join(
+    filter(
+        None, [str(GRIB_DEFINITIONS), os.environ.get("ECCODES_EXTRA_DEFINITION_PATH")]
+    )
+)
+
+MERGE_ROOT = "modelos/tempo/MERGE/GPM/DAILY"
+WRF_ROOT = "modelos/tempo/WRF/ams_07km/recortes/prec"
+
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """Handle one FTP control connection"""
+
+    server: "LocalFTPServer"
+
+    def setup(self):
+        super().setup()
+        self.cwd = "/"
+        self.rest = 0
+        self.pasv: Optional[socket.socket] = None
+
+    def reply(self, line: str):
+        """Send a reply, after the configured latency"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write((line + "\r\n").encode())
+
+    def real_path(self, path: str) -> Path:
+        """Convert an FTP path into a path inside the served folder"""
+        path = posixpath.normpath(posixpath.join(self.cwd, path or "."))
+        return self.server.root / path.lstrip("/")
+
+    def handle(self):
+        self.reply("220 Local FTP stand-in")
+
+        for raw in self.rfile:
+            line = raw.decode().rstrip("\r\n")
+            cmd, _, arg = line.partition(" ")
+            cmd = cmd.upper()
+            self.server.commands.append(cmd)
+
+            method = getattr(self, "cmd_" + cmd.lower(), None)
+            if method is None:
+                self.reply(f"502 Command {cmd} not implemented")
+                continue
+
+            try:
+                if method(arg) is False:
+                    break
+            except (ConnectionError, OSError):
+                break
+
+        if self.pasv is not None:
+            self.pasv.close()
+
+    # Session commands
+    def cmd_user(self, _):
+        self.reply("331 Anonymous login ok")
+
+    def cmd_pass(self, _):
+        self.reply("230 Logged in")
+
+    def cmd_type(self, arg):
+        self.reply(f"200 Type set to {arg}")
+
+    def cmd_noop(self, _):
+        self.reply("200 NOOP ok")
+
+    def cmd_pwd(self, _):
+        self.reply(f'257 "{self.cwd}" is the current directory')
+
+    def cmd_cwd(self, arg):
+        if self.real_path(arg).is_dir():
+            self.cwd = posixpath.normpath(posixpath.join(self.cwd, arg))
+            self.reply("250 Directory changed")
+        else:
+            self.reply("550 No such directory")
+
+    def cmd_quit(self, _):
+        self.reply("221 Bye")
+        return False
+
+    # File information
+    def cmd_size(self, arg):
+        path = self.real_path(arg)
+        if path.is_file():
+            self.reply(f"213 {path.stat().st_size}")
+        else:
+            self.reply("550 No such file")
+
+    def cmd_mdtm(self, arg):
+        path = self.real_path(arg)
+        if path.is_file():
+            self.reply(f"213 {self.server.mtime(path)}")
+        else:
+            self.reply("550 No such file")
+
+    # Data transfers (passive mode only)
+    def cmd_pasv(self, _):
+        if self.pasv is not None:
+            self.pasv.close()
+        self.pasv = socket.create_server(("127.0.0.1", 0))
+        port = self.pasv.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xFF})")
+
+    def cmd_rest(self, arg):
+        self.rest = int(arg)
+        self.reply(f"350 Restarting at {self.rest}")
+
+    def transfer(self, data: Union[bytes, Path], offset: int = 0):
+        """Send the data through the passive connection, respecting the bandwidth cap"""
+        if self.pasv is None:
+            self.reply("425 Use PASV first")
+            return
+
+        self.reply("150 Opening data connection")
+        conn, _ = self.pasv.accept()
+        self.pasv.close()
+        self.pasv = None
+
+        chunk_size = 64 * 1024
+        try:
+            if isinstance(data, Path):
+                with open(data, "rb") as file:
+                    file.seek(offset)
+                    chunks = iter(lambda: file.read(chunk_size), b"")
+                    self.send_chunks(conn, chunks)
+            else:
+                chunks = (
+                    data[i : i + chunk_size] for i in range(0, len(data), chunk_size)
+                )
+                self.send_chunks(conn, chunks)
+        finally:
+            conn.close()
+
+        self.reply("226 Transfer complete")
+
+    def send_chunks(self, conn: socket.socket, chunks):
+        """Send the chunks, sleeping as needed to keep the bandwidth under the cap"""
+        start, sent = time.monotonic(), 0
+        for chunk in chunks:
+            conn.sendall(chunk)
+            sent += len(chunk)
+            if self.server.bandwidth:
+                delay = sent / self.server.bandwidth - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def cmd_retr(self, arg):
+        path = self.real_path(arg)
+        offset, self.rest = self.rest, 0
+        if not path.is_file():
+            self.reply("550 No such file")
+            return
+
+        self.transfer(path, offset)
+
+    def cmd_mlsd(self, arg):
+        path = self.real_path(arg)
+        if not path.is_dir():
+            self.reply("550 No such directory")
+            return
+
+        if not self.server.mlsd:
+            self.reply("500 MLSD not understood")
+            return
+
+        lines = []
+        for item in sorted(path.iterdir()):
+            if item.is_dir():
+                lines.append(f"type=dir; {item.name}")
+            else:
+                stat = item.stat()
+                modify = self.server.mtime(item)
+                lines.append(
+                    f"type=file;size={stat.st_size};modify={modify}; {item.name}"
+                )
+
+        self.transfer("".join(line + "\r\n" for line in lines).encode())
+
+    def cmd_list(self, arg):
+        path = self.real_path(arg)
+        if not path.is_dir():
+            self.reply("550 No such directory")
+            return
+
+        lines = []
+        for item in sorted(path.iterdir()):
+            stat = item.stat()
+            kind = "d" if item.is_dir() else "-"
+            date = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            date_str = date.strftime("%b %d %H:%M")
+            lines.append(
+                f"{kind}rw-r--r--    1 ftp      ftp  {stat.st_size:>10} {date_str} {item.name}"
+            )
+
+        self.transfer("".join(line + "\r\n" for line in lines).encode())
+
+    def cmd_nlst(self, arg):
+        path = self.real_path(arg)
+        if not path.is_dir():
+            self.reply("550 No such directory")
+            return
+
+        names = "".join(item.name + "\r\n" for item in sorted(path.iterdir()))
+        self.transfer(names.encode())
+
+
+class LocalFTPServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded FTP server on localhost serving the `root` folder.
+    :param root: Folder to be served
+    :param latency: Delay (in seconds) added before each reply of the control connection
+    :param bandwidth: Maximum speed (in bytes/s) of each data transfer. None means unlimited
+    :param mlsd: If False, MLSD is refused, so clients have to fallback to LIST
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        root: Union[str, Path],
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        mlsd: bool = True,
+    ):
+        super().__init__(("127.0.0.1", 0), FTPHandler)
+        self.root = Path(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mlsd = mlsd
+        self.commands: list = []
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        """Address in the `host:port` format accepted by FTPUtil"""
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    @staticmethod
+    def mtime(path: Path) -> str:
+        """Modification time in the MDTM/MLSD format (UTC)"""
+        date = datetime.fromtimestamp(int(path.stat().st_mtime), timezone.utc)
+        return date.strftime("%Y%m%d%H%M%S")
+
+    def start(self) -> "LocalFTPServer":
+        """Serve in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket"""
+        self.shutdown()
+        self.server_close()
+
+
+def grib_bytes(values, date: datetime, lat: float = -10.0, lon: float = 300.0) -> bytes:
+    """
+    Encode a 2D array as a GRIB2 message on a regular 1 degree grid, starting at lat/lon
+    (longitudes in 0-360, as in INPE files). The variable is decoded by cfgrib as `prec`.
+    """
+    import eccodes  # pylint: disable=import-outside-toplevel
+
+    values = np.asarray(values, dtype="float64")
+    n_lat, n_lon = values.shape
+
+    gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+    try:
+        for key, value in {
+            "centre": 46,
+            "parameterCategory": 1,
+            "parameterNumber": 8,
+            "Ni": n_lon,
+            "Nj": n_lat,
+            "latitudeOfFirstGridPointInDegrees": lat,
+            "latitudeOfLastGridPointInDegrees": lat - (n_lat - 1),
+            "longitudeOfFirstGridPointInDegrees": lon,
+            "longitudeOfLastGridPointInDegrees": lon + (n_lon - 1),
+            "iDirectionIncrementInDegrees": 1.0,
+            "jDirectionIncrementInDegrees": 1.0,
+            "dataDate": int(date.strftime("%Y%m%d")),
+            "dataTime": date.hour * 100,
+        }.items():
+            eccodes.codes_set(gid, key, value)
+
+        eccodes.codes_set_values(gid, values.ravel())
+        return eccodes.codes_get_message(gid)
+
+    finally:
+        eccodes.codes_release(gid)
+
+
+def write_file(path: Path, size: int, mtime: datetime):
+    """Write a synthetic file with the given size and modification time"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(os.urandom(size))
+    timestamp = mtime.timestamp()
+    os.utime(path, (timestamp, timestamp))
+
+
+def populate_merge(
+    root: Union[str, Path], start: datetime, end: datetime, size: int = 1024
+):
+    """Create synthetic daily MERGE files as DAILY/YYYY/MM/MERGE_CPTEC_YYYYMMDD.grib2"""
+    date = start
+    while date <= end:
+        path = Path(root) / MERGE_ROOT / f"{date:%Y/%m}/MERGE_CPTEC_{date:%Y%m%d}.grib2"
+        write_file(path, size, date + timedelta(days=1, hours=10))
+        date += timedelta(days=1)
+
+
+def populate_wrf(
+    root: Union[str, Path], ref_date: datetime, hours: int = 48, size: int = 1024
+):
+    """
+    Create synthetic hourly WRF files for one run as
+    prec/YYYY/MM/DD/00/WRF_cpt_07KM_YYYYMMDD00_YYYYMMDDHH.grib2
+    """
+    folder = Path(root) / WRF_ROOT / f"{ref_date:%Y/%m/%d}/00"
+    for hour in range(hours + 1):
+        date = ref_date + timedelta(hours=hour)
+        path = folder / f"WRF_cpt_07KM_{ref_date:%Y%m%d}00_{date:%Y%m%d%H}.grib2"
+        write_file(path, size, ref_date + timedelta(hours=4))
+
+
+def rain_parser(root: Path, days: int) -> BaseParser:
+    """Serve `days` GRIB2 files (from 2023-03-01) with the value of the day in all pixels"""
+    (root / "rain").mkdir()
+    for day in range(1, days + 1):
+        (root / f"rain/rain_202303{day:02d}.grib2").write_bytes(
+            grib_bytes(np.full((3, 4), day), datetime(2023, 3, day))
+        )
+
+    return BaseParser(
+        datatype="rain",
+        root="/rain",
+        filename_fn=lambda date: f"rain_{date:%Y%m%d}.grib2",
+    )
+
+
+def month_parser(daily: BaseParser) -> MonthAccumParser:
+    """Return a parser of the monthly totals of the daily parser"""
+    return MonthAccumParser(
+        datatype="monthly",
+        fn_creator=lambda date: f"accum_{date:%Y%m}.nc",
+        daily_parser=daily,
+        date_freq=DateFrequency.MONTHLY,
+    )
+
+
+def wrf_parsers(
+    root: Path, runs: list, hours: int
+) -> Tuple[HourlyWRFParser, DailyWRFParser]:
+    """
+    Serve the cumulative WRF hours of the runs (the run `i` has a cumulative rain
+    of (i + 2) * hour in all pixels) and return the hourly and daily parsers
+    """
+    for i, ref_date in enumerate(runs):
+        folder = root / f"wrf/{ref_date:%Y/%m/%d}/00"
+        folder.mkdir(parents=True)
+        for hour in range(hours + 1):
+            date = ref_date + timedelta(hours=hour)
+            (folder / INPE.WRF_filename(date, ref_date=ref_date)).write_bytes(
+                grib_bytes(np.full((3, 4), (i + 2.0) * hour), date)
+            )
+
+    hourly = HourlyWRFParser(
+        datatype="hourly",
+        root="/wrf",
+        filename_fn=INPE.WRF_filename,
+        foldername_fn=INPE.WRF_foldername,
+        date_freq=DateFrequency.HOURLY,
+        mirror_folder=True,
+    )
+    daily = DailyWRFParser(datatype="daily", root="/wrf", hourly_parser=hourly)
+
+    return hourly, daily
@@ -0,0 +1,48 @@
+"""Tests for the local catalog"""
+from datetime import datetime
+
+from raindownloader.catalog import LocalCatalog
+
+
+class TestLocalCatalog:
+    """Test the LocalCatalog class"""
+
+    def test_register_and_lookup(self, tmp_path):
+        """Test the entries are persisted and found by range"""
+        catalog = LocalCatalog(tmp_path)
+
+        for day in (1, 2, 4):
+            file = tmp_path / f"file_{day}.grib2"
+            file.write_bytes(b"x" * day)
+            catalog.register("DAILY_RAIN", f"2023030{day}", file)
+
+        catalog.register(
+            "HOURLY_WRF", datetime(2023, 3, 1, 1), file, ref_date=datetime(2023, 3, 1)
+        )
+
+        entry = catalog.get("DAILY_RAIN", datetime(2023, 3, 2))
+        assert entry is not None
+        assert entry["size"] == 2
+        assert entry["path"] == tmp_path / "file_2.grib2"
+
+        entries = catalog.lookup("DAILY_RAIN", ["20230301", "20230303", "20230304"])
+        assert set(entries) == {"20230301T000000", "20230304T000000"}
+
+        assert catalog.get("HOURLY_WRF", datetime(2023, 3, 1, 1)) is None
+        assert catalog.get("HOURLY_WRF", datetime(2023, 3, 1, 1), ref_date="20230301")
+
+        # the catalog is persisted in the local folder
+        catalog.close()
+        assert len(LocalCatalog(tmp_path)) == 4
+
+    def test_prune(self, tmp_path):
+        """Test entries of deleted files are removed"""
+        catalog = LocalCatalog(tmp_path)
+        file = tmp_path / "file.nc"
+        file.write_bytes(b"data")
+        catalog.register("DAILY_RAIN", "20230301", file)
+
+        assert catalog.prune() == 0
+        file.unlink()
+        assert catalog.prune() == 1
+        assert catalog.get("DAILY_RAIN", "20230301") is None
@@ -0,0 +1,82 @@
+"""Tests for the command line interface"""
+from unittest.mock import patch
+
+import pytest
+
+from raindownloader.cli import SyncStats, main, sync
+from raindownloader.downloader import Downloader
+from raindownloader.inpeparser import INPEParsers, INPETypes
+
+
+class TestSync:
+    """Test the sync command against the local FTP server"""
+
+    def test_sync(self, ftp_server, tmp_path, capsys):
+        """Files are downloaded once, then counted as cache hits"""
+        args = ["sync", "--server", ftp_server.address, "--local-folder", str(tmp_path)]
+        args += ["--start", "2023-03-01", "--end", "2023-03-05", "--workers", "2"]
+
+        assert main(args) == 0
+        output = capsys.readouterr().out
+        assert "DAILY_RAIN: 5 files" in output
+        assert "5 downloaded" in output
+        assert "0 cache hits" in output
+
+        assert main(args + ["--check-updates"]) == 0
+        output = capsys.readouterr().out
+        assert "0 downloaded" in output
+        assert "5 cache hits" in output
+
+    def test_sync_failures(self, ftp_server, tmp_path, capsys):
+        """Missing files are reported as failures, without stopping the others"""
+        args = ["sync", "--server", ftp_server.address, "--local-folder", str(tmp_path)]
+        args += ["--start", "2023-03-30", "--end", "2023-04-01"]
+
+        assert main(args) == 1
+        captured = capsys.readouterr()
+        assert "2 downloaded" in captured.out
+        assert "1 failures" in captured.out
+        assert "FAILED DAILY_RAIN/20230401" in captured.err
+
+    def test_sync_not_forced(self, ftp_server, tmp_path):
+        """The parsers decide if their files must be updated, without forced downloads"""
+        parser = INPEParsers.daily_rain_parser
+        downloader = Downloader(ftp_server.address, [parser], tmp_path, keepalive=None)
+        stats = SyncStats()
+
+        with patch.object(parser, "get_file", wraps=parser.get_file) as get_file:
+            sync(downloader, INPETypes.DAILY_RAIN, "20230301", "20230302", stats)
+            sync(downloader, INPETypes.DAILY_RAIN, "20230301", "20230302", stats)
+
+        assert stats.downloaded == 2
+        assert stats.cached == 2
+        assert get_file.call_count == 4
+        assert not any(
+            call.kwargs.get("force_download") for call in get_file.mock_calls
+        )
+
+    def test_wrf_requires_ref_date(self, tmp_path, capsys):
+        """The WRF datatypes are rejected by the argument parser without --ref-date"""
+        args = ["sync", "--local-folder", str(tmp_path), "--start", "2023-03-01"]
+
+        with pytest.raises(SystemExit) as error:
+            main(args + ["--datatypes", "DAILY_RAIN", "HOURLY_WRF"])
+
+        assert error.value.code == 2
+        assert "--ref-date is required for HOURLY_WRF" in capsys.readouterr().err
+
+    def test_sync_cleanup(self, ftp_server, tmp_path):
+        """The FTP connections and the catalog are closed when the sync fails"""
+        args = ["sync", "--server", ftp_server.address, "--local-folder", str(tmp_path)]
+        args += ["--start", "2023-03-01", "--end", "2023-03-01"]
+
+        with patch("raindownloader.cli.sync", side_effect=KeyboardInterrupt), patch(
+            "raindownloader.utils.FTPUtil.close"
+        ) as close_ftp, patch(
+            "raindownloader.catalog.LocalCatalog.close"
+        ) as close_catalog:
+            with pytest.raises(KeyboardInterrupt):
+                main(args)
+
+        close_ftp.assert_called_once()
+        close_catalog.assert_called_once()
@@ -0,0 +1,106 @@
+"""Tests for the Zarr cube store"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import rioxarray  # noqa: F401  pylint: disable=unused-import
+import xarray as xr
+
+from raindownloader.cubestore import CubeStore, CumulativeStore
+
+
+def layers(days: list) -> xr.DataArray:
+    """Cube with one layer per day, with a scalar and a time-varying coordinate"""
+    arrays = [
+        xr.DataArray(
+            np.full((2, 3), day, dtype="float32"),
+            dims=("latitude", "longitude"),
+            coords={
+                "latitude": [1.0, 0.0],
+                "longitude": [0.0, 1.0, 2.0],
+                "time": pd.Timestamp(2023, 3, day),
+                "valid_time": pd.Timestamp(2023, 3, day, 12),
+                "surface": 0.0,
+            },
+            name="prec",
+        ).rio.write_crs("epsg:4326")
+        for day in days
+    ]
+    return xr.concat(arrays, dim="time")
+
+
+class TestCubeStore:
+    """Test the CubeStore class"""
+
+    def test_append_and_read(self, tmp_path):
+        """Dates appended in any order are read back in the requested order"""
+        store = CubeStore(tmp_path / "prec.zarr", time_chunk=2)
+        assert store.read(["20230301"]) is None
+
+        store.append(layers([3]), [datetime(2023, 3, 3)])
+        store.append(layers([1, 2, 3]), ["20230301", "20230302", "20230303"])
+        assert store.missing(["20230302", "20230304"]) == ["20230304"]
+
+        cube = store.read(["20230301", "20230302", "20230303"])
+        expected = layers([1, 2, 3])
+
+        assert cube.name == "prec"
+        assert cube.sizes["time"] == 3
+        xr.testing.assert_equal(
+            cube.drop_vars("spatial_ref"), expected.drop_vars("spatial_ref")
+        )
+        assert cube.rio.crs.to_epsg() == 4326
+
+        # the scalar coordinates are kept as scalars
+        assert cube["surface"].ndim == 0
+        assert cube["valid_time"].dims == ("time",)
+
+        lazy = store.read(["20230303", "20230301"], lazy=True)
+        assert lazy.chunks is not None
+        assert lazy.sum(dim=["latitude", "longitude"]).values.tolist() == [18, 6]
+
+
+class TestCumulativeStore:
+    """Test the CumulativeStore class"""
+
+    @staticmethod
+    def days(start: int, end: int):
+        """Daily layers with the value of the day (NaN in one pixel of day 2)"""
+        for day in range(start, end + 1):
+            values = np.full((2, 3), float(day))
+            if day == 2:
+                values[0, 0] = np.nan
+            yield xr.DataArray(
+                values,
+                dims=("latitude", "longitude"),
+                coords={
+                    "latitude": [0.0, 1.0],
+                    "longitude": [0.0, 1.0, 2.0],
+                    "time": np.datetime64(f"2023-03-{day:02d}"),
+                },
+                name="tp",
+            ).rio.write_crs("epsg:4326")
+
+    def test_accum(self, tmp_path):
+        """Any period is the difference of two slices, across several writes"""
+        store = CumulativeStore(tmp_path / "cumsum.zarr", time_chunk=3)
+        assert store.dates() is None
+
+        store.extend(self.days(1, 5), datetime(2023, 3, 1))
+        store.extend(self.days(6, 10), datetime(2023, 3, 6))
+        assert len(store.dates()) == 11
+        assert store.covers(datetime(2023, 3, 1), datetime(2023, 3, 10))
+
+        accum = store.accum(datetime(2023, 3, 2), datetime(2023, 3, 8))
+        assert accum.dtype == "float32" and accum.name == "tp"
+        assert float(accum[1, 1]) == sum(range(2, 9))
+        assert float(accum[0, 0]) == sum(range(3, 9))
+        assert accum.time == np.datetime64("2023-03-02")
+        assert accum.rio.crs is not None
+
+        assert float(store.accum(datetime(2023, 3, 1), datetime(2023, 3, 1))[1, 1]) == 1
+        assert store.accum(datetime(2023, 3, 5), datetime(2023, 3, 11)) is None
+
+        with pytest.raises(ValueError, match="contiguous"):
+            store.extend(self.days(12, 13), datetime(2023, 3, 12))
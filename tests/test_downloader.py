@@ -1,12 +1,27 @@
 """
 Tests for the INPEDownloader classes
 """
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from functools import cached_property
 from pathlib import Path
 from unittest.mock import patch, MagicMock
+
+import dask.array
+import geopandas as gpd
+import numpy as np
 import pytest
+import xarray as xr
+from shapely.geometry import box
 
 from raindownloader.downloader import Downloader
 from raindownloader.inpeparser import INPEParsers, INPETypes
+from raindownloader.parser import BaseParser
+from raindownloader.utils import GISUtil, Reducer
+
+from ftp_server import grib_bytes, month_parser, rain_parser, wrf_parsers
 
 
 class TestDownloader:
@@ -25,11 +40,14 @@ class TestDownloader:
         }
         return data
 
-    downloader = Downloader(
-        server=INPEParsers.FTPurl,
-        parsers=INPEParsers.parsers,
-        local_folder="./tests/data",
-    )
+    @cached_property
+    def downloader(self) -> Downloader:
+        """Downloader of the INPE server, connected on first use (not when collecting)"""
+        return Downloader(
+            server=INPEParsers.FTPurl,
+            parsers=INPEParsers.parsers,
+            local_folder="./tests/data",
+        )
 
     @patch("raindownloader.downloader.FTPUtil")
     def test_init(self, _):
@@ -115,3 +133,355 @@ class TestDownloader:
     #     # assert download called and Path type was not modified
     #     assert mock_download_ftp.called
     #     assert downloaded_file == f
+
+
+class TestDownloaderLocal:
+    """Test the Downloader against the local FTP server"""
+
+    def test_open_in_memory(self, ftp_server, tmp_path):
+        """Files are streamed and decoded from memory, without writing to the local folder"""
+        root = ftp_server.root / "memory"
+        root.mkdir()
+        (root / "rain_20230301.grib2").write_bytes(
+            grib_bytes(np.arange(12).reshape(3, 4), datetime(2023, 3, 1))
+        )
+        xr.Dataset({"rain": (("lat", "lon"), np.ones((2, 2)))}).to_netcdf(
+            root / "rain_20230301.nc"
+        )
+
+        local_folder = tmp_path / "local"
+        local_folder.mkdir()
+        parsers = [
+            BaseParser(
+                datatype=f"rain{suffix}",
+                root="/memory",
+                filename_fn=lambda date, suffix=suffix: f"rain_{date:%Y%m%d}{suffix}",
+            )
+            for suffix in (".grib2", ".nc")
+        ]
+        downloader = Downloader(
+            ftp_server.address, parsers, local_folder, keepalive=None
+        )
+
+        grib = downloader.open_file("20230301", "rain.grib2", in_memory=True)
+        netcdf = downloader.open_file("20230301", "rain.nc", in_memory=True)
+
+        assert float(grib.sum()) == sum(range(12))
+        assert float(netcdf.sum()) == 4
+        assert not list(local_folder.rglob("rain_*"))
+
+    def test_catalog(self, ftp_server, tmp_path):
+        """Test a range already downloaded is answered by the catalog, without the FTP"""
+        downloader = Downloader(
+            ftp_server.address,
+            [INPEParsers.daily_rain_parser],
+            tmp_path,
+            keepalive=None,
+        )
+        files = downloader.get_range("20230301", "20230310", INPETypes.DAILY_RAIN)
+        assert len(downloader.catalog) == 10
+
+        ftp_server.commands.clear()
+        with patch.object(Path, "exists") as exists:
+            again = downloader.get_range("20230301", "20230310", INPETypes.DAILY_RAIN)
+
+        assert again == files
+        assert not exists.called
+        assert not ftp_server.commands
+
+        # a file deleted by hand is downloaded again after pruning the catalog
+        files[0].unlink()
+        assert downloader.catalog.prune() == 1
+        assert (
+            downloader.get_range("20230301", "20230310", INPETypes.DAILY_RAIN) == files
+        )
+        assert files[0].exists()
+        assert ftp_server.commands.count("RETR") == 1
+
+        # the stale entry is dropped by the single-file checks as well
+        files[1].unlink()
+        assert not downloader.local_file_exists("20230302", INPETypes.DAILY_RAIN)
+        assert (
+            downloader.catalog.get(
+                **INPEParsers.daily_rain_parser.catalog_key("20230302")
+            )
+            is None
+        )
+        assert downloader.get_file("20230302", INPETypes.DAILY_RAIN) == files[1]
+        assert files[1].exists()
+
+    def test_prefetch(self, ftp_server_factory, tmp_path):
+        """The next dates of a cube and the day after the latest DAILY_RAIN are prefetched"""
+        server = ftp_server_factory(latency=0.01)
+        parser = rain_parser(server.root, days=6)
+        downloader = Downloader(
+            server.address, [parser], tmp_path, keepalive=None, prefetch=2
+        )
+
+        with patch.object(
+            downloader, "prefetch_files", wraps=downloader.prefetch_files
+        ) as prefetch:
+            cube = downloader.create_cube("20230301", "20230306", "rain")
+
+        assert prefetch.call_args_list[0].args[0] == [
+            datetime(2023, 3, 2),
+            datetime(2023, 3, 3),
+        ]
+        assert cube.sum(dim=["latitude", "longitude"]).values.ravel().tolist() == [
+            12.0 * day for day in range(1, 7)
+        ]
+        assert len(downloader.catalog) == 6
+
+        # a new session warms the day after the latest local DAILY_RAIN file
+        merge = Downloader(
+            server.address, [INPEParsers.daily_rain_parser], tmp_path, keepalive=None
+        )
+        merge.get_range("20230301", "20230305", INPETypes.DAILY_RAIN)
+
+        merge = Downloader(
+            server.address,
+            [INPEParsers.daily_rain_parser],
+            tmp_path,
+            keepalive=None,
+            prefetch=1,
+        )
+        assert merge.prefetch_latest().result().name == "MERGE_CPTEC_20230306.grib2"
+        assert merge.local_file_exists("20230306", INPETypes.DAILY_RAIN)
+
+    def test_close(self, ftp_server_factory, tmp_path):
+        """Closing the downloader stops the prefetch threads, the FTP pool and the catalog"""
+        server = ftp_server_factory(latency=0.05)
+        parser = rain_parser(server.root, days=6)
+        downloader = Downloader(
+            server.address, [parser], tmp_path, keepalive=None, prefetch=1
+        )
+        futures = downloader.prefetch_files(
+            ["20230301", "20230302", "20230303"], "rain"
+        )
+        prefetcher = downloader._prefetcher  # pylint: disable=protected-access
+
+        with patch.object(downloader.ftp, "close", wraps=downloader.ftp.close) as close:
+            downloader.close()
+
+        close.assert_called_once()
+        assert prefetcher._shutdown  # pylint: disable=protected-access
+        assert all(future.done() for future in futures)
+        assert downloader._prefetcher is None  # pylint: disable=protected-access
+        with pytest.raises(sqlite3.ProgrammingError):
+            len(downloader.catalog)
+
+    def test_latest_available(self, ftp_server, tmp_path):
+        """The latest date comes from one listing per month, falling back to the previous one"""
+        downloader = Downloader(
+            ftp_server.address,
+            [INPEParsers.daily_rain_parser],
+            tmp_path,
+            keepalive=None,
+        )
+        downloader.ftp.invalidate_listings()
+        ftp_server.commands.clear()
+
+        latest = downloader.latest_available(INPETypes.DAILY_RAIN, "20230315")
+        assert latest == datetime(2023, 3, 15)
+        assert ftp_server.commands.count("MLSD") == 1
+        assert "SIZE" not in ftp_server.commands
+
+        # April has no files yet, so the last day of March is found
+        latest = downloader.latest_available(INPETypes.DAILY_RAIN, "20230410")
+        assert latest == datetime(2023, 3, 31)
+        assert ftp_server.commands.count("MLSD") == 2
+
+        assert downloader.latest_available(INPETypes.DAILY_RAIN, "20230610") is None
+
+    def test_lazy_cube(self, ftp_server, tmp_path):
+        """Lazy cubes are backed by dask and give the same results"""
+        parser = rain_parser(ftp_server.root, days=10)
+        downloader = Downloader(ftp_server.address, [parser], tmp_path, keepalive=None)
+
+        cube = downloader.create_cube("20230301", "20230310", "rain", lazy=True)
+        assert isinstance(cube.data, dask.array.Array)
+        assert len(cube.chunksizes["time"]) == 10
+
+        eager = downloader.create_cube("20230301", "20230310", "rain")
+        assert (cube.sum(dim="time").compute() == eager.sum(dim="time")).all()
+
+        accum = downloader.accum_rain("20230301", "20230310", "rain", lazy=True)
+        assert float(accum.max()) == sum(range(1, 11))
+
+        with patch("importlib.util.find_spec", return_value=None):
+            with pytest.raises(ImportError, match="pip install dask"):
+                downloader.create_cube("20230301", "20230310", "rain", lazy=True)
+
+    def test_cube_store(self, ftp_server, tmp_path):
+        """Decoded dates are appended to the cube store and sliced from it afterwards"""
+        parser = rain_parser(ftp_server.root, days=8)
+        downloader = Downloader(
+            ftp_server.address, [parser], tmp_path, keepalive=None, cube_store=True
+        )
+
+        first = downloader.create_cube("20230301", "20230305", "rain")
+        second = downloader.create_cube("20230303", "20230308", "rain")
+        assert second.sum(dim=["latitude", "longitude"]).values.ravel().tolist() == [
+            12.0 * day for day in range(3, 9)
+        ]
+
+        with patch.object(downloader, "open_file") as open_file:
+            cube = downloader.create_cube("20230301", "20230308", "rain")
+
+        assert not open_file.called
+        xr.testing.assert_equal(cube.isel(time=slice(0, 5)), first)
+
+        # files updated in the server are seen by parsers that check for updates
+        # (a minute later, as the listings have a resolution of seconds)
+        updated = ftp_server.root / "rain/rain_20230301.grib2"
+        updated.write_bytes(grib_bytes(np.full((3, 4), 100), datetime(2023, 3, 1)))
+        os.utime(updated, (time.time() + 60, time.time() + 60))
+        parser.avoid_update = False
+        parser.ftp.invalidate_listings()
+        cube = downloader.create_cube("20230301", "20230302", "rain")
+        assert cube.sum(dim=["latitude", "longitude"]).values.ravel().tolist() == [
+            1200.0,
+            24.0,
+        ]
+
+    def test_region_cube(self, ftp_server, tmp_path):
+        """Cubes cut to a bbox or geometry equal the full cube clipped to the region"""
+        parser = rain_parser(ftp_server.root, days=4)
+        downloader = Downloader(
+            ftp_server.address, [parser], tmp_path, keepalive=None, cube_store=True
+        )
+
+        full = downloader.create_cube("20230301", "20230304", "rain")
+        bbox = (300.5, -11.5, 302.5, -9.5)
+        cube = downloader.create_cube("20230301", "20230304", "rain", bbox=bbox)
+
+        assert cube.sizes["time"] == 4
+        assert (cube.sizes["latitude"], cube.sizes["longitude"]) == (2, 2)
+        expected = full.rio.write_crs("epsg:4326").rio.clip_box(*bbox)
+        xr.testing.assert_equal(
+            cube.drop_vars("spatial_ref"), expected.drop_vars("spatial_ref")
+        )
+
+        # without the cube store, each file is cut before being stacked
+        downloader.cube_stores = None
+        geometry = gpd.GeoSeries([box(*bbox)], crs="epsg:4326")
+        clipped = downloader.create_cube(
+            "20230301", "20230304", "rain", geometry=geometry
+        )
+        assert clipped.shape == cube.shape
+        assert float(clipped.sum()) == float(cube.sum())
+
+        accum = downloader.accum_rain("20230301", "20230304", "rain", bbox=bbox)
+        assert accum.squeeze().shape == (2, 2) and float(accum.max()) == 10
+
+    def test_reduce_range(self, ftp_server, tmp_path):
+        """The period is reduced file by file, without creating the cube"""
+        parser = rain_parser(ftp_server.root, days=6)
+        downloader = Downloader(ftp_server.address, [parser], tmp_path, keepalive=None)
+
+        with patch.object(GISUtil, "stack_arrays") as stack_arrays:
+            accum = downloader.accum_rain("20230301", "20230306", "rain")
+            wettest = downloader.reduce_range("20230301", "20230306", "rain", "max")
+            rainy = downloader.reduce_range(
+                "20230301", "20230306", "rain", Reducer.rainy_days(threshold=4)
+            )
+
+        assert not stack_arrays.called
+        cube = downloader.create_cube("20230301", "20230306", "rain")
+        np.testing.assert_array_equal(accum.values, cube.sum(dim="time").values)
+        assert float(wettest.max()) == 6 and float(rainy.max()) == 3
+        assert accum.time.values == cube.time[0].values
+
+    def test_cumulative_store(self, ftp_server, tmp_path):
+        """Periods are read from the running totals, opening each file just once"""
+        parser = rain_parser(ftp_server.root, days=10)
+        downloader = Downloader(
+            ftp_server.address,
+            [parser],
+            tmp_path,
+            keepalive=None,
+            cumulative_store=True,
+        )
+        periods = [("20230301", "20230303"), ("20230304", "20230310")]
+
+        with patch.object(
+            downloader, "open_file", wraps=downloader.open_file
+        ) as open_file:
+            rains = downloader.accum_periodically_rain(periods, "rain")
+            again = downloader.accum_rain("20230302", "20230309", "rain")
+
+        assert open_file.call_count == 10
+        assert rains.max(dim=["latitude", "longitude"]).values.ravel().tolist() == [
+            6.0,
+            sum(range(4, 11)),
+        ]
+        assert float(again.max()) == sum(range(2, 10))
+
+        # the totals can't be prepended, so an earlier period rebuilds the store
+        downloader.get_cumulative_store("rain").clear()
+        downloader.accum_rain("20230305", "20230306", "rain")
+        assert float(downloader.accum_rain("20230301", "20230310", "rain").max()) == 55
+
+    def test_month_cube_store(self, ftp_server, tmp_path):
+        """Cubes of monthly totals follow their refresh instead of the cube store"""
+        daily = rain_parser(ftp_server.root, days=31)
+        monthly = month_parser(daily)
+        downloader = Downloader(
+            ftp_server.address,
+            [daily, monthly],
+            tmp_path,
+            keepalive=None,
+            cube_store=True,
+        )
+
+        file = monthly.get_file(datetime(2023, 3, 1), tmp_path)
+
+        # a total of the first 20 days, just created
+        with xr.open_dataset(file) as dset:
+            partial = dset.load()
+        partial["monthacum"][:] = sum(range(1, 21))
+        partial.attrs.update(last_day="20230320", days=20)
+        partial.to_netcdf(file)
+
+        cube = downloader.create_cube("20230301", "20230301", "monthly")
+        assert float(cube.max()) == sum(range(1, 21))
+
+        # some hours later, the total is refreshed with the rest of the month
+        partial.attrs.update(updated=str(datetime.now() - timedelta(hours=3)))
+        partial.to_netcdf(file)
+
+        cube = downloader.create_cube("20230301", "20230301", "monthly")
+        assert float(cube.max()) == sum(range(1, 32))
+
+    def test_lead_cube(self, ftp_server, tmp_path):
+        """All the leads of the runs come from one pass, downloading each hour once"""
+        runs = [datetime(2023, 5, 22), datetime(2023, 5, 23)]
+        hourly, daily = wrf_parsers(ftp_server.root, runs, hours=60)
+        downloader = Downloader(
+            ftp_server.address, [hourly, daily], tmp_path, keepalive=None, max_workers=2
+        )
+
+        # the test parsers stand for the DAILY_WRF parser
+        with patch.object(downloader, "get_parser", return_value=daily):
+            ftp_server.commands.clear()
+            cube = downloader.create_lead_cube("20230522", "20230523", [2, 0, 1])
+
+        # hours 0, 12, 36 and 60 of each run
+        assert ftp_server.commands.count("RETR") == 8
+        assert cube.dims == ("run_date", "lead", "latitude", "longitude")
+        assert cube.lead.values.tolist() == [0, 1, 2]
+        assert cube.max(dim=["latitude", "longitude"]).values.tolist() == [
+            [24, 48, 48],
+            [36, 72, 72],
+        ]
+        assert cube.valid_date[1, 2].values == np.datetime64("2023-05-25T12:00")
+
+        # the same as the daily files
+        forecast = downloader.open_file("20230524", "daily", ref_date=runs[0])
+        np.testing.assert_array_equal(
+            forecast.sel(variable="daily").squeeze().values, cube[0, 2].values
+        )
+
+        with patch.object(downloader, "get_parser", return_value=daily):
+            with pytest.raises(ValueError, match="No WRF runs"):
+                downloader.create_lead_cube("20230523", "20230522")
@@ -0,0 +1,17 @@
+"""
+Tests of the local FTP stand-in (see ftp_server.py) and the benchmark harness.
+The tests of each module against the stand-in are next to the other tests of the module.
+"""
+from benchmark import run_benchmark
+
+
+class TestLocalFTP:
+    """Test the local FTP stand-in and the benchmark harness"""
+
+    def test_benchmark(self):
+        """The benchmark harness runs and reports the throughput"""
+        result = run_benchmark(days=5, workers=2, latency=0.001, size=1024)
+
+        assert result["files"] == 5
+        assert result["bytes"] == 5 * 1024
+        assert result["files/s"] > 0
@@ -0,0 +1,37 @@
+"""Guard the import time of the package against regressions"""
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import run_import_benchmark
+
+
+class TestImports:
+    """The heavy dependencies should only be imported on first use"""
+
+    @pytest.mark.parametrize(
+        "module",
+        [
+            "raindownloader.downloader",
+            "raindownloader.inpeparser",
+            "raindownloader.cli",
+        ],
+    )
+    def test_no_heavy_imports(self, module):
+        """Importing the modules does not load the geo/plotting dependencies"""
+        result = run_import_benchmark(module, repeat=1)
+        assert not result["heavy"], f"{module} imports {result['heavy']}"
+
+    def test_lazy_modules_load_on_use(self):
+        """The lazy xarray also registers the rioxarray accessor"""
+        code = (
+            "from raindownloader.utils import xr\n"
+            "from raindownloader.inpeparser import INPE\n"
+            "print(hasattr(xr.DataArray([1]), 'rio'), INPE.cmap.name)\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=False
+        ).stdout
+
+        assert output.split() == ["True", "my_colormap"]
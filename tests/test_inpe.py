@@ -1,6 +1,19 @@
 """
 Tests for the INPE classes
 """
+import os
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import numpy as np
+import xarray as xr
+
+from raindownloader.downloader import Downloader
+from raindownloader.utils import GISUtil
+
+from ftp_server import grib_bytes, month_parser, rain_parser, wrf_parsers
+
 # import os
 # import pytest
 
@@ -40,3 +53,166 @@ Tests for the INPE classes
 #             INPE.MERGE_filename(fixture_data["test_date"])
 #             == fixture_data["correct_filename"]
 #         )
+
+
+class TestINPEParsers:
+    """Test the INPE parsers against the local FTP server"""
+
+    def test_incremental_month(self, ftp_server, tmp_path):
+        """An outdated monthly total just adds the days after its last day"""
+        daily = rain_parser(ftp_server.root, days=31)
+        monthly = month_parser(daily)
+        Downloader(ftp_server.address, [daily, monthly], tmp_path, keepalive=None)
+
+        with patch.object(
+            GISUtil, "reduce_files", wraps=GISUtil.reduce_files
+        ) as reduce:
+            file = monthly.get_file(datetime(2023, 3, 1), tmp_path)
+            with xr.open_dataset(file) as dset:
+                full = dset.load()
+
+            # simulate a total created on the 20th, 3 hours ago
+            partial = full.copy(deep=True)
+            partial["monthacum"][:] = sum(range(1, 21))
+            partial.attrs.update(
+                last_day="20230320",
+                days=20,
+                updated=str(datetime.now() - timedelta(hours=3)),
+            )
+            partial.to_netcdf(file)
+
+            reduce.reset_mock()
+            monthly.get_file(datetime(2023, 3, 1), tmp_path)
+
+        assert len(reduce.call_args.kwargs["files"]) == 11
+        with xr.open_dataset(file) as dset:
+            xr.testing.assert_equal(dset["monthacum"], full["monthacum"])
+            assert dset.attrs["days"] == 31
+            assert dset.attrs["last_day"] == full.attrs["last_day"]
+        assert float(full["monthacum"].max()) == sum(range(1, 32))
+
+    def test_month_catalog(self, ftp_server, tmp_path):
+        """An outdated monthly total is updated by get_files even if it is in the catalog"""
+        daily = rain_parser(ftp_server.root, days=31)
+        monthly = month_parser(daily)
+        downloader = Downloader(
+            ftp_server.address, [daily, monthly], tmp_path, keepalive=None
+        )
+
+        file = monthly.get_file(datetime(2023, 3, 1), tmp_path)
+        assert monthly.is_downloaded(datetime(2023, 3, 1), tmp_path)
+
+        # an incomplete total, created 3 hours ago and present in the catalog
+        with xr.open_dataset(file) as dset:
+            partial = dset.load()
+        partial["monthacum"][:] = sum(range(1, 21))
+        partial.attrs.update(
+            last_day="20230320",
+            days=20,
+            updated=str(datetime.now() - timedelta(hours=3)),
+        )
+        partial.to_netcdf(file)
+        downloader.catalog.register(
+            path=file, **monthly.catalog_key(datetime(2023, 3, 1))
+        )
+
+        assert not monthly.is_downloaded(datetime(2023, 3, 1), tmp_path)
+        assert monthly.get_files([datetime(2023, 3, 1)], tmp_path) == [file]
+
+        with xr.open_dataset(file) as dset:
+            assert dset.attrs["days"] == 31
+            assert float(dset["monthacum"].max()) == sum(range(1, 32))
+
+    def test_nested_workers(self, ftp_server, tmp_path):
+        """A monthly total with several workers gets its daily files without deadlocking"""
+        daily = rain_parser(ftp_server.root, days=31)
+        for day in range(1, 29):
+            (ftp_server.root / f"rain/rain_202302{day:02d}.grib2").write_bytes(
+                grib_bytes(np.full((3, 4), day), datetime(2023, 2, day))
+            )
+        monthly = month_parser(daily)
+        downloader = Downloader(
+            ftp_server.address,
+            [daily, monthly],
+            tmp_path,
+            keepalive=None,
+            max_workers=2,
+        )
+
+        files = []
+        thread = threading.Thread(
+            target=lambda: files.extend(
+                downloader.get_range("20230201", "20230301", "monthly")
+            ),
+            daemon=True,
+        )
+        thread.start()
+        thread.join(timeout=60)
+
+        # on a deadlock, release the sessions held by the workers, so the test ends
+        deadlocked = thread.is_alive()
+        if deadlocked:
+            for _ in range(downloader.ftp.pool_size):
+                downloader.ftp._slots.release()  # pylint: disable=protected-access
+            thread.join()
+
+        assert not deadlocked
+        assert [file.name for file in files] == ["accum_202302.nc", "accum_202303.nc"]
+
+    def test_wrf_cumulative(self, ftp_server, tmp_path):
+        """Each cumulative WRF hour is downloaded once and the rain comes from differences"""
+        ref_date = datetime(2023, 5, 22)
+        hourly, daily = wrf_parsers(ftp_server.root, [ref_date], hours=48)
+        downloader = Downloader(
+            ftp_server.address, [hourly, daily], tmp_path, keepalive=None
+        )
+        ftp_server.commands.clear()
+
+        files = hourly.get_range(
+            datetime(2023, 5, 22, 1),
+            datetime(2023, 5, 22, 6),
+            tmp_path,
+            ref_date=ref_date,
+        )
+        assert ftp_server.commands.count("RETR") == 7
+        for file in files:
+            with xr.open_dataset(file) as dset:
+                assert (dset["hourly"] == 2).all()
+
+        # the day is the difference of 12h of the day and of the previous day (or the start)
+        ftp_server.commands.clear()
+        first = downloader.open_file("20230522", "daily", ref_date=ref_date)
+        second = downloader.open_file("20230523", "daily", ref_date=ref_date)
+
+        assert ftp_server.commands.count("RETR") == 2
+        assert float(first.max()) == 24 and float(second.max()) == 48
+        assert not list(tmp_path.rglob("tmp*"))
+
+    def test_wrf_cumulative_prune(self, ftp_server, tmp_path):
+        """Only the cumulative files of the newest runs (and of the run in use) are kept"""
+        runs = [datetime(2023, 5, 20), datetime(2023, 5, 21), datetime(2023, 5, 22)]
+        hourly, _ = wrf_parsers(ftp_server.root, runs, hours=2)
+        hourly.keep_runs = 2
+        Downloader(ftp_server.address, [hourly], tmp_path, keepalive=None)
+
+        # the remote files of each run are newer than the ones of the previous run
+        for ref_date in runs:
+            folder = ftp_server.root / f"wrf/{ref_date:%Y/%m/%d}/00"
+            for file in folder.iterdir():
+                stamp = ref_date.timestamp()
+                os.utime(file, (stamp, stamp))
+
+        cache = hourly.cumulative_folder(tmp_path) / "hourly"
+
+        def cached_runs():
+            files = [file for file in cache.rglob("*") if file.is_file()]
+            return sorted({file.parent.relative_to(cache).as_posix() for file in files})
+
+        for ref_date in runs:
+            hourly.get_file(ref_date + timedelta(hours=2), tmp_path, ref_date=ref_date)
+        assert cached_runs() == ["2023/05/21/00", "2023/05/22/00"]
+        assert not (cache / "2023/05/20").exists()
+
+        # an old run is downloaded again, so the oldest of the others is dropped
+        hourly.get_file(runs[0] + timedelta(hours=1), tmp_path, ref_date=runs[0])
+        assert cached_runs() == ["2023/05/20/00", "2023/05/22/00"]
@@ -0,0 +1,74 @@
+"""Tests for the cache of rasterized geometries"""
+from unittest.mock import patch
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rioxarray  # noqa: F401  pylint: disable=unused-import
+import xarray as xr
+from shapely.geometry import Polygon
+
+from raindownloader.downloader import Downloader
+from raindownloader.maskcache import MaskCache
+
+
+def grid_cube(size: int = 20) -> xr.DataArray:
+    """Cube with 3 dates in a 0.1 degree grid (values are the pixel index)"""
+    values = np.arange(3 * size * size, dtype="float32").reshape(3, size, size)
+    return xr.DataArray(
+        values,
+        dims=("time", "latitude", "longitude"),
+        coords={
+            "time": pd.date_range("2023-03-01", periods=3),
+            "latitude": -10 - 0.1 * np.arange(size),
+            "longitude": -60 + 0.1 * np.arange(size),
+        },
+    ).rio.write_crs("epsg:4326")
+
+
+BASIN = gpd.GeoSeries(
+    [Polygon([(-59.5, -10.3), (-58.6, -10.6), (-59.0, -11.4), (-59.7, -11.0)])],
+    crs="epsg:4326",
+)
+
+
+class TestMaskCache:
+    """Test the MaskCache class"""
+
+    def test_clip(self, tmp_path):
+        """The cached masks give the same result as rio.clip"""
+        cube = grid_cube()
+        cache = MaskCache(tmp_path)
+
+        clipped = Downloader.cut_cube_by_geoms(cube, BASIN, mask_cache=cache)
+        expected = Downloader.cut_cube_by_geoms(cube, BASIN)
+        xr.testing.assert_equal(
+            clipped.drop_vars("spatial_ref"), expected.drop_vars("spatial_ref")
+        )
+
+        series = Downloader.get_time_series(
+            cube, gpd.GeoDataFrame(geometry=BASIN), xr.DataArray.mean, mask_cache=cache
+        )
+        assert (
+            series.tolist()
+            == clipped.mean(dim=["latitude", "longitude"]).values.tolist()
+        )
+        assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    def test_persistence(self, tmp_path):
+        """Masks are rasterized once per grid and loaded from disk by new caches"""
+        cube = grid_cube()
+        MaskCache(tmp_path).clip(cube, BASIN)
+
+        with patch("rasterio.features.geometry_mask") as geometry_mask:
+            cache = MaskCache(tmp_path)
+            cache.clip(cube, BASIN)
+            cache.clip(cube.isel(time=0), BASIN)
+            assert not geometry_mask.called
+
+        # another grid needs its own mask
+        cache.clip(grid_cube(size=25), BASIN)
+        assert len(list(tmp_path.glob("*.npz"))) == 2
+
+        cache.clear()
+        assert not list(tmp_path.glob("*.npz"))
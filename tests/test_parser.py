@@ -1,8 +1,11 @@
 """Test the BaseParser class"""
 import os
+import time
 from pathlib import Path
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from raindownloader.inpeparser import INPEParsers
 from raindownloader.parser import BaseParser, DateFrequency
+from raindownloader.utils import FTPUtil
 
 
 class TestBaseParser:
@@ -65,6 +68,19 @@ class TestBaseParser:
         dates = self.base_parser.dates_range("2022-01-01", "2022-01-03")
         assert dates == ["20220101", "20220102", "20220103"]
 
+    # Test the plan() method
+    def test_plan(self):
+        """Docstring"""
+        plan = self.base_parser.plan_range("2022-01-30", "2022-02-02", self.temp_folder)
+
+        assert len(plan) == 4
+        for date, row in plan.iterrows():
+            assert row["remote_target"] == self.base_parser.remote_target(date)
+            assert row["local_target"] == self.base_parser.local_target(
+                date, self.temp_folder
+            )
+        assert plan["remote_path"].nunique() == 2
+
     # Test the download_file() method
     def test_download_file(self):
         """Docstring"""
@@ -84,3 +100,60 @@ class TestBaseParser:
             remote_file=remote_target,
             local_folder=local_target.parent,
         )
+
+    # Test the get_files() method with parallel workers
+    def test_get_files_parallel(self):
+        """get_files with several workers keeps the dates order"""
+        dates = ["20220103", "20220101", "20220102", "20220104"]
+
+        def get_file(date, **_):
+            # make the first dates the slowest ones
+            time.sleep(0.01 * (len(dates) - dates.index(date)))
+            return Path(date)
+
+        self.base_parser.max_workers = 3
+        self.base_parser.ftp.in_session = False
+        self.base_parser.get_file = get_file  # type: ignore
+
+        files = self.base_parser.get_files(dates, self.temp_folder)
+
+        assert files == [Path(date) for date in dates]
+        assert self.base_parser.ftp.session.call_count == len(dates)
+
+    # Test the get_files() method with the planned targets
+    def test_get_files_planned(self):
+        """get_files downloads to the planned targets, without deriving them per file"""
+        dates = ["20220130", "20220201"]
+        plan = self.base_parser.plan(dates, self.temp_folder)
+
+        with patch.object(self.base_parser, "remote_target") as remote_target:
+            with patch.object(self.base_parser, "local_target") as local_target:
+                self.base_parser.get_files(dates, self.temp_folder)
+
+        assert not remote_target.called
+        assert not local_target.called
+
+        mock_fn = self.base_parser.ftp.download_ftp_file
+        for _, row in plan.iterrows():
+            mock_fn.assert_any_call(
+                remote_file=row["remote_target"],
+                local_folder=row["local_target"].parent,
+            )
+
+
+class TestParserLocal:
+    """Test the parsers against the local FTP server"""
+
+    def test_parallel_range(self, ftp_server, tmp_path):
+        """get_range with several workers downloads everything in date order"""
+        # the module-level parser is restored after the test (see conftest.py)
+        parser = INPEParsers.daily_rain_parser
+        parser.ftp = FTPUtil(ftp_server.address, pool_size=4)
+        parser.max_workers = 4
+
+        files = parser.get_range("2023-03-01", "2023-03-10", tmp_path)
+
+        assert [file.name for file in files] == [
+            f"MERGE_CPTEC_202303{day:02d}.grib2" for day in range(1, 11)
+        ]
+        assert all(file.exists() for file in files)
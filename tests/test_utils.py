@@ -1,14 +1,26 @@
 """
 Tests
 """
+import errno
+import os
+import socket
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
 from socket import gaierror
 import ftplib
+import tracemalloc
+from unittest.mock import patch, MagicMock
+import numpy as np
+import pandas as pd
 import pytest
-from raindownloader.utils import FTPUtil, OSUtil
+import xarray as xr
+from raindownloader.utils import DateProcessor, FTPUtil, GISUtil, OSUtil, Reducer
 from raindownloader.inpeparser import INPEParsers
 
+from ftp_server import MERGE_ROOT, WRF_ROOT, grib_bytes
+
 
 class TestFTPUtil:
     """Test the FTPUtil class"""
@@ -77,3 +89,468 @@ class TestOSUtil:
 
         assert isinstance(file_info["datetime"], datetime)
         assert isinstance(file_info["size"], int)
+
+
+class TestFTPPool:
+    """Test the session pool of the FTPUtil class"""
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_session(self, mock_open):
+        """Sessions are bound to the thread and reused after being released"""
+        mock_open.side_effect = lambda server: MagicMock(host=server)
+        ftp = FTPUtil("ftp.example.com", pool_size=2)
+
+        with ftp.session() as session:
+            assert ftp.get_connection() is session
+            assert session is not ftp.ftp
+
+        # outside the session, the main connection is used again
+        assert ftp.get_connection() is ftp.ftp
+
+        # the idle session is reused
+        with ftp.session() as session2:
+            assert session2 is session
+
+        assert mock_open.call_count == 2
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_session_discarded_on_error(self, mock_open):
+        """A session that raised an FTP error is closed and not returned to the pool"""
+        mock_open.side_effect = lambda server: MagicMock(host=server)
+        ftp = FTPUtil("ftp.example.com", pool_size=1)
+
+        with pytest.raises(EOFError):
+            with ftp.session() as session:
+                raise EOFError()
+
+        assert session.quit.called
+
+        with ftp.session() as session2:
+            assert session2 is not session
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_session_kept_on_missing_file(self, mock_open):
+        """A session that just got a permanent error (e.g., missing file) is reused"""
+        mock_open.side_effect = lambda server: MagicMock(host=server)
+        ftp = FTPUtil("ftp.example.com", pool_size=1)
+
+        with pytest.raises(ftplib.error_perm):
+            with ftp.session() as session:
+                raise ftplib.error_perm("550 No such file")
+
+        with ftp.session() as session2:
+            assert session2 is session
+
+        assert not session.quit.called
+
+    def test_connection_errors(self):
+        """Socket errors mean a lost connection, local file errors don't"""
+        assert FTPUtil.is_connection_error(EOFError())
+        assert FTPUtil.is_connection_error(ConnectionResetError())
+        assert FTPUtil.is_connection_error(TimeoutError())
+        assert FTPUtil.is_connection_error(ftplib.error_temp("421 Timeout"))
+        assert FTPUtil.is_connection_error(OSError(errno.ENETUNREACH, "unreachable"))
+
+        assert not FTPUtil.is_connection_error(ftplib.error_temp("450 Busy"))
+        assert not FTPUtil.is_connection_error(ftplib.error_perm("550 No such file"))
+        assert not FTPUtil.is_connection_error(OSError(errno.ENOSPC, "disk full"))
+        assert not FTPUtil.is_connection_error(PermissionError(errno.EACCES, "denied"))
+
+
+class TestFTPListing:
+    """Test the folder listing functions of the FTPUtil class"""
+
+    @staticmethod
+    def mlsd(_, facts=None):  # pylint: disable=unused-argument
+        """Fake MLSD answer"""
+        return iter(
+            [
+                (".", {"type": "cdir"}),
+                ("2023", {"type": "dir"}),
+                (
+                    "MERGE_CPTEC_20230301.grib2",
+                    {"type": "file", "size": "1234", "modify": "20230302101112.123"},
+                ),
+            ]
+        )
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_list_folder(self, mock_open):
+        """MLSD entries are parsed into datetime and size, ignoring folders"""
+        mock_open.return_value.mlsd.side_effect = self.mlsd
+        ftp = FTPUtil("ftp.example.com")
+
+        listing = ftp.list_folder("/DAILY/2023/03")
+        assert listing == {
+            "MERGE_CPTEC_20230301.grib2": {
+                "datetime": datetime(2023, 3, 2, 10, 11, 12),
+                "size": 1234,
+            }
+        }
+
+    def test_parse_list_line(self):
+        """LIST lines give the size, but not a precise datetime"""
+        line = "-rw-r--r--    1 ftp      ftp       1234 Mar 02 10:11 MERGE_CPTEC_20230301.grib2"
+        assert FTPUtil.parse_list_line(line) == (
+            "MERGE_CPTEC_20230301.grib2",
+            {"datetime": None, "size": 1234},
+        )
+        assert (
+            FTPUtil.parse_list_line("drwxr-xr-x 2 ftp ftp 4096 Mar 02 10:11 03") is None
+        )
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_listing_cache(self, mock_open):
+        """File info and existence are answered from the cached listing"""
+        conn = mock_open.return_value
+        conn.mlsd.side_effect = self.mlsd
+        ftp = FTPUtil("ftp.example.com")
+        remote_file = "/DAILY/2023/03/MERGE_CPTEC_20230301.grib2"
+
+        ftp.prefetch_listings(["/DAILY/2023/03/", "/DAILY/2023/03"])
+        info = ftp.get_ftp_file_info(remote_file)
+        assert info == {"datetime": datetime(2023, 3, 2, 10, 11, 12), "size": 1234}
+        assert not ftp.file_changed(remote_file, info)
+        assert ftp.file_changed(remote_file, {**info, "size": 1})
+        assert ftp.file_exists(remote_file)
+        assert not ftp.file_exists("/DAILY/2023/03/MERGE_CPTEC_20230331.grib2")
+
+        assert conn.mlsd.call_count == 1
+        assert not conn.sendcmd.called
+        assert not conn.size.called
+
+        # once the listing expires, the folder is listed again
+        ftp.closed_listing_ttl = 0
+        ftp.invalidate_listings("/DAILY/2023/03")
+        ftp.file_exists(remote_file)
+        ftp.file_exists(remote_file)
+        assert conn.mlsd.call_count == 3
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_folder_ttl(self, _):
+        """Past months get the long TTL, current month and other folders get the short one"""
+        ftp = FTPUtil("ftp.example.com", listing_ttl=1, closed_listing_ttl=100)
+        now = datetime.now()
+
+        assert ftp.folder_ttl("/DAILY/2023/03") == 100
+        assert ftp.folder_ttl("/prec/2023/05/22/00") == 100
+        assert ftp.folder_ttl(f"/DAILY/{now.year}/{now.month:02d}") == 1
+        assert ftp.folder_ttl("/CLIMATOLOGY/DAILY_AVERAGE") == 1
+
+
+class TestFTPDownload:
+    """Test the resumable download of the FTPUtil class"""
+
+    content = b"0123456789" * 100
+
+    def retrbinary(self, calls: list):
+        """Create a fake retrbinary that fails midway in the first call"""
+
+        def _retrbinary(_, callback, rest=None):
+            calls.append(rest)
+            offset = rest or 0
+            if len(calls) == 1:
+                callback(self.content[offset:500])
+                raise EOFError("connection lost")
+
+            callback(self.content[offset:])
+
+        return _retrbinary
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_download_resumed(self, mock_open, tmp_path):
+        """An interrupted transfer is resumed from the partial size and moved into place"""
+        calls: list = []
+        conn = mock_open.return_value
+        conn.mlsd.return_value = iter(
+            [
+                (
+                    "file.grib2",
+                    {"type": "file", "size": "1000", "modify": "20230302101112"},
+                )
+            ]
+        )
+        conn.retrbinary.side_effect = self.retrbinary(calls)
+        ftp = FTPUtil("ftp.example.com")
+
+        local_path = ftp.download_ftp_file("/DAILY/2023/03/file.grib2", tmp_path)
+
+        assert calls == [None, 500]
+        assert local_path.read_bytes() == self.content
+        assert not local_path.with_name("file.grib2.part").exists()
+        assert OSUtil.get_local_file_info(local_path) == {
+            "datetime": datetime(2023, 3, 2, 10, 11, 12),
+            "size": 1000,
+        }
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_download_incomplete(self, mock_open, tmp_path):
+        """A file is never moved into place if the transfer could not be completed"""
+        conn = mock_open.return_value
+        conn.sendcmd.return_value = "213 20230302101112"
+        conn.size.return_value = 1000
+        conn.retrbinary.side_effect = EOFError("connection lost")
+        ftp = FTPUtil("ftp.example.com")
+
+        with pytest.raises(EOFError):
+            ftp.download_ftp_file(
+                "/file.grib2", tmp_path, alt_server="ftp.example.com", retries=1
+            )
+
+        assert conn.retrbinary.call_count == 2
+        assert not (tmp_path / "file.grib2").exists()
+
+    @patch("raindownloader.utils.FTPUtil.open_connection")
+    def test_download_local_error(self, mock_open, tmp_path):
+        """Local errors (e.g., disk full) are raised without retrying the transfer"""
+        conn = mock_open.return_value
+        conn.sendcmd.return_value = "213 20230302101112"
+        conn.size.return_value = 1000
+        conn.retrbinary.side_effect = OSError(errno.ENOSPC, "No space left on device")
+        ftp = FTPUtil("ftp.example.com")
+
+        with pytest.raises(OSError, match="No space left"):
+            ftp.download_ftp_file("/file.grib2", tmp_path, retries=3)
+
+        assert conn.retrbinary.call_count == 1
+
+
+class TestFTPUtilLocal:
+    """Test the FTPUtil class against the local FTP server"""
+
+    remote_file = f"/{MERGE_ROOT}/2023/03/MERGE_CPTEC_20230301.grib2"
+
+    def test_list_folder(self, ftp_server_factory):
+        """MLSD and the LIST fallback give the same sizes"""
+        mlsd = FTPUtil(ftp_server_factory().address).list_folder(
+            f"/{MERGE_ROOT}/2023/03"
+        )
+        listing = FTPUtil(ftp_server_factory(mlsd=False).address).list_folder(
+            f"/{MERGE_ROOT}/2023/03"
+        )
+
+        assert len(mlsd) == len(listing) == 31
+        assert all(mlsd[name]["size"] == listing[name]["size"] for name in mlsd)
+        assert isinstance(mlsd["MERGE_CPTEC_20230301.grib2"]["datetime"], datetime)
+
+    def test_download_resume(self, ftp_server, tmp_path):
+        """A partial file left by a previous transfer is resumed with REST"""
+        ftp = FTPUtil(ftp_server.address)
+        info = ftp.get_ftp_file_info(self.remote_file)
+
+        # simulate an interrupted transfer
+        full = ftp.download_ftp_file(self.remote_file, tmp_path).read_bytes()
+        (tmp_path / "MERGE_CPTEC_20230301.grib2").unlink()
+        part = tmp_path / "MERGE_CPTEC_20230301.grib2.part"
+        part.write_bytes(full[:100])
+        timestamp = info["datetime"].timestamp()
+        os.utime(part, (timestamp, timestamp))
+
+        ftp_server.commands.clear()
+        local_path = ftp.download_ftp_file(self.remote_file, tmp_path)
+
+        assert "REST" in ftp_server.commands
+        assert local_path.read_bytes() == full
+        assert not part.exists()
+
+    def test_download_outdated_listing(self, ftp_server, tmp_path):
+        """A file published again after the folder was listed is downloaded in full"""
+        ftp = FTPUtil(ftp_server.address)
+        assert ftp.file_exists(self.remote_file)
+
+        # the file grows after the listing was cached
+        content = os.urandom(2048)
+        (ftp_server.root / self.remote_file.lstrip("/")).write_bytes(content)
+
+        local_path = ftp.download_ftp_file(self.remote_file, tmp_path)
+
+        assert local_path.read_bytes() == content
+        assert ftp.listed_file_info(self.remote_file)["size"] == 2048
+
+    def test_lazy_reconnect(self, ftp_server):
+        """A lost connection is replaced when used, without probing it beforehand"""
+        ftp = FTPUtil(ftp_server.address)
+        ftp_server.commands.clear()
+
+        # the commands sent are just the ones needed for the listing
+        assert ftp.file_exists(self.remote_file)
+        assert "PWD" not in ftp_server.commands and "NOOP" not in ftp_server.commands
+
+        # drop the connection and query another folder
+        ftp.ftp.sock.shutdown(socket.SHUT_RDWR)
+        info = ftp.get_ftp_file_info(
+            f"/{WRF_ROOT}/2023/05/22/00/WRF_cpt_07KM_2023052200_2023052201.grib2"
+        )
+
+        assert info["size"] == 1024
+        assert ftp_server.commands.count("USER") == 1
+
+    def test_keepalive(self, ftp_server):
+        """The keep-alive sends NOOP through idle connections"""
+        ftp = FTPUtil(ftp_server.address, keepalive=0.05)
+
+        try:
+            time.sleep(0.3)
+            assert "NOOP" in ftp_server.commands
+        finally:
+            ftp.close()
+
+    def test_keepalive_pool_size(self, ftp_server):
+        """Sessions requested during a keep-alive don't open connections beyond pool_size"""
+        ftp = FTPUtil(ftp_server.address, pool_size=1)
+        with ftp.session():
+            pass
+
+        def session():
+            with ftp.session():
+                pass
+
+        def check_connection(_):
+            # a session is requested while the idle one is being pinged
+            thread = threading.Thread(target=session, daemon=True)
+            threads.append(thread)
+            thread.start()
+            thread.join(0.2)
+            return True
+
+        threads = []
+        try:
+            with patch.object(
+                FTPUtil, "check_connection", side_effect=check_connection
+            ):
+                ftp.send_keepalives()
+
+            threads[-1].join(5)
+            assert ftp._idle.qsize() == 1  # pylint:disable=protected-access
+        finally:
+            ftp.close()
+
+
+class TestDateProcessor:
+    """Test the DateProcessor class"""
+
+    def test_parse_date(self):
+        """Canonical strings are parsed directly, others by dateutil"""
+        with patch("raindownloader.utils.parser.parse") as parse:
+            assert DateProcessor.parse_date("20230301") == datetime(2023, 3, 1)
+            assert DateProcessor.parse_date("20230301T153000") == datetime(
+                2023, 3, 1, 15, 30
+            )
+            assert not parse.called
+
+        assert DateProcessor.parse_date("2023-03-01 15:30") == datetime(
+            2023, 3, 1, 15, 30
+        )
+        assert DateProcessor.month_abrev("20230301") == "mar"
+
+        # partial dates are completed with the current day, so they are never memoized
+        with patch("raindownloader.utils.parser.parse") as parse:
+            DateProcessor.parse_date("2023-3")
+            DateProcessor.parse_date("2023-3")
+            assert parse.call_count == 2
+
+        with pytest.raises(ValueError):
+            DateProcessor.parse_date("20231301")
+
+
+class TestGISUtil:
+    """Test the GISUtil class"""
+
+    def test_grib_index_cache(self, tmp_path):
+        """The cfgrib index is kept in the index folder and replaced if the file changes"""
+        file = tmp_path / "rain.grib2"
+        file.write_bytes(grib_bytes([[1.0, 2.0], [3.0, 4.0]], datetime(2023, 3, 1)))
+        index_folder = tmp_path / "cache"
+
+        with GISUtil.open_dataset(file, index_folder) as dset:
+            assert float(dset["prec"].sum()) == 10
+
+        index = GISUtil.grib_index_path(file, index_folder)
+        assert list(index_folder.iterdir()) == [index]
+        assert not list(tmp_path.glob("*.idx"))
+
+        # reopening uses the same index
+        with GISUtil.open_dataset(file, index_folder):
+            assert list(index_folder.iterdir()) == [index]
+
+        file.write_bytes(grib_bytes([[1.0, 1.0], [1.0, 1.0]], datetime(2023, 3, 1)))
+        os.utime(file, (file.stat().st_atime, file.stat().st_mtime + 10))
+        with GISUtil.open_dataset(file, index_folder) as dset:
+            assert float(dset["prec"].sum()) == 4
+
+        assert len(list(index_folder.iterdir())) == 1
+        assert GISUtil.grib_index_path(file, index_folder) != index
+
+    @staticmethod
+    def layer(day: int, size: int = 3) -> xr.DataArray:
+        """Daily layer with a time-varying and a constant scalar coordinate"""
+        return xr.DataArray(
+            np.full((size, size), day, dtype="float64"),
+            dims=("latitude", "longitude"),
+            coords={
+                "latitude": np.arange(size, dtype="float64"),
+                "longitude": np.arange(size, dtype="float64"),
+                "time": pd.Timestamp(2023, 3, day),
+                "surface": 0.0,
+            },
+            name="prec",
+        )
+
+    def test_stack_arrays(self):
+        """The preallocated stack gives the same cube as xr.concat"""
+        layers = [self.layer(day) for day in range(1, 5)]
+        expected = xr.concat([layer.astype("float32") for layer in layers], dim="time")
+
+        cube = GISUtil.stack_arrays(iter(layers), size=4)
+        xr.testing.assert_identical(cube, expected)
+
+        with pytest.raises(ValueError):
+            GISUtil.stack_arrays([self.layer(1), self.layer(2, size=4)], size=2)
+
+    def test_stack_arrays_memory(self):
+        """Peak memory is about the final cube, as layers are decoded one at a time"""
+        days = 20
+        tracemalloc.start()
+        cube = GISUtil.stack_arrays(
+            (self.layer(day % 28 + 1, size=200) for day in range(days)), size=days
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert cube.dtype == "float32"
+        assert peak < 1.5 * cube.nbytes
+
+    def test_reducers(self):
+        """The streaming reducers match the reductions of the cube"""
+        layers = [self.layer(day) for day in (3, 1, 7, 2)]
+        layers[1][0, 0] = np.nan
+        cube = xr.concat(layers, dim="time")
+
+        for name, expected in [
+            ("sum", cube.sum(dim="time")),
+            ("max", cube.max(dim="time")),
+            ("min", cube.min(dim="time")),
+            ("rainy_days", (cube >= 1).sum(dim="time")),
+        ]:
+            result = Reducer.get(name).reduce(iter(layers))
+            assert result.dtype == "float32"
+            assert result.time == layers[0].time
+            np.testing.assert_array_equal(result.values, expected.values)
+
+        with pytest.raises(ValueError):
+            Reducer.sum().reduce([])
+
+    def test_reducers_memory(self):
+        """Peak memory of a streaming sum does not grow with the number of layers"""
+        peaks = []
+        for days in (5, 40):
+            tracemalloc.start()
+            accum = Reducer.sum().reduce(
+                self.layer(day % 28 + 1, size=200) for day in range(days)
+            )
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+            assert float(accum[0, 0]) == sum(day % 28 + 1 for day in range(days))
+
+        assert peaks[1] < 1.2 * peaks[0]